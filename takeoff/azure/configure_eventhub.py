@@ -1,7 +1,7 @@
 import logging
 import pprint
-from dataclasses import dataclass
-from typing import List, Set
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
 
 import voluptuous as vol
 from azure.mgmt.eventhub import EventHubManagementClient
@@ -11,21 +11,22 @@ from msrestazure.azure_exceptions import CloudError
 from takeoff.application_version import ApplicationVersion
 from takeoff.azure.create_databricks_secrets import CreateDatabricksSecretFromValue
 from takeoff.azure.credentials.keyvault import KeyVaultClient
-from takeoff.azure.credentials.subscription_id import SubscriptionId
 from takeoff.azure.util import (
     get_resource_group_name,
     get_eventhub_name,
     get_eventhub_entity_name,
-    get_azure_credentials_object,
     get_databricks_secret_name,
 )
+from takeoff.azure.management_clients import ManagementClients
 from takeoff.context import Context, ContextKey
 from takeoff.credentials.secret import Secret
 from takeoff.schemas import TAKEOFF_BASE_SCHEMA
 from takeoff.step import Step
+from takeoff.util import run_concurrently
 
 logger = logging.getLogger(__name__)
 
+
 SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
     {
         vol.Required("task"): "configure_eventhub",
@@ -53,6 +54,11 @@ SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
                 }
             ],
         ),
+        vol.Optional(
+            "max_parallel_operations",
+            default=4,
+            description="The number of EventHub entities that are configured concurrently",
+        ): vol.All(int, vol.Range(min=1)),
         "azure": {
             vol.Required(
                 "eventhub_naming",
@@ -95,6 +101,18 @@ class ConnectingString(object):
     connection_string: str
 
 
+@dataclass
+class EventHubIndex(object):
+    """In-memory snapshot of the consumer groups and authorization rules of EventHub entities
+
+    Kept up to date with everything created during the run, so every entity is listed only once.
+    """
+
+    consumer_groups: Dict[EventHub, Set[str]] = field(default_factory=dict)
+    authorization_rules: Dict[EventHub, Set[str]] = field(default_factory=dict)
+    connection_strings: Dict[Tuple[EventHub, str], ConnectingString] = field(default_factory=dict)
+
+
 class ConfigureEventHub(Step):
     """Configures EventHub
 
@@ -104,21 +122,29 @@ class ConfigureEventHub(Step):
     Optionally propagate the consumer- or producer secrets to Databricks as secret.
     """
 
+    produces = frozenset(
+        {ContextKey.EVENTHUB_PRODUCER_POLICY_SECRETS, ContextKey.EVENTHUB_CONSUMER_GROUP_SECRETS}
+    )
+
     def __init__(self, env: ApplicationVersion, config: dict):
         super().__init__(env, config)
         self.vault_name, self.vault_client = KeyVaultClient.vault_and_client(self.config, self.env)
         self.eventhub_client = self._get_eventhub_client()
+        self._databricks_secrets: Optional[CreateDatabricksSecretFromValue] = None
 
     def schema(self) -> vol.Schema:
         return SCHEMA
 
     def run(self):
+        databricks_secrets: List[Secret] = []
         if "create_consumer_groups" in self.config:
-            self._setup_consumer_groups()
+            databricks_secrets += self._setup_consumer_groups()
         if "create_producer_policies" in self.config:
-            self._setup_producer_policies()
+            databricks_secrets += self._setup_producer_policies()
+        # one batch for both, so the Databricks scope is only written once per step
+        self.create_databricks_secrets(databricks_secrets)
 
-    def _setup_consumer_groups(self):
+    def _setup_consumer_groups(self) -> List[Secret]:
         """Constructs consumer groups for all EventHub entities requested."""
         groups = [
             EventHubConsumerGroup(
@@ -133,9 +159,9 @@ class ConfigureEventHub(Step):
             )
             for group in self.config["create_consumer_groups"]
         ]
-        self.create_eventhub_consumer_groups(groups)
+        return self.create_eventhub_consumer_groups(groups)
 
-    def _setup_producer_policies(self):
+    def _setup_producer_policies(self) -> List[Secret]:
         policies = [
             EventHubProducerPolicy(
                 get_eventhub_entity_name(policy["eventhub_entity_naming"], self.env),
@@ -143,13 +169,18 @@ class ConfigureEventHub(Step):
             )
             for policy in self.config["create_producer_policies"]
         ]
-        self.create_eventhub_producer_policies(policies)
+        return self.create_eventhub_producer_policies(policies)
 
-    def create_eventhub_producer_policies(self, producer_policies: List[EventHubProducerPolicy]):
+    def create_eventhub_producer_policies(
+        self, producer_policies: List[EventHubProducerPolicy]
+    ) -> List[Secret]:
         """Constructs producer policies for all EventHub entities requested.
 
         Args:
             producer_policies: List of producer policies to create
+
+        Returns:
+            The secrets of the policies that should be propagated to Databricks
         """
         eventhub_namespace = get_eventhub_name(self.config, self.env)
         resource_group = get_resource_group_name(self.config, self.env)
@@ -157,11 +188,19 @@ class ConfigureEventHub(Step):
         logger.info(f"Using Azure resource group: {resource_group}")
         logger.info(f"Using Azure EventHub namespace: {eventhub_namespace}")
 
-        secrets = [
-            self._create_producer_policy(policy, resource_group, eventhub_namespace, self.application_name)
-            for policy in producer_policies
-        ]
+        secrets = run_concurrently(
+            lambda policy: self._create_producer_policy(
+                policy, resource_group, eventhub_namespace, self.application_name
+            ),
+            producer_policies,
+            self.config["max_parallel_operations"],
+            "configure",
+            "producer policies",
+        )
         Context().create_or_update(ContextKey.EVENTHUB_PRODUCER_POLICY_SECRETS, secrets)
+        return [
+            secret for policy, secret in zip(producer_policies, secrets) if policy.create_databricks_secret
+        ]
 
     def _create_producer_policy(
         self,
@@ -170,8 +209,8 @@ class ConfigureEventHub(Step):
         eventhub_namespace: str,
         application_name: str,
     ) -> Secret:
-        """Creates given producer policy on EventHub. Optionally constructs Databricks secret
-        containing the connection string for the policy.
+        """Creates given producer policy on EventHub and constructs a secret containing the connection
+        string for the policy.
 
         Args:
             policy: Name of the EventHub entity
@@ -198,105 +237,103 @@ class ConfigureEventHub(Step):
             logger.error("Could not create connection String. Make sure the EventHub exists.")
             raise e
 
-        secret = Secret(f"{policy.eventhub_entity_name}-connection-string", connection_string)
-        if policy.create_databricks_secret:
-            self.create_databricks_secrets([secret])
-        return secret
+        return Secret(f"{policy.eventhub_entity_name}-connection-string", connection_string)
 
-    def _eventhub_exists(self, group: EventHubConsumerGroup) -> bool:
-        """Checks if the EventHub entity exists
+    def _validate_eventhubs(self, hubs: Set[EventHub]):
+        """Checks if all EventHub entities exist, listing every namespace only once
 
         Args:
-            group: Object containing names of EventHub namespace and entity
+            hubs: The EventHub entities to check
 
-        Returns:
-            True if the entity exists, otherwise False
+        Raises:
+            ValueError if any of the entities does not exist
         """
-        hubs = list(
-            self.eventhub_client.event_hubs.list_by_namespace(
-                group.eventhub.resource_group, group.eventhub.namespace
-            )
-        )
-        if group.eventhub.name in set(_.name for _ in hubs):
-            return True
-        raise ValueError(
-            f"EventHub with name {group.eventhub.name} does not exist. " f"Please create it first"
-        )
+        namespaces = {(_.resource_group, _.namespace) for _ in hubs}
+        existing = {
+            (resource_group, namespace, hub.name)
+            for resource_group, namespace in namespaces
+            for hub in self.eventhub_client.event_hubs.list_by_namespace(resource_group, namespace)
+        }
+        missing = sorted(_.name for _ in hubs if (_.resource_group, _.namespace, _.name) not in existing)
+        if missing:
+            raise ValueError(f"EventHubs with names {missing} do not exist. Please create them first")
+
+    def _index_eventhubs(self, hubs: Set[EventHub]) -> EventHubIndex:
+        """Lists the consumer groups and authorization rules of all EventHub entities once
 
-    def _group_exists(self, group: EventHubConsumerGroup) -> bool:
-        """Checks if the EventHub consumer group has already been made.
         Args:
-            group: Object containing names of EventHub namespace and entity
+            hubs: The EventHub entities to index
 
         Returns:
-            True if the consumer group exists, otherwise False
+            The index of the existing consumer groups and authorization rules
         """
-        consumer_groups = list(
-            self.eventhub_client.consumer_groups.list_by_event_hub(
-                group.eventhub.resource_group, group.eventhub.namespace, group.eventhub.name
-            )
-        )
 
-        if group.consumer_group in set(_.name for _ in consumer_groups):
-            logging.warning(
-                f"Consumer group with name {group.consumer_group} in hub {group.eventhub.name}"
-                " already exists, not creating."
+        def list_hub(hub: EventHub) -> Tuple[Set[str], Set[str]]:
+            consumer_groups = self.eventhub_client.consumer_groups.list_by_event_hub(
+                hub.resource_group, hub.namespace, hub.name
             )
-            return True
-        return False
-
-    def _authorization_rules_exists(self, hub: EventHub, name: str) -> bool:
-        """Checks if the EventHub contains given authorization rule.
-
-        Args:
-            hub: Object containing information on the EventHub entity
-            name: Name of the authorization rule
-
-        Returns:
-            True if the authorization rule exists, otherwise False
-        """
-        logging.info(
-            f"Retrieving rules, Resource Group {hub.resource_group}, "
-            f"EventHub Namespace {hub.namespace}, "
-            f"EventHub Entity: {hub.name}"
-        )
-        existing_policies = list(
-            self.eventhub_client.event_hubs.list_authorization_rules(
+            rules = self.eventhub_client.event_hubs.list_authorization_rules(
                 hub.resource_group, hub.namespace, hub.name
             )
-        )
-        if name in set(_.name for _ in existing_policies):
-            print(f"Authorization rule with name {name} in hub {hub.name}" " already exists, not creating.")
-            return True
-        return False
+            return {_.name for _ in consumer_groups}, {_.name for _ in rules}
+
+        ordered_hubs = sorted(hubs, key=lambda _: (_.resource_group, _.namespace, _.name))
+        index = EventHubIndex()
+        for hub, (consumer_groups, rules) in zip(
+            ordered_hubs,
+            run_concurrently(
+                list_hub, ordered_hubs, self.config["max_parallel_operations"], "list", "EventHubs"
+            ),
+        ):
+            index.consumer_groups[hub] = consumer_groups
+            index.authorization_rules[hub] = rules
+        return index
 
     def create_databricks_secrets(self, secrets: List[Secret]):
-        """Creates a Databricks secret from the provided secrets
+        """Creates Databricks secrets from the provided secrets, in a single batch
+
+        The Databricks client is created, and the secret scope is created if needed, only once per step.
 
         Args:
             secrets: A list of secrets
-            application_name: The name of this application
         """
-        databricks_secrets = CreateDatabricksSecretFromValue(self.env, self.config)
-        databricks_secrets._create_scope(self.application_name)
-        databricks_secrets._add_secrets(self.application_name, secrets)
+        if not secrets:
+            return
+        if self._databricks_secrets is None:
+            self._databricks_secrets = CreateDatabricksSecretFromValue(self.env, self.config)
+            self._databricks_secrets._create_scope(self.application_name)
+        self._databricks_secrets._add_secrets(
+            self.application_name, secrets, self.config["max_parallel_operations"]
+        )
 
-    def _create_consumer_group(self, group: EventHubConsumerGroup) -> Secret:
-        """Creates given consumer groups on EventHub. Optionally constructs Databricks secret
-        containing the connection string for the consumer group.
+    def _create_consumer_group(
+        self, group: EventHubConsumerGroup, index: Optional[EventHubIndex] = None
+    ) -> Secret:
+        """Creates given consumer groups on EventHub and constructs a secret containing the connection
+        string for the consumer group.
 
         Args:
             group: Object containing names of EventHub namespace and entity
+            index: The existing consumer groups and authorization rules. If not provided, the
+                   EventHub entity of the group is listed.
         """
+        index = index or self._index_eventhubs({group.eventhub})
         try:
-            logger.info(f"Creating consumer group {group}")
-            self.eventhub_client.consumer_groups.create_or_update(
-                group.eventhub.resource_group,
-                group.eventhub.namespace,
-                group.eventhub.name,
-                group.consumer_group,
-            )
-            connection_string = self._create_connection_string(group.eventhub)
+            if group.consumer_group in index.consumer_groups[group.eventhub]:
+                logger.warning(
+                    f"Consumer group with name {group.consumer_group} in hub {group.eventhub.name}"
+                    " already exists, not creating."
+                )
+            else:
+                logger.info(f"Creating consumer group {group}")
+                self.eventhub_client.consumer_groups.create_or_update(
+                    group.eventhub.resource_group,
+                    group.eventhub.namespace,
+                    group.eventhub.name,
+                    group.consumer_group,
+                )
+                index.consumer_groups[group.eventhub].add(group.consumer_group)
+            connection_string = self._create_connection_string(group.eventhub, index)
         except CloudError as e:
             logger.error("Something went wrong during creating consumer group")
             raise e
@@ -307,25 +344,34 @@ class ConfigureEventHub(Step):
 
         secret_name = get_databricks_secret_name(f"{group.eventhub.name}-connection-string{suffix}", self.env)
 
-        secret = Secret(secret_name, connection_string.connection_string)
-
-        if group.create_databricks_secret:
-            self.create_databricks_secrets([secret])
-
-        return secret
+        return Secret(secret_name, connection_string.connection_string)
 
-    def _create_connection_string(self, eventhub_entity: EventHub) -> ConnectingString:
+    def _create_connection_string(
+        self, eventhub_entity: EventHub, index: Optional[EventHubIndex] = None
+    ) -> ConnectingString:
         """Creates connections strings for all given EventHub entities.
 
+        The authorization rule is only created if it does not exist yet, and the connection string is
+        fetched only once per EventHub entity.
+
         Args:
             eventhub_entity: Object containing EventHub metadata
+            index: The existing authorization rules. If not provided, the EventHub entity is listed.
 
         Returns:
             Connection string
         """
+        index = index or self._index_eventhubs({eventhub_entity})
         policy_name = f"{self.application_name}-policy"
+        if (eventhub_entity, policy_name) in index.connection_strings:
+            return index.connection_strings[(eventhub_entity, policy_name)]
 
-        if not self._authorization_rules_exists(eventhub_entity, policy_name):
+        if policy_name in index.authorization_rules[eventhub_entity]:
+            logger.info(
+                f"Authorization rule with name {policy_name} in hub {eventhub_entity.name}"
+                " already exists, not creating."
+            )
+        else:
             self.eventhub_client.event_hubs.create_or_update_authorization_rule(
                 eventhub_entity.resource_group,
                 eventhub_entity.namespace,
@@ -333,12 +379,15 @@ class ConfigureEventHub(Step):
                 policy_name,
                 [AccessRights.listen],
             )
+            index.authorization_rules[eventhub_entity].add(policy_name)
 
         connection_string = self.eventhub_client.event_hubs.list_keys(
             eventhub_entity.resource_group, eventhub_entity.namespace, eventhub_entity.name, policy_name
         ).primary_connection_string
 
-        return ConnectingString(eventhub_entity.name, connection_string)
+        result = ConnectingString(eventhub_entity.name, connection_string)
+        index.connection_strings[(eventhub_entity, policy_name)] = result
+        return result
 
     @staticmethod
     def _get_unique_eventhubs(eventhubs: List[EventHubConsumerGroup]) -> Set[EventHub]:
@@ -358,17 +407,51 @@ class ConfigureEventHub(Step):
         Returns:
             An EventHub Management client
         """
-        credentials = get_azure_credentials_object(self.config, self.vault_name, self.vault_client)
-        return EventHubManagementClient(
-            credentials, SubscriptionId(self.vault_name, self.vault_client).subscription_id(self.config)
+        return ManagementClients().client(
+            EventHubManagementClient, self.config, self.vault_name, self.vault_client
         )
 
-    def create_eventhub_consumer_groups(self, consumer_groups: List[EventHubConsumerGroup]):
+    def create_eventhub_consumer_groups(self, consumer_groups: List[EventHubConsumerGroup]) -> List[Secret]:
         """Creates a new EventHub consumer group if one does not exist.
 
+        All EventHub entities are listed once up front. Only the consumer groups and authorization rules
+        that do not exist yet are created, `max_parallel_operations` at a time.
+
         Args:
             consumer_groups: A list of EventHubConsumerGroup containing the name of the consumer
             group to create.
+
+        Returns:
+            The secrets of the consumer groups that should be propagated to Databricks
         """
-        secrets = [self._create_consumer_group(group=group) for group in consumer_groups]
+        eventhubs = self._get_unique_eventhubs(consumer_groups)
+        self._validate_eventhubs(eventhubs)
+        index = self._index_eventhubs(eventhubs)
+
+        policy_name = f"{self.application_name}-policy"
+        missing_groups = [
+            _ for _ in consumer_groups if _.consumer_group not in index.consumer_groups[_.eventhub]
+        ]
+        missing_rules = [_ for _ in eventhubs if policy_name not in index.authorization_rules[_]]
+        logger.info(
+            f"Creating {len(missing_groups)} of {len(consumer_groups)} consumer groups and "
+            f"{len(missing_rules)} authorization rules in {len(eventhubs)} EventHubs"
+        )
+
+        # connection strings are shared by all groups of a hub, so they are created before the groups
+        run_concurrently(
+            lambda hub: self._create_connection_string(hub, index),
+            sorted(eventhubs, key=lambda _: (_.resource_group, _.namespace, _.name)),
+            self.config["max_parallel_operations"],
+            "configure",
+            "EventHub authorization rules",
+        )
+        secrets = run_concurrently(
+            lambda group: self._create_consumer_group(group=group, index=index),
+            consumer_groups,
+            self.config["max_parallel_operations"],
+            "configure",
+            "consumer groups",
+        )
         Context().create_or_update(ContextKey.EVENTHUB_CONSUMER_GROUP_SECRETS, secrets)
+        return [secret for group, secret in zip(consumer_groups, secrets) if group.create_databricks_secret]
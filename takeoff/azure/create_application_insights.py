@@ -8,8 +8,8 @@ from azure.mgmt.applicationinsights.models import ApplicationInsightsComponent
 from takeoff.application_version import ApplicationVersion
 from takeoff.azure.create_databricks_secrets import CreateDatabricksSecretFromValue
 from takeoff.azure.credentials.keyvault import KeyVaultClient
-from takeoff.azure.credentials.subscription_id import SubscriptionId
-from takeoff.azure.util import get_resource_group_name, get_azure_credentials_object
+from takeoff.azure.management_clients import ManagementClients
+from takeoff.azure.util import get_resource_group_name
 from takeoff.credentials.secret import Secret
 from takeoff.schemas import TAKEOFF_BASE_SCHEMA
 from takeoff.step import Step
@@ -83,11 +83,8 @@ class CreateApplicationInsights(Step):
         Returns:
             An Application Insights management client
         """
-        credentials = get_azure_credentials_object(self.config, self.vault_name, self.vault_client)
-
-        return ApplicationInsightsManagementClient(
-            credentials,
-            SubscriptionId(self.vault_name, self.vault_client).subscription_id(self.config),
+        return ManagementClients().client(
+            ApplicationInsightsManagementClient, self.config, self.vault_name, self.vault_client
         )
 
     def _find_existing_instance(
@@ -1,7 +1,12 @@
 import abc
+import hashlib
+import hmac
+import json
 import logging
+import os
+from dataclasses import dataclass
 from pprint import pprint
-from typing import List
+from typing import Any, Dict, List
 
 import voluptuous as vol
 from databricks_cli.secrets.api import SecretApi
@@ -16,11 +21,86 @@ from takeoff.credentials.DeploymentYamlEnvironmentVariablesMixin import (
 from takeoff.credentials.secret import Secret
 from takeoff.schemas import TAKEOFF_BASE_SCHEMA
 from takeoff.step import Step, SubStep
+from takeoff.util import run_concurrently, write_json_atomically
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
+@dataclass(frozen=True)
+class SecretsDiff:
+    """Keys of the secrets in a Databricks secret scope, grouped by what a sync did with them"""
+
+    added: List[str]
+    changed: List[str]
+    unchanged: List[str]
+    removed: List[str]
+
+    def summary(self) -> str:
+        return (
+            f"{len(self.added)} added, {len(self.changed)} changed, "
+            f"{len(self.unchanged)} unchanged, {len(self.removed)} removed"
+        )
+
+
+class SecretsState(object):
+    """Fingerprints of the secrets written to Databricks, stored in a local json file.
+
+    Databricks never returns secret values, so these fingerprints are the only way to tell whether a
+    secret changed since the last deploy. A fingerprint is an HMAC of the key and value, keyed with a random
+    salt. The salt is stored in the same file, so anyone who can read the file can check guesses of a secret
+    value against its fingerprint. The file must be kept as private as the secrets themselves.
+
+    The file must be persisted in between runs, e.g. with a CI cache. Without it, every run writes all
+    secrets again. The file is only readable by its owner.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.__state: Dict[str, Any] = {"salt": os.urandom(16).hex(), "scopes": {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.__state = json.load(f)
+        else:
+            logger.warning(
+                f"Secrets state file {path} does not exist, all secrets are written. "
+                "Persist it in between runs, e.g. with a CI cache, to only write changed secrets"
+            )
+
+    def fingerprint(self, secret: Secret) -> str:
+        """Computes the fingerprint of a secret
+
+        Args:
+            secret: The secret to fingerprint
+
+        Returns:
+            The hex digest of the HMAC of the key and value of the secret
+        """
+        message = f"{secret.key}\0{secret.val}".encode()
+        return hmac.new(bytes.fromhex(self.__state["salt"]), message, hashlib.sha256).hexdigest()
+
+    def fingerprints(self, scope_id: str) -> Dict[str, str]:
+        """Returns the fingerprints of the secrets last written to a scope
+
+        Args:
+            scope_id: Identifies the scope, e.g. the environment and the scope name
+
+        Returns:
+            The fingerprints by secret key, empty if the scope was never synced
+        """
+        return dict(self.__state["scopes"].get(scope_id, {}))
+
+    def update(self, scope_id: str, fingerprints: Dict[str, str]):
+        """Replaces the fingerprints of a scope and writes the state file
+
+        Args:
+            scope_id: Identifies the scope, e.g. the environment and the scope name
+            fingerprints: The fingerprints by secret key
+        """
+        self.__state["scopes"][scope_id] = fingerprints
+        write_json_atomically(self.path, self.__state, mode=0o600)
+
+
 class CreateDatabricksSecretsMixin(object):
     def __init__(self):
         raise BaseException("Should not instantiate this class")
@@ -51,20 +131,131 @@ class CreateDatabricksSecretsMixin(object):
         if not self._scope_exists(scopes, scope_name):
             self.get_secret_api().create_scope(scope_name, None)
 
-    def _add_secrets(self, scope_name: str, secrets: List[Secret]):
+    def _add_secrets(self, scope_name: str, secrets: List[Secret], max_workers: int = 1):
         """Add Databricks secrets to the provided scope
 
+        Secrets with the same key are written only once, the last value wins.
+
         Args:
             scope_name: The name of the scope to create secrets in
             secrets: List of secrets
+            max_workers: The maximum number of secrets to write concurrently
         """
-        for secret in secrets:
+        unique_secrets = list({_.key: _ for _ in secrets}.values())
+
+        def put_secret(secret: Secret):
             logger.info(f"Set secret {scope_name}: {secret.key}")
             self.get_secret_api().put_secret(scope_name, secret.key, secret.val, None)
 
+        run_concurrently(
+            put_secret, unique_secrets, max_workers, "write", f"secrets to {scope_name}", lambda _: _.key
+        )
+
+    def _delete_secrets(self, scope_name: str, keys: List[str], max_workers: int = 1):
+        """Delete Databricks secrets from the provided scope
+
+        Args:
+            scope_name: The name of the scope to delete secrets from
+            keys: The keys of the secrets to delete
+            max_workers: The maximum number of secrets to delete concurrently
+        """
+
+        def delete_secret(key: str):
+            logger.info(f"Delete secret {scope_name}: {key}")
+            self.get_secret_api().delete_secret(scope_name, key)
+
+        run_concurrently(delete_secret, keys, max_workers, "delete", f"secrets from {scope_name}")
+
+    def _sync_secrets(
+        self,
+        scope_name: str,
+        secrets: List[Secret],
+        state: SecretsState,
+        scope_id: str,
+        delete_removed: bool = False,
+        max_workers: int = 1,
+    ) -> SecretsDiff:
+        """Writes only the secrets that are new or changed since the last sync to the provided scope
+
+        A secret is unchanged if it exists in the scope and its fingerprint matches the one in the state.
+        Secrets that were written by a previous sync but are no longer provided are removed. These are
+        only deleted from the scope if `delete_removed` is set, secrets written by anything else are
+        never touched.
+
+        Args:
+            scope_name: The name of the scope to sync the secrets to
+            secrets: List of secrets, the last value wins for duplicate keys
+            state: The fingerprints of the secrets written by previous syncs
+            scope_id: Identifies the scope in the state
+            delete_removed: Whether to delete removed secrets from the scope
+            max_workers: The maximum number of secrets to write or delete concurrently
+
+        Returns:
+            The keys of the secrets by what was done with them
+        """
+        unique_secrets = {_.key: _ for _ in secrets}
+        existing = {_["key"] for _ in self.get_secret_api().list_secrets(scope_name).get("secrets", [])}
+        previous = state.fingerprints(scope_id)
+        fingerprints = {key: state.fingerprint(secret) for key, secret in unique_secrets.items()}
+
+        diff = SecretsDiff(
+            added=sorted(key for key in unique_secrets if key not in existing),
+            changed=sorted(
+                key for key in unique_secrets if key in existing and previous.get(key) != fingerprints[key]
+            ),
+            unchanged=sorted(
+                key for key in unique_secrets if key in existing and previous.get(key) == fingerprints[key]
+            ),
+            removed=sorted(key for key in previous if key not in unique_secrets and key in existing),
+        )
+
+        self._add_secrets(scope_name, [unique_secrets[_] for _ in diff.added + diff.changed], max_workers)
+        if delete_removed:
+            self._delete_secrets(scope_name, diff.removed, max_workers)
+        else:
+            if diff.removed:
+                logger.warning(f"Not deleting secrets that were removed: {', '.join(diff.removed)}")
+            # keep tracking them, so a later sync can still delete them
+            fingerprints.update({key: previous[key] for key in diff.removed})
+
+        state.update(scope_id, fingerprints)
+        return diff
+
 
 SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
-    {vol.Required("task"): "create_databricks_secrets_from_vault"}, extra=vol.ALLOW_EXTRA
+    {
+        vol.Required("task"): "create_databricks_secrets_from_vault",
+        vol.Optional(
+            "sync",
+            default=None,
+            description=(
+                "Only write secrets that were added or changed since the last deploy, "
+                "by comparing fingerprints stored in a local state file"
+            ),
+        ): vol.Any(
+            None,
+            {
+                vol.Required(
+                    "state_file",
+                    description=(
+                        "The file containing the fingerprints of the written secrets. It must be persisted "
+                        "in between runs, e.g. with a CI cache, and kept out of the repository"
+                    ),
+                ): str,
+                vol.Optional(
+                    "delete_removed",
+                    default=False,
+                    description="Delete secrets written by a previous deploy that no longer exist",
+                ): bool,
+            },
+        ),
+        vol.Optional(
+            "max_parallel_operations",
+            default=4,
+            description="The number of secrets that are written concurrently",
+        ): vol.All(int, vol.Range(min=1)),
+    },
+    extra=vol.ALLOW_EXTRA,
 )
 
 
@@ -98,15 +289,26 @@ class CreateDatabricksSecretsFromVault(Step, CreateDatabricksSecretsMixin):
         secrets = self._combine_secrets()
 
         self._create_scope(self.application_name)
-        self._add_secrets(self.application_name, secrets)
+        if self.config["sync"]:
+            diff = self._sync_secrets(
+                self.application_name,
+                secrets,
+                SecretsState(self.config["sync"]["state_file"]),
+                f"{self.env.environment}/{self.application_name}",
+                self.config["sync"]["delete_removed"],
+                self.config["max_parallel_operations"],
+            )
+            logging.info(f'------  {diff.summary()} secrets in "{self.env.environment}"')
+        else:
+            self._add_secrets(self.application_name, secrets, self.config["max_parallel_operations"])
+            logging.info(f'------  {len(secrets)} secrets created in "{self.env.environment}"')
 
-        logging.info(f'------  {len(secrets)} secrets created in "{self.env.environment}"')
         pprint(self.secret_api.list_secrets(self.application_name))
 
     def _combine_secrets(self):
-        vault_secrets = KeyVaultCredentialsMixin(self.vault_name, self.vault_client).get_keyvault_secrets(
-            self.application_name
-        )
+        vault_secrets = KeyVaultCredentialsMixin(
+            self.vault_name, self.vault_client, max_workers=self.config["azure"]["keyvault_max_workers"]
+        ).get_keyvault_secrets(self.application_name)
         deployment_secrets = DeploymentYamlEnvironmentVariablesMixin(
             self.env, self.config
         ).get_deployment_secrets()
@@ -4,9 +4,8 @@ import voluptuous as vol
 from azure.mgmt.cosmosdb import CosmosDB
 
 from takeoff.application_version import ApplicationVersion
-from takeoff.azure.credentials.active_directory_user import ActiveDirectoryUserCredentials
 from takeoff.azure.credentials.keyvault import KeyVaultClient
-from takeoff.azure.credentials.subscription_id import SubscriptionId
+from takeoff.azure.management_clients import ManagementClients
 from takeoff.azure.util import get_resource_group_name, get_cosmos_name
 from takeoff.schemas import TAKEOFF_BASE_SCHEMA
 
@@ -47,10 +46,9 @@ class Cosmos(object):
 
     def _get_cosmos_management_client(self) -> CosmosDB:
         vault, client = KeyVaultClient.vault_and_client(self.config, self.env)
-        credentials = ActiveDirectoryUserCredentials(vault_name=vault, vault_client=client).credentials(
-            self.config
-        )
-        return CosmosDB(credentials, SubscriptionId(vault, client).subscription_id(self.config))
+        # Cosmos always authenticates as AAD user
+        config = {**self.config, "credentials_type": "active_directory_user"}
+        return ManagementClients().client(CosmosDB, config, vault, client)
 
     def _get_cosmos_instance(self) -> dict:
         return {
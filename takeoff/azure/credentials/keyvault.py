@@ -1,16 +1,55 @@
+import logging
+import threading
+from typing import Dict, Optional, Tuple
+
 from azure.keyvault import KeyVaultClient as AzureKeyVaultClient
 
 from takeoff.application_version import ApplicationVersion
 from takeoff.azure.credentials.service_principal import ServicePrincipalCredentials
 from takeoff.azure.util import get_keyvault_name
 
+logger = logging.getLogger(__name__)
+
+# Process wide pool of KeyVault clients, indexed on (vault, tenant, client id). See `KeyVaultClient`
+_keyvault_clients: Dict[Tuple[str, Optional[str], Optional[str]], AzureKeyVaultClient] = {}
+_keyvault_clients_lock = threading.Lock()
+
 
 class KeyVaultClient(object):
     @staticmethod
     def vault_and_client(config: dict, env: ApplicationVersion):
+        """Returns the name of the vault and a client for it
+
+        Clients are pooled per vault and service principal. Creating a client acquires an AAD token,
+        a pooled client reuses its token, which is only refreshed when it nears expiry, and its HTTP
+        session.
+
+        Args:
+            config: The Takeoff configuration
+            env: The environment to deploy to
+
+        Returns:
+            The name of the vault and a KeyVault client
+        """
         vault = get_keyvault_name(config, env)
-        keyvault_client = AzureKeyVaultClient(
-            credentials=ServicePrincipalCredentials().credentials(config, env.environment_formatted)
-        )
+        sp = ServicePrincipalCredentials()
+        credential_kwargs = sp.credential_kwargs(config, env.environment_formatted)
+        key = (vault, credential_kwargs.get("tenant"), credential_kwargs.get("client_id"))
 
-        return vault, keyvault_client
+        with _keyvault_clients_lock:
+            if key not in _keyvault_clients:
+                logger.info(f"Creating KeyVault client for vault {vault}")
+                keyvault_client = AzureKeyVaultClient(
+                    credentials=sp.credentials(config, env.environment_formatted)
+                )
+                # entering the client keeps its HTTP session open in between requests
+                _keyvault_clients[key] = keyvault_client.__enter__()
+            return vault, _keyvault_clients[key]
+
+    @staticmethod
+    def clear():
+        """Closes and drops all pooled clients"""
+        with _keyvault_clients_lock:
+            for keyvault_client in _keyvault_clients.values():
+                keyvault_client.__exit__(None, None, None)
+            _keyvault_clients.clear()
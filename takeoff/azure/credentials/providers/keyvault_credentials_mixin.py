@@ -1,12 +1,21 @@
+import logging
 import re
+import time
 from dataclasses import dataclass
 from typing import List, Dict, Optional
 
 from azure.keyvault import KeyVaultClient as AzureKeyVaultClient
-from azure.keyvault.models import SecretBundle
+from azure.keyvault.models import SecretBundle, KeyVaultErrorException
+from msrest.exceptions import ClientRequestError
 
+from takeoff.azure.credentials.providers.keyvault_secret_cache import KeyVaultSecretCache
 from takeoff.credentials.secret import Secret
-from takeoff.util import get_matching_group, has_prefix_match, inverse_dictionary
+from takeoff.util import get_matching_group, has_prefix_match, inverse_dictionary, run_concurrently
+
+logger = logging.getLogger(__name__)
+
+# HTTP status codes returned by Azure KeyVault that are worth retrying
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
 
 
 @dataclass(frozen=True)
@@ -23,9 +32,27 @@ class KeyVaultSecrets:
 class KeyVaultCredentialsMixin(object):
     """Collection of Azure KeyVault helper functions"""
 
-    def __init__(self, vault_name: str, vault_client: AzureKeyVaultClient):
+    def __init__(
+        self,
+        vault_name: str,
+        vault_client: AzureKeyVaultClient,
+        max_workers: int = 1,
+        retries: int = 3,
+        backoff: float = 0.5,
+    ):
+        """
+        Args:
+            vault_name: The url of the vault
+            vault_client: An Azure KeyVault client
+            max_workers: The number of secrets to fetch concurrently. Defaults to fetching serially.
+            retries: The number of times a transient failure of a single secret fetch is retried
+            backoff: The initial number of seconds to wait between retries, doubled on every attempt
+        """
         self.vault_name = vault_name
         self.vault_client = vault_client
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
 
     def _transform_key_to_credential_kwargs(self, keys: Dict[str, str]):
         """
@@ -67,23 +94,31 @@ class KeyVaultCredentialsMixin(object):
         }
         return credential_kwargs
 
-    def _credentials(self, keys: List[str], prefix: str = None) -> Dict[str, str]:
-        """
+    def _credentials(self, keys: List[str]) -> Dict[str, str]:
+        """Looks up the requested keys directly, without listing the vault.
+
+        Listing the entire vault is reserved for `get_keyvault_secrets`.
+
         Args:
             keys (List[str]): A list containing the keys to search for in the keyvault
-            prefix (str, optional): A prefix to filter keyvault keys on
 
         Returns:
-            Dict[str: Secret]: A dictionary of all secrets matching the keys and prefix, indexed on the key
-        """
-        secrets = self.get_keyvault_secrets(prefix)
-        indexed = {_.key: _ for _ in secrets}
-        return {_: self._find_secret(_, indexed) for _ in keys}
+            Dict[str: str]: A dictionary of the values of all requested keys, indexed on the key
 
-    def _find_secret(self, secret_key, secrets: Dict[str, Secret]) -> str:
-        if secret_key not in secrets:
-            raise ValueError(f"Could not find required key {secret_key}")
-        return secrets[secret_key].val
+        Raises:
+            ValueError if any of the keys does not exist in the vault
+        """
+        return {_: self._find_secret(_) for _ in keys}
+
+    def _find_secret(self, secret_key: str) -> str:
+        try:
+            return self._get_secret_value(self.vault_client, self.vault_name, secret_key)
+        except KeyVaultErrorException as e:
+            if e.response is not None and e.response.status_code == 404:
+                raise ValueError(
+                    f"Could not find required key {secret_key} in vault {self.vault_name}"
+                ) from e
+            raise e
 
     def get_keyvault_secrets(self, prefix: Optional[str] = "") -> List[Secret]:
         """
@@ -128,13 +163,78 @@ class KeyVaultCredentialsMixin(object):
     def _retrieve_secrets(
         self, client: AzureKeyVaultClient, vault: str, prefix: Optional[str]
     ) -> List[Secret]:
-        secrets = list(client.get_secrets(vault))
-        secrets_ids = self._extract_keyvault_ids_from(secrets)
+        secrets_ids = self._list_keyvault_ids(client, vault)
         secrets_filtered = self._filter_keyvault_ids(secrets_ids, prefix)
 
-        app_secrets = [
-            Secret(_.databricks_secret_key, client.get_secret(vault, _.keyvault_id, "").value)
-            for _ in secrets_filtered
-        ]
+        values = self._get_secret_values(client, vault, [_.keyvault_id for _ in secrets_filtered])
+
+        app_secrets = [Secret(_.databricks_secret_key, value) for _, value in zip(secrets_filtered, values)]
 
         return app_secrets
+
+    def _list_keyvault_ids(self, client: AzureKeyVaultClient, vault: str) -> List[str]:
+        """Lists the ids of all secrets in the vault, at most once per vault per run"""
+        return KeyVaultSecretCache().secret_ids(
+            vault, lambda: self._extract_keyvault_ids_from(list(client.get_secrets(vault)))
+        )
+
+    def _get_secret_values(
+        self, client: AzureKeyVaultClient, vault: str, keyvault_ids: List[str]
+    ) -> List[str]:
+        """Fetches the values for the given keyvault ids, using at most `max_workers` concurrent requests.
+
+        Args:
+            client: An Azure KeyVault client
+            vault: The url of the vault
+            keyvault_ids: The ids of the secrets to fetch
+
+        Returns:
+            List[str]: The secret values, in the same order as `keyvault_ids`
+
+        Raises:
+            RuntimeError listing every secret that could not be fetched
+        """
+        return run_concurrently(
+            lambda _: self._get_secret_value(client, vault, _),
+            keyvault_ids,
+            self.max_workers,
+            "fetch",
+            "secrets",
+        )
+
+    def _get_secret_value(self, client: AzureKeyVaultClient, vault: str, keyvault_id: str) -> str:
+        """Fetches a single secret value, at most once per vault per run"""
+        return KeyVaultSecretCache().secret_value(
+            vault, keyvault_id, lambda: self._fetch_secret_value(client, vault, keyvault_id)
+        )
+
+    def _fetch_secret_value(self, client: AzureKeyVaultClient, vault: str, keyvault_id: str) -> str:
+        """Fetches a single secret value, retrying transient failures with exponential backoff.
+
+        Args:
+            client: An Azure KeyVault client
+            vault: The url of the vault
+            keyvault_id: The id of the secret to fetch
+
+        Returns:
+            str: The latest version of the secret value
+        """
+        attempt = 0
+        while True:
+            try:
+                return client.get_secret(vault, keyvault_id, "").value
+            except (KeyVaultErrorException, ClientRequestError) as e:
+                if attempt >= self.retries or not self._is_transient(e):
+                    raise e
+                delay = self.backoff * 2**attempt
+                logger.warning(f"Fetching secret {keyvault_id} failed, retrying in {delay} seconds: {e}")
+                time.sleep(delay)
+                attempt += 1
+
+    @staticmethod
+    def _is_transient(error: Exception) -> bool:
+        """Connection errors and throttling or server side errors are considered transient"""
+        if isinstance(error, KeyVaultErrorException):
+            response = error.response
+            return response is not None and response.status_code in TRANSIENT_STATUS_CODES
+        return True
@@ -0,0 +1,63 @@
+import logging
+from typing import Callable, List, Optional, Tuple
+
+from takeoff.context import Singleton
+from takeoff.util import KeyedCache
+
+logger = logging.getLogger(__name__)
+
+
+class KeyVaultSecretCache(metaclass=Singleton):
+    """Run scoped, in-memory cache of Azure KeyVault secrets.
+
+    The cache is shared by all `KeyVaultCredentialsMixin` instances, which means every secret is
+    requested at most once per vault during a deployment. Both the listing of the vault and the
+    individual secret values are loaded lazily, on first use. Nothing is ever written to disk.
+    """
+
+    def __init__(self):
+        self.__ids: KeyedCache[Optional[str], List[str]] = KeyedCache()
+        self.__values: KeyedCache[Tuple[Optional[str], str], str] = KeyedCache()
+
+    def secret_ids(self, vault: Optional[str], load: Callable[[], List[str]]) -> List[str]:
+        """Returns the ids of all secrets in the vault, listing the vault only on first use
+
+        Args:
+            vault: The url of the vault
+            load: Lists all secret ids in the vault
+
+        Returns:
+            The ids of all secrets in the vault
+        """
+        return self.__ids.get_or_create(vault, load)
+
+    def secret_value(self, vault: Optional[str], keyvault_id: str, load: Callable[[], str]) -> str:
+        """Returns the value of a single secret, fetching it from the vault only on first use
+
+        Args:
+            vault: The url of the vault
+            keyvault_id: The id of the secret
+            load: Fetches the secret value from the vault
+
+        Returns:
+            The secret value
+        """
+        return self.__values.get_or_create((vault, keyvault_id), load)
+
+    def invalidate(self, vault: Optional[str] = None) -> "KeyVaultSecretCache":
+        """Drops cached secrets, so they will be fetched from the vault again on next use
+
+        Args:
+            vault: The url of the vault to invalidate. If not provided all vaults are invalidated.
+
+        Returns:
+            The invalidated KeyVaultSecretCache
+        """
+        if vault is None:
+            self.__ids.clear()
+            self.__values.clear()
+        else:
+            self.__ids.clear(lambda _: _ == vault)
+            self.__values.clear(lambda _: _[0] == vault)
+        logger.info(f"Invalidated KeyVault secret cache for {vault or 'all vaults'}")
+        return self
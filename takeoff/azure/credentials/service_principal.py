@@ -1,3 +1,5 @@
+from typing import Dict
+
 from msrestazure.azure_active_directory import ServicePrincipalCredentials as SpCredentials
 
 from takeoff.azure.credentials.providers.keyvault_credentials_mixin import KeyVaultCredentialsMixin
@@ -6,11 +8,13 @@ from takeoff.util import current_filename
 
 
 class ServicePrincipalCredentials(EnvironmentCredentialsMixin):
-    def credentials(self, config: dict, env: str) -> SpCredentials:
-        credential_kwargs = super()._transform_environment_key_to_credential_kwargs(
+    def credential_kwargs(self, config: dict, env: str) -> Dict[str, str]:
+        return super()._transform_environment_key_to_credential_kwargs(
             config[f"ci_environment_keys_{env}"][current_filename(__file__)]
         )
-        return SpCredentials(**credential_kwargs)
+
+    def credentials(self, config: dict, env: str) -> SpCredentials:
+        return SpCredentials(**self.credential_kwargs(config, env))
 
 
 class ServicePrincipalCredentialsFromVault(KeyVaultCredentialsMixin):
@@ -6,6 +6,5 @@ class SubscriptionId(KeyVaultCredentialsMixin):
     """Connects to the vault and grabs the Subscription ID."""
 
     def subscription_id(self, config: dict) -> str:
-        return super()._credentials([config["azure"]["keyvault_keys"][current_filename(__file__)]])[
-            "subscription-id"
-        ]
+        key = config["azure"]["keyvault_keys"][current_filename(__file__)]
+        return super()._credentials([key])[key]
@@ -0,0 +1,94 @@
+import logging
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+import requests
+from databricks_cli.runs.api import RunsApi
+
+logger = logging.getLogger(__name__)
+
+# life cycle states of a run that has not started yet
+PENDING_RUN_STATES = {"PENDING", "QUEUED", "BLOCKED", "WAITING_FOR_RETRY"}
+
+
+@dataclass
+class RunStatus(object):
+    """The last known state of a Databricks run"""
+
+    name: str
+    run_id: int
+    started: float
+    life_cycle_state: str = "PENDING"
+    result_state: Optional[str] = None
+    state_message: str = ""
+    seconds_to_running: Optional[float] = None
+
+    @property
+    def done(self) -> bool:
+        """Whether the run reached RUNNING or a terminal state"""
+        return self.life_cycle_state not in PENDING_RUN_STATES
+
+    @property
+    def running(self) -> bool:
+        return self.life_cycle_state == "RUNNING"
+
+
+class RunPoller(object):
+    """Polls the states of many Databricks runs from a single thread, until all of them started or ended.
+
+    All runs are polled in one loop. The interval in between polls doubles while no run changes state,
+    up to `max_interval`, and drops back to `initial_interval` as soon as one does.
+    """
+
+    def __init__(self, runs_api: RunsApi, initial_interval: float = 1, max_interval: float = 30):
+        self.runs_api = runs_api
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+
+    def wait(self, runs: List[RunStatus], timeout: float) -> List[RunStatus]:
+        """Polls the runs until all of them are done or the timeout passed
+
+        Args:
+            runs: The runs to poll, updated in place
+            timeout: Seconds to wait for all runs together
+
+        Returns:
+            The runs
+        """
+        deadline = time.monotonic() + timeout
+        interval = self.initial_interval
+        pending = [_ for _ in runs if not _.done]
+        while pending:
+            changed = [run for run in pending if self.poll(run)]
+            pending = [_ for _ in pending if not _.done]
+            if not pending or time.monotonic() >= deadline:
+                break
+            interval = self.initial_interval if changed else min(interval * 2, self.max_interval)
+            time.sleep(min(interval, max(deadline - time.monotonic(), 0)))
+        return runs
+
+    def poll(self, run: RunStatus) -> bool:
+        """Fetches the state of a run
+
+        A failed request leaves the run as it was, so it is polled again until the deadline.
+
+        Args:
+            run: The run to update
+
+        Returns:
+            Whether the life cycle state of the run changed
+        """
+        try:
+            state = self.runs_api.get_run(run.run_id)["state"]
+        except requests.RequestException as e:
+            logger.warning(f"Could not get the state of run {run.run_id} of {run.name}: {e}")
+            return False
+        previous = run.life_cycle_state
+        run.life_cycle_state = state["life_cycle_state"]
+        run.result_state = state.get("result_state")
+        run.state_message = state.get("state_message", "")
+        if run.running and run.seconds_to_running is None:
+            run.seconds_to_running = time.monotonic() - run.started
+            logger.info(f"Run {run.run_id} of {run.name} reached RUNNING in {run.seconds_to_running:.1f}s")
+        return run.life_cycle_state != previous
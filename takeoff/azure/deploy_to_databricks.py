@@ -1,8 +1,12 @@
+import bisect
 import json
 import logging
 import pprint
-from dataclasses import dataclass
-from typing import List, Optional, Dict
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Dict, Tuple
 
 import voluptuous as vol
 from databricks_cli.jobs.api import JobsApi
@@ -12,12 +16,17 @@ from takeoff import util
 from takeoff.application_version import ApplicationVersion
 from takeoff.azure.credentials.databricks import Databricks
 from takeoff.azure.credentials.keyvault import KeyVaultClient
+from takeoff.azure.databricks_runs import RunPoller, RunStatus
 from takeoff.schemas import TAKEOFF_BASE_SCHEMA
 from takeoff.step import Step
-from takeoff.util import get_whl_name, get_main_py_name
+from takeoff.util import get_whl_name, get_main_py_name, run_concurrently
 
 logger = logging.getLogger(__name__)
 
+# the maximum page size of the jobs/list endpoint
+JOBS_PAGE_SIZE = 25
+RUNS_PAGE_SIZE = 25
+
 SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
     {
         vol.Required("task"): "deploy_to_databricks",
@@ -47,6 +56,59 @@ SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
             ],
             vol.Length(min=1),
         ),
+        vol.Optional(
+            "job_name_match",
+            default="prefix",
+            description="How the names of existing jobs are matched to find the jobs to replace",
+        ): vol.All(str, vol.In(["exact", "prefix"])),
+        vol.Optional(
+            "max_parallel_operations",
+            default=4,
+            description="The number of active runs that are cancelled concurrently",
+        ): vol.All(int, vol.Range(min=1)),
+        vol.Optional(
+            "max_parallel_jobs", default=1, description="The number of jobs that are deployed concurrently"
+        ): vol.All(int, vol.Range(min=1)),
+        vol.Optional(
+            "swap_streaming_jobs",
+            default=None,
+            description=(
+                "Start new streaming jobs before the old ones are removed, the old job is only removed "
+                "once the run of the new job is healthy"
+            ),
+        ): vol.Any(
+            None,
+            {
+                vol.Optional(
+                    "start_timeout",
+                    default=1200,
+                    description="Seconds to wait for the run of the new job to reach RUNNING",
+                ): vol.All(int, vol.Range(min=0)),
+                vol.Optional(
+                    "health_wait",
+                    default=60,
+                    description="Seconds the new run must keep RUNNING before the old job is removed",
+                ): vol.All(int, vol.Range(min=0)),
+                vol.Optional(
+                    "poll_interval", default=10, description="Seconds in between checks of the run state"
+                ): vol.All(int, vol.Range(min=1)),
+            },
+        ),
+        vol.Optional(
+            "wait_for_runs",
+            default=None,
+            description="Wait until the runs of all started jobs reached RUNNING, fail if one did not",
+        ): vol.Any(
+            None,
+            {
+                vol.Optional(
+                    "timeout", default=1800, description="Seconds to wait for all runs together"
+                ): vol.All(int, vol.Range(min=0)),
+                vol.Optional(
+                    "max_poll_interval", default=30, description="The maximum seconds in between polls"
+                ): vol.All(int, vol.Range(min=1)),
+            },
+        ),
         "common": {vol.Optional("databricks_fs_libraries_mount_path"): str},
     },
     extra=vol.ALLOW_EXTRA,
@@ -59,6 +121,74 @@ class JobConfig(object):
     job_id: int
 
 
+@dataclass
+class JobDeployment(object):
+    """The deployment of a single job, used to report its status"""
+
+    name: str
+    config: dict
+    is_streaming: bool
+    run_immediately: bool
+    swap: bool = False
+    old_job_ids: List[int] = field(default_factory=list)
+    status: str = "pending"
+    job_id: Optional[int] = None
+    run_id: Optional[int] = None
+    run_started: Optional[float] = None
+    seconds_to_running: Optional[float] = None
+    seconds: float = 0.0
+    error: Optional[BaseException] = None
+
+
+class JobIndex(object):
+    """Index of Databricks jobs by name, supporting exact and prefix lookups. Safe to share between threads"""
+
+    def __init__(self, jobs: List[JobConfig]):
+        self.__lock = threading.Lock()
+        self.__job_ids: Dict[str, List[int]] = defaultdict(list)
+        for job in jobs:
+            self.__job_ids[job.name].append(job.job_id)
+        self.__names = sorted(self.__job_ids)
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return sum(len(_) for _ in self.__job_ids.values())
+
+    def exact(self, name: str) -> List[int]:
+        with self.__lock:
+            return list(self.__job_ids.get(name, []))
+
+    def prefix(self, prefix: str) -> List[int]:
+        with self.__lock:
+            start = bisect.bisect_left(self.__names, prefix)
+            job_ids = []
+            for name in self.__names[start:]:
+                if not name.startswith(prefix):
+                    break
+                job_ids.extend(self.__job_ids[name])
+            return job_ids
+
+    def take(self, job_ids: List[int]) -> List[int]:
+        """Drops jobs from the index
+
+        Args:
+            job_ids: The ids of the jobs to drop
+
+        Returns:
+            The ids of the jobs that were still in the index, so concurrent callers never get the same job
+        """
+        with self.__lock:
+            taken = []
+            for name, ids in list(self.__job_ids.items()):
+                for job_id in [_ for _ in ids if _ in job_ids]:
+                    ids.remove(job_id)
+                    taken.append(job_id)
+                if not ids:
+                    del self.__job_ids[name]
+                    self.__names.remove(name)
+            return [_ for _ in job_ids if _ in taken]
+
+
 class DeployToDatabricks(Step):
     def __init__(self, env: ApplicationVersion, config: dict):
         super().__init__(env, config)
@@ -88,19 +218,145 @@ class DeployToDatabricks(Step):
         will be set as databricks secrets eventually
         If the job is a streaming job this will directly start the new job_run given the new
         configuration. If the job is batch this will not start it manually.
+
+        Up to `max_parallel_jobs` jobs are removed or deployed concurrently. All old jobs are removed
+        before any new job is deployed, so no new job starts while runs of an old job are still active.
+        A job whose old job could not be removed is not deployed. Jobs deployed one at a time stop at the
+        first failure, the jobs that were not handled yet are skipped.
+
+        With `swap_streaming_jobs`, streaming jobs that run immediately are swapped instead: the new job
+        is started first and the old job is only removed once the new run is healthy, see `_swap_job`.
         """
+        index = self._job_index()
+        deployments = []
         for job in self.config["jobs"]:
             app_name = self._construct_name(job["name"])
             job_config = self.create_config(app_name, job)
             is_streaming = self._job_is_unscheduled(job_config) and not job["is_batch"]
-            run_stream_job_immediately = job["run_stream_job_immediately"]
+            deployment = JobDeployment(app_name, job_config, is_streaming, job["run_stream_job_immediately"])
+            if self.config["swap_streaming_jobs"] and is_streaming and deployment.run_immediately:
+                # claimed up front, so removing the other old jobs leaves these running
+                deployment.swap = True
+                deployment.old_job_ids = index.take(self._application_job_id(app_name, index))
+            deployments.append(deployment)
+
+        def remove(deployment: JobDeployment):
+            logger.info(f"Removing old job {deployment.name}")
+            self.remove_job(deployment.name, is_streaming=deployment.is_streaming, index=index)
+            deployment.status = "removed"
+
+        def deploy(deployment: JobDeployment):
+            logger.info(f"Submitting new job {deployment.name} with configuration:")
+            logger.info(pprint.pformat(deployment.config))
+            if deployment.swap:
+                self._swap_job(deployment)
+                return
+            deployment.job_id, deployment.run_id = self.deploy_job(
+                deployment.config, deployment.is_streaming, deployment.run_immediately
+            )
+            deployment.run_started = time.monotonic()
+            deployment.status = "started" if deployment.run_id is not None else "created"
+
+        if self._for_each_deployment(remove, [_ for _ in deployments if not _.swap]):
+            self._for_each_deployment(deploy, [_ for _ in deployments if not _.error])
+        for deployment in deployments:
+            if deployment.status == "pending":
+                deployment.status = "skipped"
+        if self.config["wait_for_runs"]:
+            self._wait_for_runs([_ for _ in deployments if _.run_id is not None and not _.error])
+        self._report_deployments(deployments)
+
+    def _for_each_deployment(
+        self, fn: Callable[[JobDeployment], None], deployments: List[JobDeployment]
+    ) -> bool:
+        """Applies `fn` to the deployments, up to `max_parallel_jobs` at a time
+
+        Failures are recorded on the deployments, and reported once all jobs are handled.
+
+        Returns:
+            Whether every deployment was handled, False if a failure stopped the others from starting
+        """
+        started: List[str] = []
+
+        def timed(deployment: JobDeployment):
+            started.append(deployment.name)
+            start = time.monotonic()
+            try:
+                fn(deployment)
+            except Exception as e:
+                if deployment.status != "rolled back":
+                    deployment.status = "failed"
+                deployment.error = e
+                raise
+            finally:
+                deployment.seconds += time.monotonic() - start
+
+        try:
+            run_concurrently(
+                timed, deployments, self.config["max_parallel_jobs"], "deploy", "jobs", lambda _: _.name
+            )
+        except Exception:
+            return len(started) == len(deployments)
+        return True
 
-            logger.info("Removing old job")
-            self.remove_job(app_name, is_streaming=is_streaming)
+    def _wait_for_runs(self, deployments: List[JobDeployment]):
+        """Polls the runs of the deployed jobs until all of them reached RUNNING or a terminal state
 
-            logger.info("Submitting new job with configuration:")
-            logger.info(pprint.pformat(job_config))
-            self.deploy_job(job_config, is_streaming, run_stream_job_immediately)
+        All runs are polled from this thread, see `RunPoller`. A job whose run did not reach RUNNING
+        before the timeout, or ended, is marked as failed.
+
+        Args:
+            deployments: The deployments of jobs that were started
+        """
+        wait = self.config["wait_for_runs"]
+        runs = [
+            (_, RunStatus(_.name, _.run_id, _.run_started, seconds_to_running=_.seconds_to_running))
+            for _ in deployments
+            if _.run_id is not None and _.run_started is not None
+        ]
+        logger.info(f"Waiting for {len(runs)} runs to start")
+        RunPoller(self.runs_api, max_interval=wait["max_poll_interval"]).wait(
+            [run for _, run in runs], wait["timeout"]
+        )
+
+        for deployment, run in runs:
+            deployment.seconds_to_running = run.seconds_to_running
+            if run.running:
+                deployment.status = "running"
+                continue
+            deployment.status = f"run {run.life_cycle_state}"
+            reason = (
+                f"ended with {run.result_state}: {run.state_message}"
+                if run.done
+                else f"did not start within {wait['timeout']}s"
+            )
+            deployment.error = RuntimeError(f"Run {run.run_id} {reason}")
+            logger.error(f"Run {run.run_id} of {deployment.name} {reason}")
+
+    @staticmethod
+    def _report_deployments(deployments: List[JobDeployment]):
+        """Logs the status of every job
+
+        Raises:
+            RuntimeError listing every job that failed
+        """
+        for deployment in deployments:
+            job_id = f" as job {deployment.job_id}" if deployment.job_id is not None else ""
+            to_running = (
+                f", RUNNING after {deployment.seconds_to_running:.1f}s"
+                if deployment.seconds_to_running is not None
+                else ""
+            )
+            logger.info(
+                f"{deployment.name}: {deployment.status}{job_id} in {deployment.seconds:.1f}s{to_running}"
+            )
+
+        failures = [_ for _ in deployments if _.error]
+        if failures:
+            report = "\n".join(f"- {_.name}: {_.error}" for _ in failures)
+            raise RuntimeError(
+                f"Could not deploy {len(failures)} of {len(deployments)} jobs:\n{report}"
+            ) from failures[0].error
 
     def create_config(self, job_name: str, job_config: dict):
         common_arguments = dict(
@@ -162,21 +418,49 @@ class DeployToDatabricks(Step):
     def _construct_job_config(config_file: str, **kwargs) -> dict:
         return util.render_file_with_jinja(config_file, kwargs, json.loads)
 
-    def remove_job(self, job_name: str, is_streaming: bool):
+    def _list_jobs(self) -> List[JobConfig]:
+        """Lists all jobs in the workspace, going over all pages"""
+        jobs: List[JobConfig] = []
+        offset = 0
+        while True:
+            page = self.jobs_api.client.client.perform_query(
+                "GET", "/jobs/list", data={"offset": offset, "limit": JOBS_PAGE_SIZE}
+            )
+            jobs.extend(JobConfig(_["settings"]["name"], _["job_id"]) for _ in page.get("jobs", []))
+            if not page.get("has_more") or not page.get("jobs"):
+                return jobs
+            offset += len(page["jobs"])
+
+    def _job_index(self) -> JobIndex:
+        index = JobIndex(self._list_jobs())
+        logger.info(f"Found {len(index)} jobs")
+        return index
+
+    def remove_job(self, job_name: str, is_streaming: bool, index: Optional[JobIndex] = None):
         """
         Removes the existing job and cancels any running job_run if the application is streaming.
         If the application is batch, it'll let the batch job finish but it will remove the job,
         making sure no other job_runs can start for that old job.
-        """
 
-        job_configs = [
-            JobConfig(_["settings"]["name"], _["job_id"]) for _ in self.jobs_api.list_jobs()["jobs"]
-        ]
-        job_ids = self._application_job_id(job_name, job_configs)
+        All jobs are listed once for the whole deployment when an index is provided.
+        Matching jobs are taken from the index before they are removed, so concurrent removals
+        never remove the same job twice.
+        """
+        if index is None:
+            index = self._job_index()
+        job_ids = index.take(self._application_job_id(job_name, index))
 
         if not job_ids:
-            logger.info(f"Could not find jobs in list of {pprint.pformat(job_configs)}")
+            logger.info(f"Could not find jobs matching {job_name} in {len(index)} jobs")
+
+        self._remove_jobs(job_ids, is_streaming)
+
+    def _application_job_id(self, job_name: str, index: JobIndex) -> List[int]:
+        if self.config["job_name_match"] == "exact":
+            return index.exact(job_name)
+        return index.prefix(job_name)
 
+    def _remove_jobs(self, job_ids: List[int], is_streaming: bool):
         for job_id in job_ids:
             logger.info(f"Found Job with ID {job_id}")
             if is_streaming:
@@ -184,30 +468,116 @@ class DeployToDatabricks(Step):
             logger.info(f"Deleting Job with ID {job_id}")
             self.jobs_api.delete_job(job_id)
 
-    def _application_job_id(self, job_name: str, jobs: List[JobConfig]) -> List[int]:
-        return [_.job_id for _ in jobs if job_name in _.name]
+    def _swap_job(self, deployment: JobDeployment):
+        """Replaces the old jobs of a streaming job with as little downtime as possible
+
+        The new job is created and started while the old jobs keep running. Once the run of the new job
+        reached RUNNING and kept running for `health_wait` seconds, the old jobs are removed. If the new
+        run does not get healthy it is rolled back: the new job is removed and the old jobs keep running.
+
+        Args:
+            deployment: The deployment of a streaming job, with the ids of the old jobs to replace
+
+        Raises:
+            RuntimeError if the run of the new job did not get healthy
+        """
+        job_id = self._submit_job(deployment.config)
+        deployment.job_id = job_id
+        try:
+            run_id = self._run_job(job_id)
+            deployment.run_id = run_id
+            deployment.run_started = time.monotonic()
+            run = RunStatus(deployment.name, run_id, deployment.run_started)
+            state = self._await_healthy_run(run)
+            deployment.seconds_to_running = run.seconds_to_running
+        except Exception:
+            self._roll_back(deployment, job_id, "unknown")
+            raise
+        if state != "RUNNING":
+            self._roll_back(deployment, job_id, state)
+            raise RuntimeError(
+                f"Run {deployment.run_id} did not get healthy ({state}), "
+                f"kept the old jobs {deployment.old_job_ids} running"
+            )
+
+        logger.info(f"Run {deployment.run_id} of {deployment.name} is healthy, removing old jobs")
+        self._remove_jobs(deployment.old_job_ids, is_streaming=True)
+        deployment.status = "swapped"
+
+    def _roll_back(self, deployment: JobDeployment, job_id: int, state: str):
+        logger.warning(f"Run {deployment.run_id} of {deployment.name} is {state}, rolling back job {job_id}")
+        self._remove_jobs([job_id], is_streaming=True)
+        deployment.status = "rolled back"
+
+    def _await_healthy_run(self, run: RunStatus) -> str:
+        """Waits until a run reached RUNNING and kept running for `health_wait` seconds
+
+        Args:
+            run: The run to wait for, updated in place
+
+        Returns:
+            The life cycle state of the run, RUNNING if it is healthy
+        """
+        swap = self.config["swap_streaming_jobs"]
+        poller = RunPoller(self.runs_api, swap["poll_interval"], swap["poll_interval"])
+        poller.wait([run], swap["start_timeout"])
+        if not run.running:
+            return run.life_cycle_state
+
+        healthy_at = time.monotonic() + swap["health_wait"]
+        while run.running and time.monotonic() < healthy_at:
+            time.sleep(min(swap["poll_interval"], max(healthy_at - time.monotonic(), 0)))
+            poller.poll(run)
+        return run.life_cycle_state
+
+    def _active_run_ids(self, job_id: int) -> List[int]:
+        """Lists the ids of all active runs of a job, going over all pages"""
+        run_ids: List[int] = []
+        offset = 0
+        while True:
+            page = self.runs_api.list_runs(
+                job_id, active_only=True, completed_only=None, offset=offset, limit=RUNS_PAGE_SIZE
+            )
+            # If the runs is empty, there are no jobs at all
+            run_ids.extend(_["run_id"] for _ in page.get("runs", []))
+            if not page.get("has_more") or not page.get("runs"):
+                return run_ids
+            offset += len(page["runs"])
 
     def _kill_it_with_fire(self, job_id: int):
         logger.info(f"Finding runs for job_id {job_id}")
-        runs = self.runs_api.list_runs(job_id, active_only=True, completed_only=None, offset=None, limit=None)
-        # If the runs is empty, there are no jobs at all
-        # TODO: Check if the has_more flag is true, this means we need to go over the pages
-        if "runs" in runs:
-            active_run_ids = [_["run_id"] for _ in runs["runs"]]
+        # all pages are listed before cancelling, cancelling shifts the offsets of active runs
+        active_run_ids = self._active_run_ids(job_id)
+        if active_run_ids:
             logger.info(f"Canceling active runs {active_run_ids}")
-            [self.runs_api.cancel_run(_) for _ in active_run_ids]
+            run_concurrently(
+                self.runs_api.cancel_run,
+                active_run_ids,
+                self.config["max_parallel_operations"],
+                "cancel",
+                f"runs of job {job_id}",
+                lambda _: f"run {_}",
+            )
+
+    def deploy_job(
+        self, job_config: Dict, is_streaming: bool, run_stream_job_immediately: bool
+    ) -> Tuple[int, Optional[int]]:
+        """Creates the job and starts it if it is a streaming job that should run immediately
 
-    def deploy_job(self, job_config: Dict, is_streaming: bool, run_stream_job_immediately: bool):
+        Returns:
+            The id of the job and the id of its run, None if it was not started
+        """
         job_id = self._submit_job(job_config)
         if is_streaming and run_stream_job_immediately:
-            self._run_job(job_id)
+            return job_id, self._run_job(job_id)
+        return job_id, None
 
     def _submit_job(self, job_config: Dict):
         job_resp = self.jobs_api.create_job(job_config)
         logger.info(f"Created Job with ID {job_resp['job_id']}")
         return job_resp["job_id"]
 
-    def _run_job(self, job_id: str):
+    def _run_job(self, job_id: str) -> int:
         resp = self.jobs_api.run_now(
             job_id=job_id,
             jar_params=None,
@@ -216,3 +586,4 @@ class DeployToDatabricks(Step):
             spark_submit_params=None,
         )
         logger.info(f"Created run with ID {resp['run_id']}")
+        return resp["run_id"]
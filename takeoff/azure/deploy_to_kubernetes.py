@@ -3,7 +3,7 @@ import logging
 import os
 from pathlib import Path
 from tempfile import NamedTemporaryFile
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 import kubernetes
 import voluptuous as vol
@@ -14,8 +14,8 @@ from kubernetes.client import CoreV1Api
 from takeoff.application_version import ApplicationVersion
 from takeoff.azure.credentials.keyvault import KeyVaultClient
 from takeoff.azure.credentials.providers.keyvault_credentials_mixin import KeyVaultCredentialsMixin
-from takeoff.azure.credentials.subscription_id import SubscriptionId
-from takeoff.azure.util import get_resource_group_name, get_kubernetes_name, get_azure_credentials_object
+from takeoff.azure.management_clients import ManagementClients
+from takeoff.azure.util import get_resource_group_name, get_kubernetes_name
 from takeoff.context import Context, ContextKey
 from takeoff.credentials.container_registry import DockerRegistry
 from takeoff.credentials.secret import Secret
@@ -63,11 +63,8 @@ class BaseKubernetes(Step):
         resource_group = get_resource_group_name(self.config, self.env)
         cluster_name = get_kubernetes_name(self.config, self.env)
 
-        credentials = get_azure_credentials_object(self.config, self.vault_name, self.vault_client)
-
-        client = ContainerServiceClient(
-            credentials=credentials,
-            subscription_id=SubscriptionId(self.vault_name, self.vault_client).subscription_id(self.config),
+        client = ManagementClients().client(
+            ContainerServiceClient, self.config, self.vault_name, self.vault_client
         )
 
         # authenticate with Kubernetes
@@ -100,6 +97,11 @@ DEPLOY_SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
         vol.Optional("wait_for_rollout"): {
             vol.Optional("resource_name", default="foo/bar"): vol.All(str, vol.Match("^.*/.*$")),
             vol.Optional("resource_namespace", default=""): str,
+            vol.Optional(
+                "timeout",
+                default=None,
+                description="The maximum number of seconds to wait for the rollout, waits forever if not set",
+            ): vol.Any(None, vol.All(int, vol.Range(min=1))),
         },
         "azure": {
             vol.Required(
@@ -119,6 +121,10 @@ DEPLOY_SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
 class DeployToKubernetes(BaseKubernetes):
     """Deploys or updates deployments and services to/on a Kubernetes cluster"""
 
+    consumes = frozenset(
+        {ContextKey.EVENTHUB_PRODUCER_POLICY_SECRETS, ContextKey.EVENTHUB_CONSUMER_GROUP_SECRETS}
+    )
+
     def __init__(self, env: ApplicationVersion, config: dict):
         super().__init__(env, config)
 
@@ -225,12 +231,11 @@ class DeployToKubernetes(BaseKubernetes):
         run_shell_command(cmd)
         logger.info("Restarted all possible resources")
 
-    def _await_rollout(self, target: str, target_namespace: str):
+    def _await_rollout(self, target: str, target_namespace: str, timeout: Optional[int] = None):
         """Await the rollout of a specified target to complete
 
         This function awaits the completion of the rollout of the target in the target_namespace. If it
-        fails, or if it does not complete successfully within the default kubectl timeout, a
-        ChildProcessorError is thrown.
+        fails, or if it does not complete successfully within the timeout, a ChildProcessorError is thrown.
 
         NOTE: This may be a bit 'racy', in the sense that if multiple CI pipelines are running simultaneously,
         the await may not always be correct (it may await a different revision than the one that this step had
@@ -240,12 +245,13 @@ class DeployToKubernetes(BaseKubernetes):
             target: The resource to target. This resource should be named according to the
                     <resource_type>/name convention.
             target_namespace: The namespace of the resource
+            timeout: The maximum number of seconds to wait for the rollout
 
         Raises:
             ChildProcessError: if the rollout of the specified resource did not complete successfully.
         """
         cmd = ["kubectl", "rollout", "--namespace", target_namespace, "status", target, "--watch=True"]
-        exit_code, _ = run_shell_command(cmd)
+        exit_code, _ = run_shell_command(cmd, timeout=timeout)
         if exit_code != 0:
             raise ChildProcessError(
                 f"Specified deployment {target} in namespace {target_namespace} "
@@ -316,9 +322,9 @@ class DeployToKubernetes(BaseKubernetes):
             self._apply_kubernetes_config_file(file_path)
             logger.info("Docker registry secret available")
 
-        secrets = KeyVaultCredentialsMixin(self.vault_name, self.vault_client).get_keyvault_secrets(
-            self.application_name
-        )
+        secrets = KeyVaultCredentialsMixin(
+            self.vault_name, self.vault_client, max_workers=self.config["azure"]["keyvault_max_workers"]
+        ).get_keyvault_secrets(self.application_name)
 
         custom_values = self._get_custom_values()
 
@@ -337,6 +343,7 @@ class DeployToKubernetes(BaseKubernetes):
             self._await_rollout(
                 self.config["wait_for_rollout"]["resource_name"],
                 self.config["wait_for_rollout"]["resource_namespace"],
+                self.config["wait_for_rollout"]["timeout"],
             )
 
     @property
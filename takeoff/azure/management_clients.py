@@ -0,0 +1,101 @@
+import logging
+from typing import Callable, Tuple, Type, TypeVar, cast
+
+from azure.keyvault import KeyVaultClient as AzureKeyVaultClient
+from msrest.service_client import SDKClient
+from msrestazure.azure_active_directory import AADMixin
+
+from takeoff.azure.credentials.subscription_id import SubscriptionId
+from takeoff.azure.util import get_azure_credentials_object
+from takeoff.context import Singleton
+from takeoff.util import KeyedCache
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T", bound=SDKClient)
+
+
+class ManagementClients(metaclass=Singleton):
+    """Run scoped factory of Azure management clients.
+
+    Resolving credentials and the subscription id requires several round trips to the vault and AAD,
+    so both are resolved once per vault. Every type of management client is created once per vault,
+    credentials type and subscription, and keeps its HTTP session open in between requests.
+    """
+
+    def __init__(self):
+        self.__credentials: KeyedCache[Tuple[str, str], AADMixin] = KeyedCache()
+        self.__subscription_ids: KeyedCache[str, str] = KeyedCache()
+        self.__clients: KeyedCache[Tuple[Type[SDKClient], str, str, str], SDKClient] = KeyedCache()
+
+    def credentials(self, config: dict, vault_name: str, vault_client: AzureKeyVaultClient) -> AADMixin:
+        """Returns the AAD credentials for the `credentials_type` in the config
+
+        Args:
+            config: The configuration of the step
+            vault_name: The name of the vault containing the credentials
+            vault_client: A client for the vault
+
+        Returns:
+            The AAD credentials, see `get_azure_credentials_object`
+        """
+        return self.__credentials.get_or_create(
+            (vault_name, config["credentials_type"]),
+            lambda: get_azure_credentials_object(config, vault_name, vault_client),
+        )
+
+    def subscription_id(self, config: dict, vault_name: str, vault_client: AzureKeyVaultClient) -> str:
+        """Returns the subscription id stored in the vault
+
+        Args:
+            config: The configuration of the step
+            vault_name: The name of the vault containing the subscription id
+            vault_client: A client for the vault
+
+        Returns:
+            The subscription id
+        """
+        return self.__subscription_ids.get_or_create(
+            vault_name, lambda: SubscriptionId(vault_name, vault_client).subscription_id(config)
+        )
+
+    def client(
+        self, client_class: Type[T], config: dict, vault_name: str, vault_client: AzureKeyVaultClient
+    ) -> T:
+        """Returns a management client of the given type
+
+        Args:
+            client_class: The type of management client, e.g. `EventHubManagementClient`
+            config: The configuration of the step
+            vault_name: The name of the vault containing the credentials and subscription id
+            vault_client: A client for the vault
+
+        Returns:
+            A management client, shared with all steps using the same credentials and subscription
+        """
+        subscription_id = self.subscription_id(config, vault_name, vault_client)
+        key = (client_class, vault_name, config["credentials_type"], subscription_id)
+
+        # management clients take a subscription id, instead of the configuration of a plain SDKClient
+        factory = cast(Callable[[AADMixin, str], T], client_class)
+
+        def create() -> SDKClient:
+            logger.info(f"Creating {client_class.__name__} for subscription {subscription_id}")
+            client = factory(self.credentials(config, vault_name, vault_client), subscription_id)
+            # entering the client keeps its HTTP session open in between requests
+            return client.__enter__()
+
+        # clients are cached by their class, so the cached client is a T
+        return cast(T, self.__clients.get_or_create(key, create))
+
+    def clear(self) -> "ManagementClients":
+        """Closes and drops all clients, credentials and subscription ids
+
+        Returns:
+            The cleared ManagementClients
+        """
+        for client in self.__clients.clear():
+            client.__exit__(None, None, None)
+        self.__credentials.clear()
+        self.__subscription_ids.clear()
+        return self
@@ -1,20 +1,42 @@
+import base64
 import glob
+import hashlib
 import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from functools import partial
+from typing import Callable, List, Optional, Tuple
 
 import voluptuous as vol
-from azure.storage.blob import BlockBlobService
+from azure.common import AzureMissingResourceHttpError
+from azure.storage.blob import BlockBlobService, ContentSettings
 from twine.commands.upload import upload
+from twine.settings import Settings
 
 from takeoff.application_version import ApplicationVersion
 from takeoff.azure.credentials.artifact_store import ArtifactStore
 from takeoff.azure.credentials.keyvault import KeyVaultClient
 from takeoff.azure.credentials.storage_account import BlobStore
+from takeoff.azure.resumable_upload import ResumableBlockUpload
 from takeoff.schemas import TAKEOFF_BASE_SCHEMA
 from takeoff.step import Step
-from takeoff.util import get_tag, get_whl_name, get_main_py_name, get_jar_name, run_shell_command
+from takeoff.util import (
+    STREAMED_OUTPUT_LINES,
+    get_tag,
+    get_whl_name,
+    get_main_py_name,
+    get_jar_name,
+    run_shell_command,
+    run_concurrently,
+)
 
 logger = logging.getLogger(__name__)
 
+MD5_CHUNK_SIZE = 4 * 1024 * 1024
+MB = 1024 * 1024
+
 
 def language_must_match_target(fields):
     """Checks if incompatible lang/targets are used.
@@ -28,6 +50,36 @@ def language_must_match_target(fields):
     return fields
 
 
+def file_md5(path: str) -> str:
+    """Computes the MD5 of a file the way Azure Storage reports it
+
+    Args:
+        path: The path to the file
+
+    Returns:
+        The base64 encoded MD5 digest of the file
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(MD5_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return base64.b64encode(md5.digest()).decode()
+
+
+@dataclass(frozen=True)
+class UploadReport:
+    """The outcome of uploading a single file to cloud storage"""
+
+    blob: str
+    bytes_uploaded: int
+    seconds: float
+    skipped: bool = False
+
+    @property
+    def megabytes_per_second(self) -> float:
+        return self.bytes_uploaded / MB / self.seconds if self.seconds else 0.0
+
+
 SCHEMA = vol.All(
     TAKEOFF_BASE_SCHEMA,
     vol.Schema(
@@ -55,6 +107,42 @@ SCHEMA = vol.All(
                     ),
                     default=False,
                 ): bool,
+                vol.Optional(
+                    "skip_unchanged_blobs",
+                    description=(
+                        "Do not upload files to cloud storage if a blob with the same name and MD5 "
+                        "already exists."
+                    ),
+                    default=True,
+                ): bool,
+                vol.Optional(
+                    "upload_block_size",
+                    description="The size in MB of the blocks large files are uploaded to cloud storage in.",
+                    default=8,
+                ): vol.All(int, vol.Range(min=1, max=100)),
+                vol.Optional(
+                    "resumable_uploads",
+                    description=(
+                        "Upload files larger than one block block by block, so a failed upload only "
+                        "uploads the missing blocks when it is retried."
+                    ),
+                    default=True,
+                ): bool,
+                vol.Optional(
+                    "upload_journal_dir",
+                    description="The directory to keep track of the uploaded blocks of resumable uploads in.",
+                    default=".takeoff/uploads",
+                ): str,
+                vol.Optional(
+                    "upload_retries",
+                    description="The number of times the missing blocks of a resumable upload are retried.",
+                    default=3,
+                ): vol.All(int, vol.Range(min=0)),
+                vol.Optional(
+                    "upload_max_connections",
+                    description="The number of blocks of a single file that are uploaded concurrently.",
+                    default=4,
+                ): vol.All(int, vol.Range(min=1)),
                 "azure": vol.All(
                     {
                         "common": {
@@ -86,6 +174,9 @@ class PublishArtifact(Step):
     def __init__(self, env: ApplicationVersion, config: dict):
         super().__init__(env, config)
         self.vault_name, self.vault_client = KeyVaultClient.vault_and_client(self.config, self.env)
+        self.__credentials_lock = threading.Lock()
+        self.__blob_service: Optional[BlockBlobService] = None
+        self.__pypi_settings: Optional[Settings] = None
 
     def run(self):
         if self.config["language"] == "python":
@@ -128,40 +219,117 @@ class PublishArtifact(Step):
         return wheels[0]
 
     def publish_python_package(self):
-        """Publishes the Python wheel to all specified targets"""
+        """Publishes the Python wheel to all specified targets, concurrently"""
+        actions = []
         for target in self.config["target"]:
             if target == "pypi":
-                self.publish_to_pypi()
+                actions.append(("pypi", self.publish_to_pypi))
             elif target == "cloud_storage":
-                self.upload_to_cloud_storage(file=self._get_wheel(), file_extension=".whl")
+                wheel = self._get_wheel()
+                actions.append(
+                    (
+                        f"cloud_storage ({wheel})",
+                        partial(self.upload_to_cloud_storage, file=wheel, file_extension=".whl"),
+                    )
+                )
                 # only upload a py file if the path has been specified
                 if "python_file_path" in self.config.keys():
-                    self.upload_to_cloud_storage(
-                        file=f"{self.config['python_file_path']}", file_extension=".py"
+                    actions.append(
+                        (
+                            f"cloud_storage ({self.config['python_file_path']})",
+                            partial(
+                                self.upload_to_cloud_storage,
+                                file=f"{self.config['python_file_path']}",
+                                file_extension=".py",
+                            ),
+                        )
                     )
             else:
                 logging.info("Invalid target for artifact")
+        self._publish_concurrently(actions)
 
     def publish_jvm_package(self):
-        """Publishes the jar to all specified targets"""
+        """Publishes the jar to all specified targets, concurrently"""
+        actions = []
         for target in self.config["target"]:
             if target == "cloud_storage":
-                self.upload_to_cloud_storage(file=self._get_jar(), file_extension=".jar")
+                jar = self._get_jar()
+                actions.append(
+                    (
+                        f"cloud_storage ({jar})",
+                        partial(self.upload_to_cloud_storage, file=jar, file_extension=".jar"),
+                    )
+                )
             elif target == "ivy":
-                self.publish_to_ivy()
+                actions.append(("ivy", self.publish_to_ivy))
             else:
                 logging.info("Invalid target for artifact")
+        self._publish_concurrently(actions)
+
+    def _publish_concurrently(self, actions: List[Tuple[str, Callable[[], object]]]):
+        """Runs all publish actions concurrently and waits for all of them to finish
+
+        The credentials of all targets are resolved up front, so every secret is read from the vault
+        once and missing credentials fail the step before anything is published.
 
-    def upload_to_cloud_storage(self, file: str, file_extension: str):
+        Args:
+            actions: The name of every target and the action publishing to it
+
+        Raises:
+            RuntimeError listing every target that failed
+        """
+        if not actions:
+            return
+        self._resolve_credentials()
+
+        def timed(target: Tuple[str, Callable[[], object]]):
+            name, action = target
+            start = time.monotonic()
+            try:
+                action()
+            finally:
+                logger.info(f"Publishing to {name} took {time.monotonic() - start:.1f}s")
+
+        run_concurrently(timed, actions, len(actions), "publish to", "targets", lambda _: _[0])
+
+    def _resolve_credentials(self):
+        """Resolves the credentials of all configured targets"""
+        if "cloud_storage" in self.config["target"]:
+            self._blob_service()
+        if "pypi" in self.config["target"] and get_tag():
+            self._pypi_settings()
+
+    def _blob_service(self) -> BlockBlobService:
+        """Returns the client for the storage account, shared by all uploads of this step"""
+        with self.__credentials_lock:
+            if not self.__blob_service:
+                self.__blob_service = BlobStore(self.vault_name, self.vault_client).service_client(
+                    self.config
+                )
+                self.__blob_service.MAX_BLOCK_SIZE = self.config["upload_block_size"] * MB
+            return self.__blob_service
+
+    def _pypi_settings(self) -> Settings:
+        """Returns the settings to upload to the artifact store, resolved once per step"""
+        with self.__credentials_lock:
+            if not self.__pypi_settings:
+                self.__pypi_settings = ArtifactStore(
+                    vault_name=self.vault_name, vault_client=self.vault_client
+                ).store_settings(self.config)
+            return self.__pypi_settings
+
+    def upload_to_cloud_storage(self, file: str, file_extension: str) -> UploadReport:
         """
         Args:
             file: Name of file
             file_extension: Extension of the file, prefixed with `.`
 
+        Returns:
+            The report of the upload
+
         Raises:
             ValueError if the filetype is not supported.
         """
-        blob_service = BlobStore(self.vault_name, self.vault_client).service_client(self.config)
 
         if file_extension == ".py":
             filename = get_main_py_name(
@@ -177,19 +345,27 @@ class PublishArtifact(Step):
         else:
             raise ValueError(f"Unsupported filetype extension: {file_extension}")
 
-        self._upload_file_to_azure_storage_account(blob_service, file, filename)
+        return self._upload_file_to_azure_storage_account(self._blob_service(), file, filename)
 
     def _upload_file_to_azure_storage_account(
         self, client: BlockBlobService, source: str, destination: str, container: str = None
-    ):
+    ) -> UploadReport:
         """Upload the file to the specified Azure Storage Account.
 
         Assumption is that any cloud environment has access to a shared repository of artifacts.
 
+        The MD5 of the file is stored with the blob. When `skip_unchanged_blobs` is set, the upload
+        is skipped if the blob already exists with the same MD5. Files larger than one block are uploaded
+        with a `ResumableBlockUpload` when `resumable_uploads` is set.
+
         Args:
             client: Azure Storage Account client
+            source: Path to the file to upload
             destination: Name of the file
             container: Name of the container the file should be uploaded to
+
+        Returns:
+            The size of the file and how long the upload took, which is also logged
         """
         if not container:
             container = self.config["azure"]["common"]["artifacts_shared_storage_account_container_name"]
@@ -200,15 +376,65 @@ class PublishArtifact(Step):
              | in container {container}"""
         )
 
-        client.create_blob_from_path(container_name=container, blob_name=destination, file_path=source)
+        start = time.monotonic()
+        content_md5 = file_md5(source)
+        if self.config["skip_unchanged_blobs"]:
+            if self._blob_md5(client, container, destination) == content_md5:
+                logger.info(f"Skipping upload of {destination}, the blob already has MD5 {content_md5}")
+                return UploadReport(destination, 0, time.monotonic() - start, skipped=True)
+            logger.info(f"Uploading {destination}, the blob does not exist or has a different MD5")
+
+        size = os.path.getsize(source)
+        block_size = self.config["upload_block_size"] * MB
+        if self.config["resumable_uploads"] and size > block_size:
+            bytes_uploaded = ResumableBlockUpload(
+                client,
+                container,
+                destination,
+                source,
+                content_md5,
+                block_size,
+                self.config["upload_journal_dir"],
+                max_connections=self.config["upload_max_connections"],
+                retries=self.config["upload_retries"],
+            ).upload()
+        else:
+            client.create_blob_from_path(
+                container_name=container,
+                blob_name=destination,
+                file_path=source,
+                content_settings=ContentSettings(content_md5=content_md5),
+                max_connections=self.config["upload_max_connections"],
+            )
+            bytes_uploaded = size
+        report = UploadReport(destination, bytes_uploaded, time.monotonic() - start)
+        logger.info(
+            f"Uploaded {destination}: {report.bytes_uploaded / MB:.1f} MB in {report.seconds:.1f}s "
+            f"({report.megabytes_per_second:.1f} MB/s)"
+        )
+        return report
+
+    @staticmethod
+    def _blob_md5(client: BlockBlobService, container: str, blob: str) -> Optional[str]:
+        """Fetches the MD5 of a blob, without downloading it
+
+        Args:
+            client: Azure Storage Account client
+            container: Name of the container of the blob
+            blob: Name of the blob
+
+        Returns:
+            The base64 encoded MD5 of the blob, None if the blob does not exist or has no MD5
+        """
+        try:
+            return client.get_blob_properties(container, blob).properties.content_settings.content_md5
+        except AzureMissingResourceHttpError:
+            return None
 
     def publish_to_pypi(self):
         """Uses `twine` to upload to PyPi"""
         if get_tag():
-            credentials = ArtifactStore(
-                vault_name=self.vault_name, vault_client=self.vault_client
-            ).store_settings(self.config)
-            upload(upload_settings=credentials, dists=["dist/*"])
+            upload(upload_settings=self._pypi_settings(), dists=["dist/*"])
         else:
             logging.info("Not on a release tag, not publishing artifact on PyPi.")
 
@@ -227,7 +453,7 @@ class PublishArtifact(Step):
         version = self.env.artifact_tag
         postfix = "-SNAPSHOT" if not get_tag() else ""
         cmd = ["sbt", f'set version := "{version}{postfix}"', "publish"]
-        return_code, _ = run_shell_command(cmd)
+        return_code, _ = run_shell_command(cmd, max_output_lines=STREAMED_OUTPUT_LINES)
 
         if return_code != 0:
             raise ChildProcessError("Could not publish the package for some reason!")
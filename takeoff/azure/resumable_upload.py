@@ -0,0 +1,184 @@
+import base64
+import hashlib
+import json
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Set
+
+from azure.common import AzureMissingResourceHttpError
+from azure.storage.blob import BlobBlock, BlockBlobService, BlockListType, ContentSettings
+
+from takeoff.util import write_json_atomically
+
+logger = logging.getLogger(__name__)
+
+
+class UploadJournal(object):
+    """The ids of the blocks of an upload that were staged in blob storage, stored in a local json file.
+
+    The journal belongs to a single version of a file, uploaded with a single block size. A journal
+    written for different content or a different block size is ignored.
+    """
+
+    def __init__(self, path: str, content_md5: str, block_size: int):
+        self.path = path
+        self.content_md5 = content_md5
+        self.block_size = block_size
+        self.__lock = threading.Lock()
+        self.__blocks: Set[str] = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                journal = json.load(f)
+            if journal["content_md5"] == content_md5 and journal["block_size"] == block_size:
+                self.__blocks = set(journal["blocks"])
+
+    def blocks(self) -> Set[str]:
+        with self.__lock:
+            return set(self.__blocks)
+
+    def add(self, block_id: str):
+        """Records a staged block and writes the journal"""
+        with self.__lock:
+            self.__blocks.add(block_id)
+            journal = {
+                "content_md5": self.content_md5,
+                "block_size": self.block_size,
+                "blocks": sorted(self.__blocks),
+            }
+            write_json_atomically(self.path, journal)
+
+    def remove(self):
+        with self.__lock:
+            self.__blocks.clear()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class ResumableBlockUpload(object):
+    """Uploads a file to a block blob block by block, resuming from the blocks staged by an earlier attempt.
+
+    Every staged block is recorded in an `UploadJournal`. A failed upload is retried by only uploading the
+    blocks that are missing, also when the whole step is run again. The blocks are committed to the blob
+    with a single `put_block_list` once all of them are staged.
+
+    Block ids contain the MD5 of the file, so blocks staged for other content are never committed.
+    """
+
+    def __init__(
+        self,
+        client: BlockBlobService,
+        container: str,
+        blob: str,
+        source: str,
+        content_md5: str,
+        block_size: int,
+        journal_dir: str,
+        max_connections: int = 1,
+        retries: int = 3,
+        backoff: float = 1,
+    ):
+        """
+        Args:
+            client: Azure Storage Account client
+            container: Name of the container to upload to
+            blob: Name of the blob to upload to
+            source: Path to the file to upload
+            content_md5: The base64 encoded MD5 of the file
+            block_size: The size of the blocks in bytes
+            journal_dir: The directory to keep the journals of uploads in
+            max_connections: The number of blocks to upload concurrently
+            retries: The number of times the missing blocks are uploaded again after a failure
+            backoff: The initial number of seconds to wait between retries, doubled on every attempt
+        """
+        self.client = client
+        self.container = container
+        self.blob = blob
+        self.source = source
+        self.content_md5 = content_md5
+        self.block_size = block_size
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff = backoff
+        journal_name = hashlib.sha1(f"{container}/{blob}".encode()).hexdigest()
+        self.journal = UploadJournal(
+            os.path.join(journal_dir, f"{journal_name}.json"), content_md5, block_size
+        )
+
+    def upload(self) -> int:
+        """Uploads the missing blocks and commits the blob
+
+        Returns:
+            The number of bytes uploaded, excluding the blocks that were already staged
+
+        Raises:
+            The last failure of a block upload, once all retries are used up
+        """
+        block_ids = self._block_ids()
+        staged = self._staged_blocks(block_ids)
+        if staged:
+            logger.info(
+                f"Resuming upload of {self.blob}, {len(staged)} of {len(block_ids)} blocks are staged"
+            )
+
+        uploaded = 0
+        for attempt in range(self.retries + 1):
+            missing = [(index, _) for index, _ in enumerate(block_ids) if _ not in staged]
+            with ThreadPoolExecutor(max_workers=self.max_connections) as executor:
+                futures = [executor.submit(self._put_block, index, block_id) for index, block_id in missing]
+
+            uploaded += sum(_.result() for _ in futures if not _.exception())
+            staged |= {block_id for (_, block_id), future in zip(missing, futures) if not future.exception()}
+            errors: List[BaseException] = [e for e in (_.exception() for _ in futures) if e is not None]
+            if not errors:
+                break
+            if attempt == self.retries:
+                raise errors[-1]
+            delay = self.backoff * 2**attempt
+            logger.warning(
+                f"Uploading {len(errors)} blocks of {self.blob} failed, "
+                f"retrying in {delay} seconds: {errors[-1]}"
+            )
+            time.sleep(delay)
+
+        self.client.put_block_list(
+            self.container,
+            self.blob,
+            [BlobBlock(id=_) for _ in block_ids],
+            content_settings=ContentSettings(content_md5=self.content_md5),
+        )
+        self.journal.remove()
+        return uploaded
+
+    def _block_ids(self) -> List[str]:
+        md5 = base64.b64decode(self.content_md5).hex()
+        block_count = max(1, math.ceil(os.path.getsize(self.source) / self.block_size))
+        return [f"{md5}-{index:06d}" for index in range(block_count)]
+
+    def _staged_blocks(self, block_ids: List[str]) -> Set[str]:
+        """Returns the blocks in the journal that are still staged in blob storage
+
+        Staged blocks are discarded by the service after a week, or when another upload commits the blob.
+        """
+        journaled = self.journal.blocks()
+        if not journaled:
+            return set()
+        try:
+            block_list = self.client.get_block_list(
+                self.container, self.blob, block_list_type=BlockListType.Uncommitted
+            )
+            uncommitted = {_.id for _ in block_list.uncommitted_blocks}
+        except AzureMissingResourceHttpError:
+            uncommitted = set()
+        return journaled & uncommitted & set(block_ids)
+
+    def _put_block(self, index: int, block_id: str) -> int:
+        with open(self.source, "rb") as f:
+            f.seek(index * self.block_size)
+            data = f.read(self.block_size)
+        self.client.put_block(self.container, self.blob, data, block_id, validate_content=True)
+        self.journal.add(block_id)
+        return len(data)
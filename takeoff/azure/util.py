@@ -5,7 +5,7 @@ from azure.keyvault import KeyVaultClient as AzureKeyVaultClient
 from takeoff.application_version import ApplicationVersion
 from takeoff.azure.credentials.active_directory_user import ActiveDirectoryUserCredentials
 from takeoff.azure.credentials.service_principal import ServicePrincipalCredentialsFromVault
-from takeoff.util import load_takeoff_plugins
+from takeoff.util import find_takeoff_plugin_function
 from msrestazure.azure_active_directory import AADMixin
 
 
@@ -40,10 +40,7 @@ def _get_naming_function(function_name: str, default: Callable) -> Callable:
         A function that maps the Takeoff config and application version to the resource name. If
         a plugin was found it returns that function, otherwise the `default` provided.
     """
-    for plugin in load_takeoff_plugins().values():
-        if hasattr(plugin, function_name):
-            return getattr(plugin, function_name)
-    return default
+    return find_takeoff_plugin_function(function_name) or default
 
 
 def default_naming(key: str) -> Callable[[dict, ApplicationVersion], str]:
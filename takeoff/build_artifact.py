@@ -6,7 +6,7 @@ import voluptuous as vol
 from takeoff.application_version import ApplicationVersion
 from takeoff.schemas import TAKEOFF_BASE_SCHEMA
 from takeoff.step import Step
-from takeoff.util import run_shell_command
+from takeoff.util import STREAMED_OUTPUT_LINES, run_shell_command
 
 logger = logging.getLogger(__name__)
 
@@ -59,7 +59,7 @@ class BuildArtifact(Step):
         self._remove_old_artifacts("dist/")
 
         cmd = ["python", "setup.py", "bdist_wheel"]
-        return_code, _ = run_shell_command(cmd)
+        return_code, _ = run_shell_command(cmd, max_output_lines=STREAMED_OUTPUT_LINES)
 
         if return_code != 0:
             raise ChildProcessError("Could not build the package for some reason!")
@@ -75,7 +75,7 @@ class BuildArtifact(Step):
         self._remove_old_artifacts("target/")
 
         cmd = ["sbt", "clean", "assembly"]
-        return_code, _ = run_shell_command(cmd)
+        return_code, _ = run_shell_command(cmd, max_output_lines=STREAMED_OUTPUT_LINES)
 
         if return_code != 0:
             raise ChildProcessError("Could not build the package for some reason!")
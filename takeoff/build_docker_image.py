@@ -1,20 +1,37 @@
 import base64
+import hashlib
 import json
 import logging
 import os
 from dataclasses import dataclass
-from typing import List, Union
+from typing import List, Optional, Tuple, Union
 
+import requests
 import voluptuous as vol
+from docker.utils.build import exclude_paths
 
 from takeoff.application_version import ApplicationVersion
 from takeoff.credentials.container_registry import DockerRegistry
+from takeoff.docker_engine import DockerCliEngine, DockerEngine, DockerSdkEngine
+from takeoff.docker_registry import RegistryClient
 from takeoff.schemas import TAKEOFF_BASE_SCHEMA
 from takeoff.step import Step
-from takeoff.util import run_shell_command
+from takeoff.util import run_concurrently
 
 logger = logging.getLogger(__name__)
 
+ENGINES = ["cli", "sdk"]
+CONTEXT_HASH_LABEL = "takeoff.context-hash"
+
+
+def _engine_supports_options(config: dict) -> dict:
+    if config["engine"] == "sdk" and (
+        config["buildkit"] or any(_["cache_to"] for _ in config["dockerfiles"])
+    ):
+        raise vol.Invalid("buildkit and cache_to are only supported by the 'cli' engine", path=["engine"])
+    return config
+
+
 SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
     {
         vol.Required("task"): "build_docker_image",
@@ -30,6 +47,8 @@ SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
                     "prefix": None,
                     "custom_image_name": None,
                     "tag_release_as_latest": True,
+                    "cache_from": [],
+                    "cache_to": None,
                 }
             ],
         ): [
@@ -54,13 +73,111 @@ SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
                 vol.Optional(
                     "tag_release_as_latest", default=True, description="Tag a release also as 'latest' image."
                 ): vol.Any(None, bool),
+                vol.Optional(
+                    "cache_from",
+                    default=[],
+                    description=(
+                        "External cache sources, either an image or a buildx cache "
+                        "(e.g. type=registry,ref=myreg.io/my-app:cache or type=local,src=path)"
+                    ),
+                ): [str],
+                vol.Optional(
+                    "cache_to",
+                    default=None,
+                    description=(
+                        "Buildx cache export destination "
+                        "(e.g. type=registry,ref=myreg.io/my-app:cache,mode=max or type=local,dest=path). "
+                        "Requires docker buildx."
+                    ),
+                ): vol.Any(None, str),
             }
         ],
+        vol.Optional(
+            "buildkit",
+            default=False,
+            description="Build with BuildKit, embedding cache metadata in the pushed images",
+        ): bool,
+        vol.Optional(
+            "cache_previous_image",
+            default=False,
+            description=(
+                "Use the previously pushed image as cache source. This is the 'latest' image for releases, "
+                "the image of the same branch otherwise"
+            ),
+        ): bool,
+        vol.Optional(
+            "max_parallel_builds",
+            default=1,
+            description=(
+                "The number of images that are built and pushed concurrently. "
+                "The output of every image is prefixed with its docker file name."
+            ),
+        ): vol.All(int, vol.Range(min=1)),
+        vol.Optional(
+            "engine",
+            default="cli",
+            description=(
+                "How to talk to docker: 'cli' runs the docker-cli, 'sdk' uses a single connection to the "
+                "Docker Engine API and reports the pushed bytes and timings of every layer"
+            ),
+        ): vol.All(str, vol.In(ENGINES)),
+        vol.Optional(
+            "skip_unchanged_images",
+            default=False,
+            description=(
+                "Label images with a hash of the docker file and build context. An image is not rebuilt "
+                "when a previously pushed image has the same hash, it is only retagged and pushed"
+            ),
+        ): bool,
+        vol.Optional(
+            "reuse_image_tags",
+            default=["SNAPSHOT"],
+            description=(
+                "Tags of previously pushed images to consider for reuse, in addition to the image with the "
+                "same tag and the 'latest' image"
+            ),
+        ): [str],
     },
     extra=vol.ALLOW_EXTRA,
 )
 
 
+def context_hash(docker_file: str, root: str = ".") -> str:
+    """Computes a hash of the docker file and all files in the build context
+
+    Files excluded by `.dockerignore` are not sent to the docker daemon, so they are not part of the hash.
+    The `.git` directory is never part of the hash, it changes with every commit and tag while the sources
+    stay the same.
+
+    Args:
+        docker_file: The name of the dockerfile, relative to the build context
+        root: The build context
+
+    Returns:
+        The hex digest of the hash
+    """
+    patterns = []
+    dockerignore = os.path.join(root, ".dockerignore")
+    if os.path.exists(dockerignore):
+        with open(dockerignore) as f:
+            patterns = [_.strip() for _ in f.read().splitlines() if _.strip() and not _.startswith("#")]
+
+    # excluded last, so a `!.git` exception in .dockerignore does not add it back
+    patterns.append(".git")
+
+    digest = hashlib.sha256()
+    for path in sorted(exclude_paths(root, patterns, dockerfile=docker_file)):
+        full_path = os.path.join(root, path)
+        if not os.path.isfile(full_path):
+            continue
+        file_digest = hashlib.sha256()
+        with open(full_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                file_digest.update(chunk)
+        digest.update(f"{path}\0{file_digest.hexdigest()}\n".encode())
+    return digest.hexdigest()
+
+
 @dataclass(frozen=True)
 class DockerFile(object):
     dockerfile: str
@@ -68,6 +185,8 @@ class DockerFile(object):
     prefix: Union[str, None]
     custom_image_name: Union[str, None]
     tag_release_as_latest: bool
+    cache_from: Tuple[str, ...] = ()
+    cache_to: Optional[str] = None
 
 
 class DockerImageBuilder(Step):
@@ -76,12 +195,16 @@ class DockerImageBuilder(Step):
     Depends on:
     - Credentials for a docker registry (username, password, registry) must be
       available in your cloud vault or as environment variables
-    - The docker-cli must be available
+    - The docker-cli must be available, or the docker daemon must be reachable when using the 'sdk' engine
     """
 
     def __init__(self, env: ApplicationVersion, config: dict):
         super().__init__(env, config)
         self.docker_credentials = DockerRegistry(self.config, self.env).credentials()
+        self.engine: DockerEngine = (
+            DockerCliEngine() if self.config["engine"] == "cli" else DockerSdkEngine(self.docker_credentials)
+        )
+        self.registry = RegistryClient(self.docker_credentials)
 
     def populate_docker_config(self):
         """Creates ~/.docker/config.json and writes the credentials for the registry to the file"""
@@ -99,12 +222,18 @@ class DockerImageBuilder(Step):
             json.dump(docker_json, f)
 
     def schema(self) -> vol.Schema:
-        return SCHEMA
+        return vol.Schema(vol.All(SCHEMA, _engine_supports_options))
 
     def _construct_docker_build_config(self):
         return [
             DockerFile(
-                df["file"], df["postfix"], df["prefix"], df["custom_image_name"], df["tag_release_as_latest"]
+                df["file"],
+                df["postfix"],
+                df["prefix"],
+                df["custom_image_name"],
+                df["tag_release_as_latest"],
+                tuple(df["cache_from"]),
+                df["cache_to"],
             )
             for df in self.config["dockerfiles"]
         ]
@@ -113,97 +242,139 @@ class DockerImageBuilder(Step):
         self.populate_docker_config()
         self.deploy(self._construct_docker_build_config())
 
-    @staticmethod
-    def build_image(docker_file: str, tag: str):
-        """Build the docker image
+    def _previous_image(self, repository: str) -> str:
+        """The image pushed by an earlier run, which is 'latest' for releases and the same tag otherwise"""
+        if self.env.on_release_tag:
+            return f"{repository}:latest"
+        return f"{repository}:{self.env.artifact_tag}"
 
-        This uses bash to run commands directly.
-
-        Args:
-            docker_file: The name of the dockerfile to build
-            tag: The docker tag to apply to the image name
-        """
-        cmd = [
-            "docker",
-            "build",
-            "--build-arg",
-            f"PIP_EXTRA_INDEX_URL={os.getenv('PIP_EXTRA_INDEX_URL')}",
-            "-t",
-            tag,
-            "-f",
-            f"./{docker_file}",
-            ".",
-        ]
+    def _cache_sources(self, df: DockerFile, repository: str, output_prefix: str) -> List[str]:
+        """Determines the cache sources for a docker image
 
-        logger.info(f"Building docker image for {docker_file} with command \n{' '.join(cmd)}")
+        If `cache_previous_image` is set, the previously pushed image is added as cache source. The
+        classic docker builder can only use local images as cache, so the image is pulled first.
+        BuildKit fetches cache metadata from the registry by itself.
 
-        return_code, _ = run_shell_command(cmd)
+        Args:
+            df: The docker image to build
+            repository: The repository of the docker image
+            output_prefix: Prefixed to every line of output of the docker cli
 
-        if return_code != 0:
-            raise ChildProcessError("Could not build the image for some reason!")
+        Returns:
+            All cache sources for the docker image
+        """
+        cache_from = list(df.cache_from)
+        if self.config["cache_previous_image"]:
+            previous_image = self._previous_image(repository)
+            if self.config["buildkit"] or self.engine.pull_image(previous_image, output_prefix):
+                cache_from.append(previous_image)
+        return cache_from
 
-    @staticmethod
-    def tag_image(old_tag: str, new_tag: str):
-        """Tag a docker tag with a new tag
+    def _reusable_image(self, repository: str, digest: str) -> Optional[str]:
+        """Finds a previously pushed image that was built from the same docker file and build context
 
-        This uses bash to run commands directly.
+        The candidates are the image with the same tag, the 'latest' image and the images tagged with
+        `reuse_image_tags`. The context hash label of every candidate is read from its config in the
+        registry, none of them is pulled.
 
         Args:
-            old_tag: The existing docker tag
-            new_tag: The new docker tag
-        """
-        cmd = ["docker", "tag", old_tag, new_tag]
+            repository: The repository of the docker image
+            digest: The context hash of the image to build
 
-        logger.info(f"Tagging {old_tag} as {new_tag}")
+        Returns:
+            The tag of an image with the same context hash, if any
+        """
+        tags = [self.env.artifact_tag, "latest"] + self.config["reuse_image_tags"]
+        for candidate in [f"{repository}:{_}" for _ in dict.fromkeys(tags)]:
+            try:
+                label = self.registry.image_label(candidate, CONTEXT_HASH_LABEL)
+            except requests.RequestException as e:
+                logger.warning(f"Could not read the labels of {candidate}: {e}")
+                continue
+            if label == digest:
+                logger.info(f"Image {candidate} was built from the same context ({digest})")
+                return candidate
+        return None
 
-        return_code, _ = run_shell_command(cmd)
+    def deploy(self, dockerfiles: List[DockerFile]):
+        """Builds and pushes all docker images
 
-        if return_code != 0:
-            raise ChildProcessError("Could not tag image for some reason!")
+        When `max_parallel_builds` is larger than one, images are built concurrently, and pushing an
+        image overlaps with building the others. The output of every image is then prefixed with its
+        docker file name. No more images are started once one of them fails.
 
-    @staticmethod
-    def push_image(tag: str):
-        """Push the docker image
+        Args:
+            dockerfiles: The docker images to build
 
-        This uses bash to run commands directly.
+        Raises:
+            ChildProcessError if an image could not be built or pushed
+        """
+        max_parallel_builds = self.config["max_parallel_builds"]
+        concurrent = max_parallel_builds > 1 and len(dockerfiles) > 1
+        run_concurrently(
+            lambda df: self.deploy_image(df, f"[{df.dockerfile}] " if concurrent else ""),
+            dockerfiles,
+            max_parallel_builds,
+            "build and push",
+            "docker images",
+            lambda _: _.dockerfile,
+            fail_fast=True,
+        )
+
+    def deploy_image(self, df: DockerFile, output_prefix: str = ""):
+        """Builds and pushes a single docker image, and optionally tags and pushes it as `latest`
+
+        With `skip_unchanged_images`, an image built from the same docker file and build context is
+        tagged in the registry instead of rebuilt and pushed.
 
         Args:
-            tag: The docker tag to upload
+            df: The docker image to build
+            output_prefix: Prefixed to every line of output of the docker cli
         """
-        cmd = ["docker", "push", tag]
-
-        logger.info(f"Uploading docker image {tag}")
+        tag = self.env.artifact_tag
 
-        return_code, _ = run_shell_command(cmd)
+        repository = "/".join(
+            [_ for _ in (self.docker_credentials.registry, df.prefix, self.application_name) if _ is not None]
+        )
 
-        if return_code != 0:
-            raise ChildProcessError("Could not push image for some reason!")
+        if df.custom_image_name:
+            repository = df.custom_image_name
 
-    def deploy(self, dockerfiles: List[DockerFile]):
-        for df in dockerfiles:
-            tag = self.env.artifact_tag
-
-            repository = "/".join(
-                [
-                    _
-                    for _ in (self.docker_credentials.registry, df.prefix, self.application_name)
-                    if _ is not None
-                ]
-            )
-
-            if df.custom_image_name:
-                repository = df.custom_image_name
+        if df.postfix:
+            repository += df.postfix
 
-            if df.postfix:
-                repository += df.postfix
-
-            image_tag = f"{repository}:{tag}"
-            self.build_image(df.dockerfile, image_tag)
-            self.push_image(image_tag)
+        image_tag = f"{repository}:{tag}"
+        labels = {}
+        existing_image = None
+        if self.config["skip_unchanged_images"]:
+            digest = context_hash(df.dockerfile)
+            labels[CONTEXT_HASH_LABEL] = digest
+            existing_image = self._reusable_image(repository, digest)
 
+        if existing_image:
+            # the image is already in the registry, so it is only tagged there, without pulling or pushing
+            tags = [image_tag]
             if df.tag_release_as_latest and self.env.on_release_tag:
-                latest_tag = f"{repository}:latest"
-                # ensure that the latest tag is available for pushing
-                self.tag_image(image_tag, latest_tag)
-
-                self.push_image(latest_tag)
+                tags.append(f"{repository}:latest")
+            for new_tag in tags:
+                if new_tag != existing_image:
+                    self.registry.tag_image(existing_image, new_tag)
+            return
+
+        self.engine.build_image(
+            df.dockerfile,
+            image_tag,
+            output_prefix,
+            self._cache_sources(df, repository, output_prefix),
+            df.cache_to,
+            self.config["buildkit"],
+            labels,
+        )
+        self.engine.push_image(image_tag, output_prefix)
+
+        if df.tag_release_as_latest and self.env.on_release_tag:
+            latest_tag = f"{repository}:latest"
+            # ensure that the latest tag is available for pushing
+            self.engine.tag_image(image_tag, latest_tag, output_prefix)
+
+            self.engine.push_image(latest_tag, output_prefix)
@@ -1,4 +1,5 @@
 import logging
+import threading
 from enum import Enum, auto, unique
 from typing import Any, Dict
 
@@ -13,10 +14,14 @@ class ContextKey(Enum):
 
 class Singleton(type):
     _instances: Dict[Any, Any] = {}
+    _lock = threading.Lock()
 
     def __call__(cls, *args, **kwargs):
+        # steps run concurrently, the lock makes sure only one of them creates the instance
         if cls not in cls._instances:
-            cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
+            with Singleton._lock:
+                if cls not in cls._instances:
+                    cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
 
 
@@ -1,12 +1,37 @@
 import logging
 from typing import Callable, List
 
+import voluptuous as vol
+
 from takeoff.application_version import ApplicationVersion
+from takeoff.azure.credentials.keyvault import KeyVaultClient
+from takeoff.azure.credentials.providers.keyvault_secret_cache import KeyVaultSecretCache
+from takeoff.azure.management_clients import ManagementClients
 from takeoff.credentials.branch_name import BranchName
-from takeoff.util import get_tag, get_short_hash, get_full_yaml_filename, load_yaml, load_takeoff_plugins
+from takeoff.scheduler import plan_steps, run_steps, ScheduledStep, DEFAULT_MAX_PARALLEL_STEPS
+from takeoff.util import (
+    get_tag,
+    get_short_hash,
+    get_full_yaml_filename,
+    load_yaml,
+    find_takeoff_plugin_function,
+    refresh_takeoff_plugins,
+)
 
 logger = logging.getLogger(__name__)
 
+DEPLOYMENT_SCHEMA = vol.Schema(
+    {
+        vol.Required("steps"): [dict],
+        vol.Optional(
+            "max_parallel_steps",
+            description="The maximum number of steps running at the same time",
+            default=DEFAULT_MAX_PARALLEL_STEPS,
+        ): vol.All(int, vol.Range(min=1)),
+    },
+    extra=vol.ALLOW_EXTRA,
+)
+
 
 def deploy_env_logic(config: dict) -> ApplicationVersion:
     """Returns the version of this application based on provided Takeoff config.
@@ -35,10 +60,10 @@ def find_env_function() -> Callable:
     Returns:
         Either the default function or the first plugin function if it is found.
     """
-    for plugin in load_takeoff_plugins().values():
-        if hasattr(plugin, "deploy_env_logic"):
-            logging.info("Using plugin 'deploy_env_logic' function")
-            return plugin.deploy_env_logic
+    plugin_function = find_takeoff_plugin_function("deploy_env_logic")
+    if plugin_function:
+        logging.info("Using plugin 'deploy_env_logic' function")
+        return plugin_function
     logging.info("Using default 'deploy_env_logic' function")
     return deploy_env_logic
 
@@ -52,6 +77,8 @@ def add_takeoff_plugin_paths(dirs: List[str]):
     import sys
 
     sys.path.extend(dirs)
+    # the new paths may contain plugins that have not been discovered yet
+    refresh_takeoff_plugins()
 
 
 def main(takeoff_dir: str = ".takeoff"):
@@ -66,7 +93,7 @@ def main(takeoff_dir: str = ".takeoff"):
     """  # noqa: W605
     )
     logger.info(f"Loading Takeoff configuration from {takeoff_dir}")
-    deployment = load_yaml(get_full_yaml_filename("deployment", takeoff_dir))
+    deployment = DEPLOYMENT_SCHEMA(load_yaml(get_full_yaml_filename("deployment", takeoff_dir)))
     config = load_yaml(get_full_yaml_filename("config", takeoff_dir))
     if "plugins" in config:
         paths = config["plugins"]
@@ -76,12 +103,18 @@ def main(takeoff_dir: str = ".takeoff"):
     env = get_environment(config)
     logger.info(f"Running Takeoff with application version: {env}")
 
-    for task_config in deployment["steps"]:
-        task = task_config["task"]
+    # secrets and clients are shared between all steps of this run, but never between runs
+    KeyVaultSecretCache().invalidate()
+    KeyVaultClient.clear()
+    ManagementClients().clear()
+
+    def run_step(step: ScheduledStep):
         logger.info("*" * 76)
-        logger.info("{:10s} {:13s} {:40s} {:10s}".format("*" * 10, "RUNNING TASK:", task, "*" * 10))
+        logger.info("{:10s} {:13s} {:40s} {:10s}".format("*" * 10, "RUNNING TASK:", step.name, "*" * 10))
         logger.info("*" * 76)
-        run_task(env, task, {**task_config, **config})
+        return run_task(env, step.task, {**step.config, **config})
+
+    run_steps(plan_steps(deployment["steps"]), run_step, deployment["max_parallel_steps"])
 
 
 def run_task(env: ApplicationVersion, task: str, task_config: dict):
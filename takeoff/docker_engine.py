@@ -0,0 +1,385 @@
+import abc
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Optional, Sequence
+
+import docker
+from docker.errors import APIError
+from docker.utils import parse_repository_tag
+
+from takeoff.credentials.container_registry import DockerCredentials
+from takeoff.util import STREAMED_OUTPUT_LINES, run_shell_command
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class LayerPush(object):
+    layer_id: str
+    status: str = "Waiting"
+    bytes_pushed: int = 0
+    started: Optional[float] = None
+    finished: Optional[float] = None
+
+    @property
+    def seconds(self) -> float:
+        if self.started is None or self.finished is None:
+            return 0.0
+        return self.finished - self.started
+
+
+@dataclass
+class PushReport(object):
+    tag: str
+    seconds: float = 0.0
+    digest: Optional[str] = None
+    layers: Dict[str, LayerPush] = field(default_factory=dict)
+
+    @property
+    def bytes_pushed(self) -> int:
+        return sum(_.bytes_pushed for _ in self.layers.values())
+
+
+class DockerEngine(object):
+    """Builds, tags, pushes and pulls docker images, either through the docker-cli or the Docker Engine API"""
+
+    @abc.abstractmethod
+    def build_image(
+        self,
+        docker_file: str,
+        tag: str,
+        output_prefix: str = "",
+        cache_from: Sequence[str] = (),
+        cache_to: Optional[str] = None,
+        buildkit: bool = False,
+        labels: Optional[Dict[str, str]] = None,
+    ):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def tag_image(self, old_tag: str, new_tag: str, output_prefix: str = ""):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def push_image(self, tag: str, output_prefix: str = ""):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def pull_image(self, tag: str, output_prefix: str = "") -> bool:
+        raise NotImplementedError
+
+
+class DockerCliEngine(DockerEngine):
+    """Builds, tags and pushes docker images with the docker-cli
+
+    Depends on:
+    - The docker-cli must be available
+    """
+
+    @staticmethod
+    def build_image(
+        docker_file: str,
+        tag: str,
+        output_prefix: str = "",
+        cache_from: Sequence[str] = (),
+        cache_to: Optional[str] = None,
+        buildkit: bool = False,
+        labels: Optional[Dict[str, str]] = None,
+    ):
+        """Build the docker image
+
+        This uses bash to run commands directly. Exporting a cache with `cache_to` requires
+        docker buildx, the image is then loaded into the local docker daemon to be pushed.
+
+        Args:
+            docker_file: The name of the dockerfile to build
+            tag: The docker tag to apply to the image name
+            output_prefix: Prefixed to every line of output of the docker cli
+            cache_from: External cache sources
+            cache_to: Cache export destination
+            buildkit: Whether to build with BuildKit. Always true when exporting a cache.
+            labels: Labels to add to the image
+        """
+        buildkit = buildkit or cache_to is not None
+        cmd = ["docker", "buildx", "build"] if cache_to else ["docker", "build"]
+        cmd += ["--build-arg", f"PIP_EXTRA_INDEX_URL={os.getenv('PIP_EXTRA_INDEX_URL')}"]
+        if buildkit:
+            # embeds the cache metadata in the image, so the pushed image can serve as cache source
+            cmd += ["--build-arg", "BUILDKIT_INLINE_CACHE=1"]
+        for source in cache_from:
+            cmd += ["--cache-from", source]
+        for key, value in (labels or {}).items():
+            cmd += ["--label", f"{key}={value}"]
+        if cache_to:
+            cmd += ["--cache-to", cache_to, "--load"]
+        cmd += ["-t", tag, "-f", f"./{docker_file}", "."]
+
+        logger.info(f"Building docker image for {docker_file} with command \n{' '.join(cmd)}")
+
+        env = {"DOCKER_BUILDKIT": "1"} if buildkit else None
+        return_code, _ = run_shell_command(
+            cmd, output_prefix=output_prefix, env=env, max_output_lines=STREAMED_OUTPUT_LINES
+        )
+
+        if return_code != 0:
+            raise ChildProcessError(f"Could not build the image {tag} for some reason!")
+
+    @staticmethod
+    def tag_image(old_tag: str, new_tag: str, output_prefix: str = ""):
+        """Tag a docker tag with a new tag
+
+        This uses bash to run commands directly.
+
+        Args:
+            old_tag: The existing docker tag
+            new_tag: The new docker tag
+            output_prefix: Prefixed to every line of output of the docker cli
+        """
+        cmd = ["docker", "tag", old_tag, new_tag]
+
+        logger.info(f"Tagging {old_tag} as {new_tag}")
+
+        return_code, _ = run_shell_command(
+            cmd, output_prefix=output_prefix, max_output_lines=STREAMED_OUTPUT_LINES
+        )
+
+        if return_code != 0:
+            raise ChildProcessError(f"Could not tag image {old_tag} as {new_tag} for some reason!")
+
+    @staticmethod
+    def push_image(tag: str, output_prefix: str = ""):
+        """Push the docker image
+
+        This uses bash to run commands directly.
+
+        Args:
+            tag: The docker tag to upload
+            output_prefix: Prefixed to every line of output of the docker cli
+        """
+        cmd = ["docker", "push", tag]
+
+        logger.info(f"Uploading docker image {tag}")
+
+        return_code, _ = run_shell_command(
+            cmd, output_prefix=output_prefix, max_output_lines=STREAMED_OUTPUT_LINES
+        )
+
+        if return_code != 0:
+            raise ChildProcessError(f"Could not push image {tag} for some reason!")
+
+    @staticmethod
+    def pull_image(tag: str, output_prefix: str = "") -> bool:
+        """Pull a docker image
+
+        This uses bash to run commands directly.
+
+        Args:
+            tag: The docker tag to download
+            output_prefix: Prefixed to every line of output of the docker cli
+
+        Returns:
+            Whether the image could be pulled
+        """
+        cmd = ["docker", "pull", tag]
+
+        logger.info(f"Downloading docker image {tag}")
+
+        return_code, _ = run_shell_command(
+            cmd, output_prefix=output_prefix, max_output_lines=STREAMED_OUTPUT_LINES
+        )
+
+        if return_code != 0:
+            logger.warning(f"Could not pull image {tag}")
+        return return_code == 0
+
+
+class DockerSdkEngine(DockerEngine):
+    """Builds, tags and pushes docker images through the Docker Engine API
+
+    As opposed to the docker-cli, a single API connection is reused for all operations. The docker
+    daemon pushes layers concurrently, progress of every layer is reported as structured events
+    from which the pushed bytes and timings per layer are collected.
+
+    Depends on:
+    - The docker daemon must be reachable, by default through `DOCKER_HOST` or the local socket
+    """
+
+    def __init__(self, credentials: DockerCredentials, client: Optional[docker.APIClient] = None):
+        self.credentials = credentials
+        self.client = client or docker.from_env().api
+
+    @property
+    def auth_config(self) -> Dict[str, str]:
+        return {
+            "username": self.credentials.username,
+            "password": self.credentials.password,
+            "serveraddress": self.credentials.registry,
+        }
+
+    def build_image(
+        self,
+        docker_file: str,
+        tag: str,
+        output_prefix: str = "",
+        cache_from: Sequence[str] = (),
+        cache_to: Optional[str] = None,
+        buildkit: bool = False,
+        labels: Optional[Dict[str, str]] = None,
+    ):
+        """Build the docker image
+
+        Args:
+            docker_file: The name of the dockerfile to build
+            tag: The docker tag to apply to the image name
+            output_prefix: Prefixed to every line of build output
+            cache_from: Images to use as cache source
+            cache_to: Not supported by the Docker Engine API
+            buildkit: Not supported by the Docker Engine API
+            labels: Labels to add to the image
+
+        Raises:
+            ValueError if BuildKit or a cache export is requested
+            ChildProcessError if the image could not be built
+        """
+        if buildkit or cache_to:
+            raise ValueError("BuildKit and cache exports are only supported by the 'cli' engine")
+
+        logger.info(f"Building docker image for {docker_file} as {tag}")
+        events = self.client.build(
+            path=".",
+            dockerfile=docker_file,
+            tag=tag,
+            buildargs={"PIP_EXTRA_INDEX_URL": str(os.getenv("PIP_EXTRA_INDEX_URL"))},
+            cache_from=list(cache_from) or None,
+            labels=labels or None,
+            rm=True,
+            decode=True,
+        )
+        self._follow_build(events, tag, output_prefix)
+
+    @staticmethod
+    def _follow_build(events: Iterable[dict], tag: str, output_prefix: str) -> Optional[str]:
+        """Streams the build output
+
+        Returns:
+            The id of the built image
+
+        Raises:
+            ChildProcessError if the build reported an error
+        """
+        image_id = None
+        for event in events:
+            if "error" in event:
+                raise ChildProcessError(f"Could not build the image {tag}: {event['error'].strip()}")
+            if "stream" in event and event["stream"].strip():
+                print(f"{output_prefix}{event['stream'].rstrip()}")
+            if "aux" in event and "ID" in event["aux"]:
+                image_id = event["aux"]["ID"]
+        logger.info(f"Built image {tag} with id {image_id}")
+        return image_id
+
+    def tag_image(self, old_tag: str, new_tag: str, output_prefix: str = ""):
+        """Tag a docker tag with a new tag
+
+        Args:
+            old_tag: The existing docker tag
+            new_tag: The new docker tag
+            output_prefix: Not used, tagging has no output
+
+        Raises:
+            ChildProcessError if the image could not be tagged
+        """
+        logger.info(f"Tagging {old_tag} as {new_tag}")
+        repository, tag = parse_repository_tag(new_tag)
+        try:
+            tagged = self.client.tag(old_tag, repository, tag)
+        except APIError as e:
+            raise ChildProcessError(f"Could not tag image {old_tag} as {new_tag}: {e}")
+        if not tagged:
+            raise ChildProcessError(f"Could not tag image {old_tag} as {new_tag} for some reason!")
+
+    def push_image(self, tag: str, output_prefix: str = "") -> PushReport:
+        """Push the docker image and report how long pushing each layer took
+
+        Args:
+            tag: The docker tag to upload
+            output_prefix: Prefixed to every line of push output
+
+        Returns:
+            The pushed bytes and timings of every layer
+
+        Raises:
+            ChildProcessError if the image could not be pushed
+        """
+        logger.info(f"Uploading docker image {tag}")
+        repository, image_tag = parse_repository_tag(tag)
+        started = time.monotonic()
+        events = self.client.push(
+            repository, tag=image_tag, stream=True, decode=True, auth_config=self.auth_config
+        )
+        report = self._follow_push(events, tag)
+        report.seconds = time.monotonic() - started
+
+        self._log_push_report(report, output_prefix)
+        return report
+
+    @staticmethod
+    def _follow_push(events: Iterable[dict], tag: str) -> PushReport:
+        """Collects the progress of every layer from the push events
+
+        Raises:
+            ChildProcessError if the push reported an error
+        """
+        report = PushReport(tag)
+        for event in events:
+            now = time.monotonic()
+            if "error" in event:
+                raise ChildProcessError(f"Could not push image {tag}: {event['error'].strip()}")
+            if "aux" in event and "Digest" in event["aux"]:
+                report.digest = event["aux"]["Digest"]
+            if "id" not in event or "status" not in event:
+                continue
+
+            layer = report.layers.setdefault(event["id"], LayerPush(event["id"]))
+            layer.status = event["status"]
+            if event["status"] == "Pushing":
+                layer.started = layer.started or now
+                layer.bytes_pushed = max(
+                    layer.bytes_pushed, event.get("progressDetail", {}).get("current", 0)
+                )
+            elif event["status"] == "Pushed":
+                layer.finished = now
+        return report
+
+    @staticmethod
+    def _log_push_report(report: PushReport, output_prefix: str):
+        for layer in report.layers.values():
+            print(
+                f"{output_prefix}{layer.layer_id}: {layer.status}, "
+                f"{layer.bytes_pushed} bytes in {layer.seconds:.1f} seconds"
+            )
+        logger.info(
+            f"Pushed {report.tag} ({report.digest}): {report.bytes_pushed} bytes in "
+            f"{len(report.layers)} layers in {report.seconds:.1f} seconds"
+        )
+
+    def pull_image(self, tag: str, output_prefix: str = "") -> bool:
+        """Pull a docker image
+
+        Args:
+            tag: The docker tag to download
+            output_prefix: Not used, pull progress is not streamed
+
+        Returns:
+            Whether the image could be pulled
+        """
+        logger.info(f"Downloading docker image {tag}")
+        repository, image_tag = parse_repository_tag(tag)
+        try:
+            self.client.pull(repository, tag=image_tag, auth_config=self.auth_config)
+        except APIError as e:
+            logger.warning(f"Could not pull image {tag}: {e}")
+            return False
+        return True
@@ -0,0 +1,179 @@
+import json
+import logging
+import re
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import requests
+from docker.auth import resolve_repository_name
+from docker.utils import parse_repository_tag
+
+from takeoff.credentials.container_registry import DockerCredentials
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_LIST_TYPES = [
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.index.v1+json",
+]
+MANIFEST_TYPES = [
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+] + MANIFEST_LIST_TYPES
+
+
+@dataclass(frozen=True)
+class Manifest(object):
+    media_type: str
+    content: bytes
+
+    @property
+    def json(self) -> dict:
+        return json.loads(self.content)
+
+
+class RegistryClient(object):
+    """Reads and tags images in a docker registry through the Docker Registry HTTP API V2
+
+    Only manifests and image configs are downloaded, which are a few kilobytes, so the labels of an image
+    can be read without pulling its layers. Tagging an image puts its manifest under the new tag, the
+    layers it refers to are already in the repository.
+
+    The credentials are used for the registry they belong to, other registries are accessed anonymously.
+    """
+
+    def __init__(self, credentials: DockerCredentials, session: Optional[requests.Session] = None):
+        self.credentials = credentials
+        self.session = session or requests.Session()
+        self.__registry = self._resolve(f"{credentials.registry}/_")[0]
+        self.__tokens: Dict[Tuple[str, str], str] = {}
+
+    @staticmethod
+    def _resolve(image: str) -> Tuple[str, str, str]:
+        """Splits an image into the host of its registry, its repository and its tag"""
+        repository, tag = parse_repository_tag(image)
+        registry, name = resolve_repository_name(repository)
+        if registry == "docker.io":
+            registry = "registry-1.docker.io"
+            if "/" not in name:
+                name = f"library/{name}"
+        return registry, name, tag or "latest"
+
+    def _basic_auth(self, registry: str) -> Optional[Tuple[str, str]]:
+        if registry != self.__registry:
+            return None
+        return self.credentials.username, self.credentials.password
+
+    def _request(self, method: str, registry: str, name: str, path: str, **kwargs) -> requests.Response:
+        """Sends a request to the registry, exchanging the credentials for a token when it asks for one"""
+        url = f"https://{registry}/v2/{name}/{path}"
+        headers = kwargs.pop("headers", {})
+        token = self.__tokens.get((registry, name))
+        if token:
+            response = self.session.request(
+                method, url, headers={**headers, "Authorization": f"Bearer {token}"}, **kwargs
+            )
+        else:
+            response = self.session.request(
+                method, url, headers=headers, auth=self._basic_auth(registry), **kwargs
+            )
+
+        challenge = response.headers.get("WWW-Authenticate", "")
+        if response.status_code == 401 and challenge.lower().startswith("bearer "):
+            token = self._token(challenge, registry, name)
+            self.__tokens[(registry, name)] = token
+            response = self.session.request(
+                method, url, headers={**headers, "Authorization": f"Bearer {token}"}, **kwargs
+            )
+        return response
+
+    def _token(self, challenge: str, registry: str, name: str) -> str:
+        """Requests a token for the repository from the authorization service named in the challenge"""
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        response = self.session.get(
+            params.pop("realm"),
+            params={**params, "scope": f"repository:{name}:pull,push"},
+            auth=self._basic_auth(registry),
+        )
+        response.raise_for_status()
+        body = response.json()
+        return body.get("token") or body["access_token"]
+
+    def _manifest(self, registry: str, name: str, reference: str) -> Optional[Manifest]:
+        response = self._request(
+            "GET", registry, name, f"manifests/{reference}", headers={"Accept": ", ".join(MANIFEST_TYPES)}
+        )
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return Manifest(response.headers["Content-Type"].split(";")[0], response.content)
+
+    def image_label(self, image: str, label: str) -> Optional[str]:
+        """Reads a label from the config of an image in the registry
+
+        For a multi-platform image, the config of the first platform is read. All platforms are built
+        from the same docker file and build context.
+
+        Args:
+            image: The image, including its tag
+            label: The name of the label
+
+        Returns:
+            The value of the label, or None if the image or the label does not exist
+
+        Raises:
+            requests.HTTPError if the registry could not be read
+        """
+        registry, name, reference = self._resolve(image)
+        manifest = self._manifest(registry, name, reference)
+        if manifest is None:
+            return None
+        if manifest.media_type in MANIFEST_LIST_TYPES:
+            # buildx adds attestations as manifests of an unknown platform, they have no image config
+            platforms = [
+                _
+                for _ in manifest.json["manifests"]
+                if _.get("platform", {}).get("os", "unknown") != "unknown"
+            ]
+            if not platforms:
+                return None
+            manifest = self._manifest(registry, name, platforms[0]["digest"])
+            if manifest is None:
+                return None
+
+        response = self._request("GET", registry, name, f"blobs/{manifest.json['config']['digest']}")
+        response.raise_for_status()
+        return (response.json().get("config", {}).get("Labels") or {}).get(label)
+
+    def tag_image(self, old_tag: str, new_tag: str):
+        """Tags an image in the registry by putting its manifest under the new tag
+
+        Args:
+            old_tag: The existing image
+            new_tag: The new tag, in the same repository
+
+        Raises:
+            ValueError if the tags are in different repositories
+            ChildProcessError if the image could not be tagged
+        """
+        registry, name, reference = self._resolve(old_tag)
+        new_registry, new_name, new_reference = self._resolve(new_tag)
+        if (registry, name) != (new_registry, new_name):
+            raise ValueError(f"Can not tag {old_tag} as {new_tag} in another repository")
+
+        logger.info(f"Tagging {old_tag} as {new_tag} in the registry")
+        try:
+            manifest = self._manifest(registry, name, reference)
+            if manifest is None:
+                raise ChildProcessError(f"Could not tag image {old_tag}, it does not exist")
+            response = self._request(
+                "PUT",
+                registry,
+                name,
+                f"manifests/{new_reference}",
+                headers={"Content-Type": manifest.media_type},
+                data=manifest.content,
+            )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise ChildProcessError(f"Could not tag image {old_tag} as {new_tag}: {e}")
@@ -0,0 +1,127 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, Future
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, FrozenSet, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_PARALLEL_STEPS = 4
+
+
+@dataclass(frozen=True)
+class ScheduledStep(object):
+    index: int
+    name: str
+    config: dict
+    depends_on: FrozenSet[int]
+
+    @property
+    def task(self) -> str:
+        return self.config["task"]
+
+
+def _context_keys(task: str) -> Tuple[FrozenSet, FrozenSet]:
+    """Returns the Context keys produced and consumed by the step that runs the given task"""
+    from takeoff.steps import steps
+
+    step = steps.get(task)
+    if step is None:
+        return frozenset(), frozenset()
+    return step.produces, step.consumes
+
+
+def plan_steps(step_configs: List[dict]) -> List[ScheduledStep]:
+    """Determines the dependencies between all steps in `.takeoff/deployment.yml`
+
+    A step without `depends_on` depends on all steps before it, which means all steps run in order by
+    default. A step with `depends_on` only waits for the steps it names. Steps can be named with the
+    optional `name` field, otherwise the name of the task is used. Regardless of `depends_on`, a step
+    that consumes a `ContextKey` always waits for all preceding steps that produce it.
+
+    Args:
+        step_configs: The configuration of all steps, in order
+
+    Returns:
+        All steps and their dependencies, in order
+
+    Raises:
+        ValueError if a step depends on an unknown step or the steps depend on each other in a cycle
+    """
+    names: Dict[str, List[int]] = {}
+    for i, config in enumerate(step_configs):
+        names.setdefault(config.get("name", config["task"]), []).append(i)
+
+    planned = []
+    for i, config in enumerate(step_configs):
+        name = config.get("name", config["task"])
+        if "depends_on" in config:
+            unknown = [_ for _ in config["depends_on"] if _ not in names]
+            if unknown:
+                raise ValueError(f"Step {name} depends on unknown steps {unknown}")
+            depends_on = {j for _ in config["depends_on"] for j in names[_] if j != i}
+        else:
+            depends_on = set(range(i))
+
+        _, consumes = _context_keys(config["task"])
+        depends_on |= {
+            j for j, other in enumerate(step_configs[:i]) if consumes & _context_keys(other["task"])[0]
+        }
+        planned.append(ScheduledStep(i, name, config, frozenset(depends_on)))
+
+    _check_acyclic(planned)
+    return planned
+
+
+def _check_acyclic(steps: List[ScheduledStep]):
+    done: set = set()
+    remaining = list(steps)
+    while remaining:
+        ready = [_ for _ in remaining if _.depends_on <= done]
+        if not ready:
+            raise ValueError(f"Steps {[_.name for _ in remaining]} depend on each other in a cycle")
+        done |= {_.index for _ in ready}
+        remaining = [_ for _ in remaining if _.index not in done]
+
+
+def run_steps(steps: List[ScheduledStep], run: Callable[[ScheduledStep], Any], max_workers: int = 1):
+    """Runs all steps as soon as their dependencies have finished, at most `max_workers` at a time.
+
+    As soon as a step fails no new steps are started. Steps that are already running are allowed
+    to finish.
+
+    Args:
+        steps: The planned steps, see `plan_steps`
+        run: Runs a single step
+        max_workers: The maximum number of steps to run concurrently
+
+    Raises:
+        The exception of the first step that failed
+    """
+    pending = list(steps)
+    running: Dict[Future, ScheduledStep] = {}
+    done: set = set()
+    failed: List[Tuple[ScheduledStep, BaseException]] = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if not failed:
+                for step in [_ for _ in pending if _.depends_on <= done][: max_workers - len(running)]:
+                    pending.remove(step)
+                    running[executor.submit(run, step)] = step
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                e = future.exception()
+                if e is not None:
+                    logger.error(f"Step {step.name} failed: {e}")
+                    failed.append((step, e))
+                else:
+                    done.add(step.index)
+
+    if failed:
+        if pending:
+            logger.error(f"Not running steps {[_.name for _ in pending]} because of failed steps")
+        raise failed[0][1]
@@ -113,6 +113,11 @@ AZURE_SCHEMA = {
     ): str,
     vol.Optional("location", default="west europe"): str,
     vol.Optional("keyvault_keys"): AZURE_KEYVAULT_KEYS_SCHEMA,
+    vol.Optional(
+        "keyvault_max_workers",
+        default=1,
+        description="The number of secrets that are fetched concurrently from the KeyVault",
+    ): vol.All(int, vol.Range(min=1)),
     vol.Optional("common"): AZURE_COMMON,
 }
 
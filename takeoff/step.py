@@ -1,11 +1,13 @@
 import abc
 import logging
 import pprint
+from typing import FrozenSet
 
 import voluptuous as vol
 
 from takeoff.application_version import ApplicationVersion
 from takeoff.azure.credentials.keyvault import KeyVaultClient
+from takeoff.context import ContextKey
 from takeoff.credentials.application_name import ApplicationName
 
 logger = logging.getLogger(__name__)
@@ -17,8 +19,15 @@ class Step(object):
     Inheriting from this class will allow the user to create a new Step that will validate the schema
     and expose the `run` function. After inheriting this, add the new class to `steps.py`. This will
     enable Takeoff to pick it up from the `.takeoff/deployment.yml`.
+
+    Steps that store values in the `Context` must list their keys in `produces`, steps that read
+    values from the `Context` must list them in `consumes`. Takeoff uses these to never run a step
+    concurrently with the steps it depends on.
     """
 
+    produces: FrozenSet[ContextKey] = frozenset()
+    consumes: FrozenSet[ContextKey] = frozenset()
+
     def __init__(self, env: ApplicationVersion, config: dict):
         self.env = env
         self.config = self.validate(config)
@@ -1,11 +1,35 @@
 import base64
 import importlib
+import json
 import logging
 import os
 import pkgutil
 import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass
-from typing import Callable, List, Pattern, Union, Tuple, Optional, Any
+from types import ModuleType
+from typing import (
+    IO,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Pattern,
+    TextIO,
+    Union,
+    Tuple,
+    Optional,
+    Any,
+    Generic,
+    Hashable,
+    Sequence,
+    Set,
+    TypeVar,
+)
 
 import jinja2
 from git import Repo
@@ -13,9 +37,26 @@ from yaml import load, SafeLoader
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
 
 DEFAULT_TAKEOFF_PLUGIN_PREFIX = "takeoff_"
 
+# Process wide plugin registry, indexed on plugin prefix. Discovery is done once, see `load_takeoff_plugins`
+_takeoff_plugins: Dict[str, Dict[str, ModuleType]] = {}
+_takeoff_plugin_functions: Dict[Tuple[str, str], Optional[Callable]] = {}
+_takeoff_plugins_lock = threading.RLock()
+
+DEFAULT_SHORT_HASH_LENGTH = 7
+
+# The lines of output kept of commands whose output is only streamed, e.g. builds and uploads
+STREAMED_OUTPUT_LINES = 10
+
+# Process wide snapshot of the git repository, see `git_metadata`
+_git_metadata: Optional["GitMetadata"] = None
+_git_metadata_lock = threading.Lock()
+
 
 @dataclass(frozen=True)
 class AzureSp(object):
@@ -57,15 +98,51 @@ def render_file_with_jinja(path: str, params: dict, parse_function: Callable) ->
     return parse_function(rendered)
 
 
+@dataclass(frozen=True)
+class GitMetadata(object):
+    tag: Optional[str]
+    hexsha: str
+    short_hash: str
+
+
+def git_metadata() -> GitMetadata:
+    """Returns the tag and hash of the commit that is deployed
+
+    The repository is inspected only once per process. Call `refresh_git_metadata` when HEAD changes.
+
+    Returns:
+        The tag pointing at HEAD, if any, and the hash of HEAD
+    """
+    global _git_metadata
+    with _git_metadata_lock:
+        if _git_metadata is None:
+            repo = Repo(search_parent_directories=True)
+            # asks git for the tags of HEAD directly, instead of resolving the commit of every tag
+            tags = repo.git.tag("--points-at", "HEAD").splitlines()
+            hexsha = repo.head.object.hexsha
+            _git_metadata = GitMetadata(
+                tags[0] if tags else None, hexsha, repo.git.rev_parse(hexsha, short=DEFAULT_SHORT_HASH_LENGTH)
+            )
+            logger.info(f"Resolved git metadata {_git_metadata}")
+        return _git_metadata
+
+
+def refresh_git_metadata():
+    """Drops the git metadata, so the repository is inspected again on next use"""
+    global _git_metadata
+    with _git_metadata_lock:
+        _git_metadata = None
+
+
 def get_tag() -> Union[None, str]:
-    repo = Repo(search_parent_directories=True)
-    return next((tag for tag in repo.tags if tag.commit == repo.head.commit), None)
+    return git_metadata().tag
 
 
-def get_short_hash(n: int = 7) -> str:
+def get_short_hash(n: int = DEFAULT_SHORT_HASH_LENGTH) -> str:
+    if n == DEFAULT_SHORT_HASH_LENGTH:
+        return git_metadata().short_hash
     repo = Repo(search_parent_directories=True)
-    sha = repo.head.object.hexsha
-    return repo.git.rev_parse(sha, short=n)
+    return repo.git.rev_parse(git_metadata().hexsha, short=n)
 
 
 def b64_encode(s: str) -> str:
@@ -153,6 +230,25 @@ def load_yaml(path: str) -> dict:
     return load(config_file, Loader=SafeLoader)
 
 
+def write_json_atomically(path: str, data: Any, mode: int = 0o666):
+    """Writes data to a json file, creating its directory if needed
+
+    The data is written to a temporary file that replaces the file, so the previous version of the file is
+    kept intact if writing is interrupted.
+
+    Args:
+        path: The file to write
+        data: The data to serialize
+        mode: The permissions of the file, restricted further by the umask
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(f"{path}.tmp", "w", opener=lambda _, flags: os.open(_, flags, mode)) as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+    os.replace(f"{path}.tmp", path)
+
+
 def current_filename(__fn):
     return os.path.basename(__fn).split(".")[0]
 
@@ -205,32 +301,287 @@ def get_jar_name(build_definition_name: str, artifact_tag: str, file_ext: str) -
     return f"{build_definition_name}/{build_definition_name}-{artifact_tag}{file_ext}"
 
 
-def run_shell_command(command: List[str]) -> Tuple[Optional[int], List[Union[str, Any]]]:
-    """Runs a shell command using `subprocess.Popen`
+@dataclass(frozen=True)
+class CommandResult(object):
+    command: List[str]
+    exit_code: Optional[int]
+    duration: float
+    stdout: List[str]
+    stderr: List[str]
+    timed_out: bool = False
+
+
+def _stream_output(stream: IO[str], target: TextIO, output_prefix: str, lines: Deque[str]):
+    """Reads all lines from a process stream, echoing them to `target`"""
+    for line in iter(stream.readline, ""):
+        print(f"{output_prefix}{line.rstrip()}", file=target)
+        lines.append(line)
+    stream.close()
+
+
+def run_command(
+    command: List[str],
+    output_prefix: str = "",
+    env: Optional[Dict[str, str]] = None,
+    timeout: Optional[float] = None,
+    max_output_lines: Optional[int] = None,
+) -> CommandResult:
+    """Runs a command using `subprocess.Popen`, streaming its stdout and stderr while it runs
+
+    Both streams are read on their own thread, so a process never blocks on a full pipe and many
+    processes can run concurrently. When the timeout expires, the process is killed.
+
+    Args:
+        command: The command and its arguments
+        output_prefix: Prefixed to every line of output streamed to stdout and stderr, to tell apart the
+                       output of commands that run concurrently
+        env: Environment variables set for the command, in addition to the current environment
+        timeout: The maximum wall-clock time in seconds the command is allowed to run
+        max_output_lines: Only keep the last lines of every stream, instead of all output
+
+    Returns:
+        The exit code, duration and (the last lines of) the output of the command
+    """
+    started = time.monotonic()
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd="./",
+        universal_newlines=True,
+        env={**os.environ, **env} if env else None,
+    )
+    stdout: Deque[str] = deque(maxlen=max_output_lines)
+    stderr: Deque[str] = deque(maxlen=max_output_lines)
+    readers = [
+        threading.Thread(target=_stream_output, args=(process.stdout, sys.stdout, output_prefix, stdout)),
+        threading.Thread(target=_stream_output, args=(process.stderr, sys.stderr, output_prefix, stderr)),
+    ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    timed_out = False
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        logger.error(f"Command {' '.join(command)} did not finish within {timeout} seconds, killing it")
+        timed_out = True
+        process.kill()
+        process.wait()
+    for reader in readers:
+        # processes started by a killed process may keep the pipes open, don't wait for them forever
+        reader.join(timeout=5 if timed_out else None)
+
+    return CommandResult(
+        command, process.returncode, time.monotonic() - started, list(stdout), list(stderr), timed_out
+    )
+
+
+def run_shell_command(
+    command: List[str],
+    output_prefix: str = "",
+    env: Optional[Dict[str, str]] = None,
+    timeout: Optional[float] = None,
+    max_output_lines: Optional[int] = None,
+) -> Tuple[Optional[int], List[Union[str, Any]]]:
+    """Runs a shell command, see `run_command`
 
     In addition to running any bash command, the output of process is streamed directly to the stdout.
 
+    Args:
+        command: The command and its arguments
+        output_prefix: Prefixed to every line of output streamed to stdout, to tell apart the output
+                       of commands that run concurrently
+        env: Environment variables set for the command, in addition to the current environment
+        timeout: The maximum wall-clock time in seconds the command is allowed to run
+        max_output_lines: Only keep the last lines of output, e.g. `STREAMED_OUTPUT_LINES` when the
+                          output is not used
+
+    Returns:
+        The result of the bash command. 0 for success, >=1 for failure. A command that was killed
+        because of the timeout has a negative result.
+    """
+    result = run_command(command, output_prefix, env, timeout, max_output_lines)
+    return result.exit_code, result.stdout
+
+
+def _submit(
+    executor: ThreadPoolExecutor, fn: Callable[[Any], T], items: Sequence[Any], workers: int, fail_fast: bool
+) -> List[Future]:
+    """Submits the items to the executor, with `fail_fast` only once a worker is free and nothing failed"""
+    futures: List[Future] = []
+    running: Set[Future] = set()
+    for item in items:
+        if fail_fast and len(running) == workers:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            if any(_.exception() for _ in done):
+                break
+        future = executor.submit(fn, item)
+        futures.append(future)
+        running.add(future)
+    return futures
+
+
+def run_concurrently(
+    fn: Callable[[Any], T],
+    items: Sequence[Any],
+    max_workers: int,
+    action: str,
+    description: str,
+    name: Callable[[Any], str] = str,
+    fail_fast: bool = False,
+) -> List[T]:
+    """Applies a function to all items, at most `max_workers` at a time
+
+    By default every item is processed, also when processing other items fails. All failures are logged
+    and raised together once all items are done.
+
+    With `fail_fast`, no more items are started after the first failure. The items that are already
+    being processed are finished, and the first failure is raised as is. A single worker always fails
+    fast, so items processed one after another stop at the first failure, like a plain loop would.
+
+    Args:
+        fn: The function to apply
+        items: The items to apply the function to
+        max_workers: The maximum number of items processed at the same time
+        action: What the function does, used in error messages, e.g. "configure"
+        description: Describes the items, used in error messages, e.g. "consumer groups"
+        name: Names an item in error messages
+        fail_fast: Whether to stop starting items after the first failure
+
+    Returns:
+        The results, in the order of the items
+
+    Raises:
+        RuntimeError listing every item that failed, caused by the first failure. With `fail_fast`,
+        the first failure itself.
+    """
+    if not items:
+        return []
+    workers = max(1, min(max_workers, len(items)))
+    fail_fast = fail_fast or workers == 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = _submit(executor, fn, items, workers, fail_fast)
+
+    failures: List[Tuple[Any, BaseException]] = []
+    for item, future in zip(items, futures):
+        e = future.exception()
+        if e is not None:
+            failures.append((item, e))
+    for item, e in failures:
+        logger.error(f"Could not {action} {name(item)}: {e}")
+    if failures and fail_fast:
+        skipped = len(items) - len(futures)
+        if skipped:
+            logger.error(f"Skipped {skipped} of {len(items)} {description} after the first failure")
+        raise failures[0][1]
+    if failures:
+        report = "\n".join(f"- {name(item)}: {e}" for item, e in failures)
+        raise RuntimeError(
+            f"Could not {action} {len(failures)} of {len(items)} {description}:\n{report}"
+        ) from failures[0][1]
+    return [_.result() for _ in futures]
+
+
+class KeyedCache(Generic[K, V]):
+    """Thread safe cache that creates the value of every key at most once
+
+    Every key has its own lock, so creating the value of one key does not block requests for other keys,
+    and concurrent requests for the same key wait for a single creation.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__key_locks: Dict[K, threading.Lock] = {}
+        self.__values: Dict[K, V] = {}
+
+    def get_or_create(self, key: K, create: Callable[[], V]) -> V:
+        """Returns the value of a key, creating it on first use
+
+        Args:
+            key: The key of the value
+            create: Creates the value, called at most once per key
+
+        Returns:
+            The value of the key
+        """
+        with self.__lock:
+            key_lock = self.__key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.__lock:
+                if key in self.__values:
+                    return self.__values[key]
+            value = create()
+            with self.__lock:
+                self.__values[key] = value
+            return value
+
+    def clear(self, matches: Optional[Callable[[K], bool]] = None) -> List[V]:
+        """Drops cached values, so they are created again on next use
+
+        Args:
+            matches: Selects the keys to drop. If not provided all values are dropped.
+
+        Returns:
+            The dropped values
+        """
+        with self.__lock:
+            keys = [_ for _ in self.__values if matches is None or matches(_)]
+            return [self.__values.pop(_) for _ in keys]
+
+
+def load_takeoff_plugins() -> Dict[str, ModuleType]:
+    """Discovers and imports all Takeoff plugins on the python path.
+
+    https://packaging.python.org/guides/creating-and-discovering-plugins/
+
+    Scanning the python path is expensive, so discovery happens only once per process. Call
+    `refresh_takeoff_plugins` whenever the python path is extended.
+
+    Returns:
+        A mapping of plugin module name to the imported plugin module
+    """
+    prefix = DEFAULT_TAKEOFF_PLUGIN_PREFIX
+    with _takeoff_plugins_lock:
+        if prefix not in _takeoff_plugins:
+            _takeoff_plugins[prefix] = {
+                name: importlib.import_module(name)
+                for finder, name, ispkg in pkgutil.iter_modules()
+                if name.startswith(prefix)
+            }
+            logging.info(f"Found Takeoff plugins {_takeoff_plugins[prefix]}")
+        return _takeoff_plugins[prefix]
+
+
+def find_takeoff_plugin_function(function_name: str) -> Optional[Callable]:
+    """Finds a function in the Takeoff plugins.
+
+    Resolved functions are indexed on name, so every function is looked up only once.
+
+    Args:
+        function_name: The name of the plugin function to search for
+
     Returns:
-        The result of the bash command. 0 for success, >=1 for failure.
+        The function of the first plugin that defines it, None if no plugin defines it.
     """
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, cwd="./", universal_newlines=True)
-    output_lines = []
-    while True:
-        output = process.stdout.readline()  # type: ignore
-        if output == "" and process.poll() is not None:
-            break
-        if output:
-            print(output.strip())
-            output_lines.append(output)
-    return process.poll(), output_lines
-
-
-def load_takeoff_plugins():
-    """https://packaging.python.org/guides/creating-and-discovering-plugins/"""
-    plugins = {
-        name: importlib.import_module(name)
-        for finder, name, ispkg in pkgutil.iter_modules()
-        if name.startswith(DEFAULT_TAKEOFF_PLUGIN_PREFIX)
-    }
-    logging.info(f"Found Takeoff plugins {plugins}")
-    return plugins
+    key = (DEFAULT_TAKEOFF_PLUGIN_PREFIX, function_name)
+    with _takeoff_plugins_lock:
+        if key not in _takeoff_plugin_functions:
+            _takeoff_plugin_functions[key] = next(
+                (
+                    getattr(plugin, function_name)
+                    for plugin in load_takeoff_plugins().values()
+                    if hasattr(plugin, function_name)
+                ),
+                None,
+            )
+        return _takeoff_plugin_functions[key]
+
+
+def refresh_takeoff_plugins():
+    """Forgets all discovered Takeoff plugins, they will be rediscovered on next use"""
+    with _takeoff_plugins_lock:
+        _takeoff_plugins.clear()
+        _takeoff_plugin_functions.clear()
+        importlib.invalidate_caches()
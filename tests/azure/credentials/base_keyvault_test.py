@@ -3,6 +3,8 @@ import unittest
 from dataclasses import dataclass
 from unittest import mock
 
+from takeoff.azure.credentials.providers.keyvault_secret_cache import KeyVaultSecretCache
+
 
 @dataclass
 class MockKeyVaultId:
@@ -52,13 +54,16 @@ CONFIG = {"azure": {"keyvault_keys":
 
 class KeyVaultBaseTest(unittest.TestCase):
 
+    def setUp(self):
+        KeyVaultSecretCache().invalidate()
+
     def construct_keyvault_mock(self):
         m_client = mock.Mock()
         m_client.configure_mock(
             **{'get_secrets.return_value':
                    list(map(MockKeyVaultId, map(lambda x: f"{PREFIX}{x[0]}", VALUES))),
                'get_secret.side_effect':
-                   list(map(MockKeyVaultSecret, map(lambda x: x[1], VALUES)))
+                   lambda vault, key, version: MockKeyVaultSecret(dict(VALUES)[key])
                })
         return m_client
 
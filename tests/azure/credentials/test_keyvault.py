@@ -1,15 +1,24 @@
+import os
 from unittest import mock
 
 from takeoff.application_version import ApplicationVersion
 from takeoff.azure.credentials.keyvault import KeyVaultClient as victim
-from tests.credentials.base_environment_keys_test import EnvironmentKeyBaseTest
+from tests.credentials.base_environment_keys_test import EnvironmentKeyBaseTest, CONFIG, OS_KEYS
 
 
 class TestKeyVaultClient(EnvironmentKeyBaseTest):
+    def setUp(self):
+        victim.clear()
+
+    def tearDown(self):
+        victim.clear()
+
     def call_victim(self, config):
         env = ApplicationVersion("DEV", "04fab6", "my-branch")
-        with mock.patch("takeoff.azure.credentials.keyvault.ServicePrincipalCredentials.credentials",
-                        return_value="mylittlepony") as m_creds:
+        with mock.patch("takeoff.azure.credentials.keyvault.ServicePrincipalCredentials.credential_kwargs",
+                        return_value={"client_id": "pony"}), \
+                mock.patch("takeoff.azure.credentials.keyvault.ServicePrincipalCredentials.credentials",
+                           return_value="mylittlepony") as m_creds:
             victim.vault_and_client(config, env)
         m_creds.assert_called_once_with(config, "dev")
 
@@ -18,3 +27,22 @@ class TestKeyVaultClient(EnvironmentKeyBaseTest):
             "takeoff.azure.credentials.keyvault.AzureKeyVaultClient",
             {"credentials": "mylittlepony"}
         )
+
+    @mock.patch.dict(os.environ, OS_KEYS)
+    def test_client_is_pooled(self):
+        env = ApplicationVersion("DEV", "04fab6", "my-branch")
+        config = {**CONFIG, "ci_environment_keys_dev": CONFIG["ci_environment_keys_env"],
+                  "ci_environment_keys_prd": CONFIG["ci_environment_keys_env"]}
+        prd_env = ApplicationVersion("PRD", "1.0.0", "master")
+        credentials = "takeoff.azure.credentials.keyvault.ServicePrincipalCredentials.credentials"
+        with mock.patch(credentials) as m_creds, \
+                mock.patch("takeoff.azure.credentials.keyvault.AzureKeyVaultClient") as m_client:
+            vault, client = victim.vault_and_client(config, env)
+            other_vault, other_client = victim.vault_and_client(config, env)
+            prd_vault, prd_client = victim.vault_and_client(config, prd_env)
+
+        assert (vault, client) == ("myvaultdev", m_client.return_value.__enter__.return_value)
+        assert (other_vault, other_client) == (vault, client)
+        assert prd_vault == "myvaultprd"
+        assert m_creds.call_count == 2
+        assert m_client.call_count == 2
@@ -1,11 +1,25 @@
 from unittest import mock
 
-from azure.keyvault.models import SecretBundle
+import pytest
+from azure.keyvault.models import SecretBundle, KeyVaultErrorException
+from msrest.exceptions import ClientRequestError
+from requests import Response
 
 from takeoff.azure.credentials.providers.keyvault_credentials_mixin import KeyVaultCredentialsMixin
+from takeoff.azure.credentials.providers.keyvault_secret_cache import KeyVaultSecretCache
+from takeoff.credentials.secret import Secret
+
+
+def keyvault_error(status_code: int) -> KeyVaultErrorException:
+    response = Response()
+    response.status_code = status_code
+    return KeyVaultErrorException(mock.Mock(), response)
 
 
 class TestAzureKeyVaultCredentialsMixin(object):
+    def setup_method(self):
+        KeyVaultSecretCache().invalidate()
+
     @mock.patch(
         "takeoff.azure.credentials.providers.keyvault_credentials_mixin.KeyVaultCredentialsMixin._credentials",
         return_value={"key1": "foo", "key2": "bar"},
@@ -31,3 +45,79 @@ class TestAzureKeyVaultCredentialsMixin(object):
 
         res = KeyVaultCredentialsMixin(None, client)._credentials(["databricks-token", "databricks-host"])
         assert len(res) == 2
+
+    def test_retrieve_secrets_concurrently_keeps_order(self):
+        client = mock.Mock()
+        client.get_secrets.return_value = [SecretBundle(id=f"app-name-secret-{i}") for i in range(20)]
+        client.get_secret.side_effect = lambda vault, key, version: SecretBundle(value=f"value-{key}")
+
+        res = KeyVaultCredentialsMixin("vault", client, max_workers=8).get_keyvault_secrets("app-name")
+
+        assert [_.key for _ in res] == [f"secret-{i}" for i in range(20)]
+        assert [_.val for _ in res] == [f"value-app-name-secret-{i}" for i in range(20)]
+
+    @mock.patch("takeoff.azure.credentials.providers.keyvault_credentials_mixin.time.sleep")
+    def test_get_secret_value_retries_transient_errors(self, m_sleep):
+        client = mock.Mock()
+        client.get_secret.side_effect = [
+            keyvault_error(429),
+            ClientRequestError("connection reset"),
+            SecretBundle(value="foo"),
+        ]
+
+        res = KeyVaultCredentialsMixin("vault", client, backoff=1)._fetch_secret_value(client, "vault", "key")
+
+        assert res == "foo"
+        m_sleep.assert_has_calls([mock.call(1), mock.call(2)])
+
+    @mock.patch("takeoff.azure.credentials.providers.keyvault_credentials_mixin.time.sleep")
+    def test_get_secret_value_does_not_retry_client_errors(self, m_sleep):
+        client = mock.Mock()
+        client.get_secret.side_effect = keyvault_error(403)
+
+        with pytest.raises(KeyVaultErrorException):
+            KeyVaultCredentialsMixin("vault", client)._fetch_secret_value(client, "vault", "key")
+        m_sleep.assert_not_called()
+
+    def test_secrets_are_fetched_once_per_run(self):
+        client = mock.Mock()
+        client.get_secret.side_effect = lambda vault, key, version: SecretBundle(value=f"value-{key}")
+
+        KeyVaultCredentialsMixin("vault", client)._credentials(["databricks-token"])
+        res = KeyVaultCredentialsMixin("vault", client)._credentials(["databricks-token", "databricks-host"])
+
+        assert res == {
+            "databricks-token": "value-databricks-token",
+            "databricks-host": "value-databricks-host",
+        }
+        client.get_secrets.assert_not_called()
+        assert client.get_secret.call_count == 2
+
+    def test_credentials_missing_key(self):
+        client = mock.Mock()
+        client.get_secret.side_effect = keyvault_error(404)
+
+        with pytest.raises(ValueError, match="databricks-host"):
+            KeyVaultCredentialsMixin("vault", client)._credentials(["databricks-host"])
+
+    def test_invalidate_secret_cache(self):
+        client = mock.Mock()
+        client.get_secret.return_value = SecretBundle(value="foo")
+
+        KeyVaultCredentialsMixin("vault", client)._credentials(["databricks-token"])
+        KeyVaultSecretCache().invalidate("vault")
+        KeyVaultCredentialsMixin("vault", client)._credentials(["databricks-token"])
+
+        assert client.get_secret.call_count == 2
+
+    def test_get_keyvault_secrets_lists_vault_once(self):
+        client = mock.Mock()
+        client.get_secrets.return_value = [SecretBundle(id="app-secret"), SecretBundle(id="other-secret")]
+        client.get_secret.return_value = SecretBundle(value="foo")
+
+        KeyVaultCredentialsMixin("vault", client).get_keyvault_secrets("app")
+        res = KeyVaultCredentialsMixin("vault", client).get_keyvault_secrets("other")
+
+        assert res == [Secret("secret", "foo")]
+        client.get_secrets.assert_called_once_with("vault")
+        assert client.get_secret.call_count == 2
@@ -1,13 +1,18 @@
 import base64
 import os
+import time
 
 from unittest import mock
 
+import git
 import pytest
+import requests
+import voluptuous as vol
 
 from takeoff.application_version import ApplicationVersion
-from takeoff.build_docker_image import DockerImageBuilder, DockerFile
+from takeoff.build_docker_image import DockerImageBuilder, DockerFile, context_hash
 from takeoff.credentials.container_registry import DockerCredentials
+from takeoff.docker_engine import DockerCliEngine
 from tests.azure import takeoff_config
 
 BASE_CONF = {"task": "build_docker_image"}
@@ -46,11 +51,12 @@ def test_construct_docker_build_config(victim: DockerImageBuilder):
     assert res == [DockerFile("Dockerfile", None, None, None, True)]
 
 def assert_docker_tag(m_bash):
-    m_bash.assert_called_once_with(["docker", "tag", "old_tag", "new_tag"])
+    m_bash.assert_called_once_with(["docker", "tag", "old_tag", "new_tag"],
+                                   output_prefix="", max_output_lines=10)
 
 
 def assert_docker_push(m_bash):
-    m_bash.assert_called_once_with(["docker", "push", "image/stag"])
+    m_bash.assert_called_once_with(["docker", "push", "image/stag"], output_prefix="", max_output_lines=10)
 
 
 def assert_docker_build(m_bash):
@@ -62,7 +68,7 @@ def assert_docker_build(m_bash):
                                     "stag",
                                     "-f",
                                     "./Thefile",
-                                    "."])
+                                    "."], output_prefix="", env=None, max_output_lines=10)
 
 
 class TestDockerImageBuilder:
@@ -73,7 +79,9 @@ class TestDockerImageBuilder:
         conf = {**takeoff_config(), **BASE_CONF}
 
         res = DockerImageBuilder(ApplicationVersion("dev", "v", "branch"), conf)
-        assert res.config['dockerfiles'] == [{"file": "Dockerfile", "postfix": None, "prefix": None, "custom_image_name": None, 'tag_release_as_latest': True}]
+        assert res.config['dockerfiles'] == [{"file": "Dockerfile", "postfix": None, "prefix": None,
+                                              "custom_image_name": None, 'tag_release_as_latest': True,
+                                              "cache_from": [], "cache_to": None}]
 
     @mock.patch.dict(os.environ, ENV_VARIABLES)
     @mock.patch("takeoff.build_docker_image.DockerRegistry.credentials", return_value=CREDS)
@@ -114,46 +122,46 @@ class TestDockerImageBuilder:
         assert_docker_json(mopen, mjson)
 
     @mock.patch.dict(os.environ, ENV_VARIABLES)
-    @mock.patch("takeoff.build_docker_image.run_shell_command", return_value=(0, ['output_lines']))
+    @mock.patch("takeoff.docker_engine.run_shell_command", return_value=(0, ['output_lines']))
     def test_tag_image_success(self, m_bash):
-        DockerImageBuilder.tag_image("old_tag", "new_tag")
+        DockerCliEngine.tag_image("old_tag", "new_tag")
         assert_docker_tag(m_bash)
 
     @mock.patch.dict(os.environ, ENV_VARIABLES)
-    @mock.patch("takeoff.build_docker_image.run_shell_command", return_value=(1, ['output_lines']))
+    @mock.patch("takeoff.docker_engine.run_shell_command", return_value=(1, ['output_lines']))
     def test_tag_image_failure(self, m_bash):
         with pytest.raises(ChildProcessError):
-            DockerImageBuilder.tag_image("old_tag", "new_tag")
+            DockerCliEngine.tag_image("old_tag", "new_tag")
         assert_docker_tag(m_bash)
 
     @mock.patch.dict(os.environ, ENV_VARIABLES)
-    @mock.patch("takeoff.build_docker_image.run_shell_command", return_value=(0, ['output_lines']))
+    @mock.patch("takeoff.docker_engine.run_shell_command", return_value=(0, ['output_lines']))
     def test_build_image_success(self, m_bash):
-        DockerImageBuilder.build_image("Thefile", "stag")
+        DockerCliEngine.build_image("Thefile", "stag")
         assert_docker_build(m_bash)
 
     @mock.patch.dict(os.environ, ENV_VARIABLES)
-    @mock.patch("takeoff.build_docker_image.run_shell_command", return_value=(1, ['output_lines']))
+    @mock.patch("takeoff.docker_engine.run_shell_command", return_value=(1, ['output_lines']))
     def test_build_image_failure(self, m_bash):
         with pytest.raises(ChildProcessError):
-            DockerImageBuilder.build_image("Thefile", "stag")
+            DockerCliEngine.build_image("Thefile", "stag")
         assert_docker_build(m_bash)
 
-    @mock.patch("takeoff.build_docker_image.run_shell_command", return_value=(0, ['output_lines']))
-    def test_push_image_success(self, m_bash, victim):
-        victim.push_image("image/stag")
+    @mock.patch("takeoff.docker_engine.run_shell_command", return_value=(0, ['output_lines']))
+    def test_push_image_success(self, m_bash):
+        DockerCliEngine.push_image("image/stag")
         assert_docker_push(m_bash)
 
-    @mock.patch("takeoff.build_docker_image.run_shell_command", return_value=(1, ['output_lines']))
-    def test_push_image_failure(self, m_bash, victim):
+    @mock.patch("takeoff.docker_engine.run_shell_command", return_value=(1, ['output_lines']))
+    def test_push_image_failure(self, m_bash):
         with pytest.raises(ChildProcessError):
-            victim.push_image("image/stag")
+            DockerCliEngine.push_image("image/stag")
         assert_docker_push(m_bash)
 
     @mock.patch.dict(os.environ, {"PIP_EXTRA_INDEX_URL": "url/to/artifact/store",
                                   "CI_PROJECT_NAME": "myapp",
                                   "CI_COMMIT_REF_SLUG": "SNAPSHOT"})
-    @mock.patch("takeoff.build_docker_image.run_shell_command", return_value=(0, ['output_lines']))
+    @mock.patch("takeoff.docker_engine.run_shell_command", return_value=(0, ['output_lines']))
     @mock.patch("takeoff.application_version.get_tag", return_value=None)
     def test_deploy_non_release(self, m_tag, m_bash, victim: DockerImageBuilder):
         files = [DockerFile("Dockerfile", None, 'name', None, True), DockerFile("File2", "-foo", None, "mycustom/repo", False)]
@@ -163,13 +171,16 @@ class TestDockerImageBuilder:
 
         push_call_1 = ["docker", "push", "pony/name/myapp:SNAPSHOT"]
         push_call_2 = ["docker", "push", "mycustom/repo-foo:SNAPSHOT"]
-        calls = list(map(mock.call, [build_call_1, push_call_1, build_call_2, push_call_2]))
+        calls = [mock.call(build_call_1, output_prefix="", env=None, max_output_lines=10),
+                 mock.call(push_call_1, output_prefix="", max_output_lines=10),
+                 mock.call(build_call_2, output_prefix="", env=None, max_output_lines=10),
+                 mock.call(push_call_2, output_prefix="", max_output_lines=10)]
         m_bash.assert_has_calls(calls)
 
     @mock.patch.dict(os.environ, {"PIP_EXTRA_INDEX_URL": "url/to/artifact/store",
                                   "CI_PROJECT_NAME": "myapp",
                                   "CI_COMMIT_REF_SLUG": "2.1.0"})
-    @mock.patch("takeoff.build_docker_image.run_shell_command", return_value=(0, ['output_lines']))
+    @mock.patch("takeoff.docker_engine.run_shell_command", return_value=(0, ['output_lines']))
     @mock.patch("takeoff.application_version.get_tag", return_value="2.1.0")
     def test_deploy_release(self, m_tag, m_bash, victim_release: DockerImageBuilder):
         files = [DockerFile("Dockerfile", None, None, None, True), DockerFile("File2", "-foo", None, "mycustom/repo", False)]
@@ -182,5 +193,248 @@ class TestDockerImageBuilder:
         tag_call_latest = ["docker", "tag", "pony/myapp:2.1.0", "pony/myapp:latest"]
         push_call_1_latest = ["docker", "push", "pony/myapp:latest"]
         push_call_2 = ["docker", "push", "mycustom/repo-foo:2.1.0"]
-        calls = list(map(mock.call, [build_call_1, push_call_1, tag_call_latest, push_call_1_latest, build_call_2, push_call_2]))
+        calls = [mock.call(build_call_1, output_prefix="", env=None, max_output_lines=10)] + \
+                [mock.call(_, output_prefix="", max_output_lines=10)
+                 for _ in [push_call_1, tag_call_latest, push_call_1_latest]] + \
+                [mock.call(build_call_2, output_prefix="", env=None, max_output_lines=10),
+                 mock.call(push_call_2, output_prefix="", max_output_lines=10)]
         m_bash.assert_has_calls(calls)
+
+    @mock.patch.dict(os.environ, {"PIP_EXTRA_INDEX_URL": "url/to/artifact/store",
+                                  "CI_PROJECT_NAME": "myapp",
+                                  "CI_COMMIT_REF_SLUG": "SNAPSHOT"})
+    @mock.patch("takeoff.docker_engine.run_shell_command", return_value=(0, ['output_lines']))
+    @mock.patch("takeoff.application_version.get_tag", return_value=None)
+    def test_deploy_parallel(self, m_tag, m_bash, victim: DockerImageBuilder):
+        victim.config["max_parallel_builds"] = 2
+        files = [DockerFile("Dockerfile", None, 'name', None, True),
+                 DockerFile("File2", "-foo", None, "mycustom/repo", False)]
+        victim.deploy(files)
+
+        build = ["docker", "build", "--build-arg", "PIP_EXTRA_INDEX_URL=url/to/artifact/store"]
+        build_call_1 = build + ["-t", "pony/name/myapp:SNAPSHOT", "-f", "./Dockerfile", "."]
+        build_call_2 = build + ["-t", "mycustom/repo-foo:SNAPSHOT", "-f", "./File2", "."]
+        push_call_1 = ["docker", "push", "pony/name/myapp:SNAPSHOT"]
+        push_call_2 = ["docker", "push", "mycustom/repo-foo:SNAPSHOT"]
+
+        # the images are built concurrently, so only the order of the calls for a single image is known
+        calls = m_bash.call_args_list
+        for build_call, push_call, prefix in [(build_call_1, push_call_1, "[Dockerfile] "),
+                                              (build_call_2, push_call_2, "[File2] ")]:
+            built = calls.index(mock.call(build_call, output_prefix=prefix, env=None, max_output_lines=10))
+            assert built < calls.index(mock.call(push_call, output_prefix=prefix, max_output_lines=10))
+        assert m_bash.call_count == 4
+
+    @mock.patch.dict(os.environ, {"PIP_EXTRA_INDEX_URL": "url/to/artifact/store",
+                                  "CI_PROJECT_NAME": "myapp",
+                                  "CI_COMMIT_REF_SLUG": "SNAPSHOT"})
+    @mock.patch("takeoff.application_version.get_tag", return_value=None)
+    def test_deploy_parallel_failure(self, m_tag, victim: DockerImageBuilder):
+        victim.config["max_parallel_builds"] = 2
+        files = [DockerFile("Dockerfile", None, None, None, True),
+                 DockerFile("File2", "-foo", None, None, False),
+                 DockerFile("File3", "-bar", None, None, False)]
+
+        def build(cmd, output_prefix, env=None, max_output_lines=None):
+            if "./Dockerfile" in cmd:
+                return 1, []
+            time.sleep(0.1)
+            return 0, []
+
+        with mock.patch("takeoff.docker_engine.run_shell_command", side_effect=build) as m_bash:
+            with pytest.raises(ChildProcessError, match="Could not build the image"):
+                victim.deploy(files)
+
+        # the image that was already being built is finished, the image not yet started is skipped
+        m_bash.assert_any_call(["docker", "push", "pony/myapp-foo:SNAPSHOT"],
+                               output_prefix="[File2] ", max_output_lines=10)
+        assert not any("./File3" in _[0][0] for _ in m_bash.call_args_list)
+
+    @mock.patch.dict(os.environ, {"PIP_EXTRA_INDEX_URL": "url/to/artifact/store",
+                                  "CI_PROJECT_NAME": "myapp",
+                                  "CI_COMMIT_REF_SLUG": "SNAPSHOT"})
+    @mock.patch("takeoff.application_version.get_tag", return_value=None)
+    def test_deploy_serial_failure(self, m_tag, victim: DockerImageBuilder):
+        files = [DockerFile("Dockerfile", None, None, None, True),
+                 DockerFile("File2", "-foo", None, None, False)]
+
+        with mock.patch("takeoff.docker_engine.run_shell_command", return_value=(1, [])) as m_bash:
+            with pytest.raises(ChildProcessError, match="Could not build the image"):
+                victim.deploy(files)
+
+        m_bash.assert_called_once()
+
+    @mock.patch.dict(os.environ, ENV_VARIABLES)
+    @mock.patch("takeoff.docker_engine.run_shell_command", return_value=(0, ['output_lines']))
+    def test_build_image_buildkit_cache(self, m_bash):
+        DockerCliEngine.build_image("Thefile", "stag", cache_from=["myreg.io/my-app:cache"], buildkit=True)
+        m_bash.assert_called_once_with(["docker", "build",
+                                        "--build-arg", "PIP_EXTRA_INDEX_URL=url/to/artifact/store",
+                                        "--build-arg", "BUILDKIT_INLINE_CACHE=1",
+                                        "--cache-from", "myreg.io/my-app:cache",
+                                        "-t", "stag", "-f", "./Thefile", "."],
+                                       output_prefix="", env={"DOCKER_BUILDKIT": "1"}, max_output_lines=10)
+
+    @mock.patch.dict(os.environ, ENV_VARIABLES)
+    @mock.patch("takeoff.docker_engine.run_shell_command", return_value=(0, ['output_lines']))
+    def test_build_image_cache_to(self, m_bash):
+        DockerCliEngine.build_image("Thefile", "stag", cache_to="type=local,dest=cache")
+        m_bash.assert_called_once_with(["docker", "buildx", "build",
+                                        "--build-arg", "PIP_EXTRA_INDEX_URL=url/to/artifact/store",
+                                        "--build-arg", "BUILDKIT_INLINE_CACHE=1",
+                                        "--cache-to", "type=local,dest=cache", "--load",
+                                        "-t", "stag", "-f", "./Thefile", "."],
+                                       output_prefix="", env={"DOCKER_BUILDKIT": "1"}, max_output_lines=10)
+
+    @mock.patch("takeoff.application_version.get_tag", return_value=None)
+    def test_cache_sources_pulls_previous_image(self, _, victim: DockerImageBuilder):
+        victim.config["cache_previous_image"] = True
+        df = DockerFile("Dockerfile", None, None, None, True, ("type=local,src=cache",))
+        with mock.patch("takeoff.docker_engine.run_shell_command", return_value=(0, [])) as m_bash:
+            res = victim._cache_sources(df, "pony/myapp", "")
+
+        m_bash.assert_called_once_with(["docker", "pull", "pony/myapp:SNAPSHOT"],
+                                       output_prefix="", max_output_lines=10)
+        assert res == ["type=local,src=cache", "pony/myapp:SNAPSHOT"]
+
+    @mock.patch("takeoff.application_version.get_tag", return_value="2.1.0")
+    def test_cache_sources_previous_image_missing(self, _, victim_release: DockerImageBuilder):
+        victim_release.config["cache_previous_image"] = True
+        df = DockerFile("Dockerfile", None, None, None, True)
+        with mock.patch("takeoff.docker_engine.run_shell_command", return_value=(1, [])) as m_bash:
+            res = victim_release._cache_sources(df, "pony/myapp", "")
+
+        m_bash.assert_called_once_with(["docker", "pull", "pony/myapp:latest"],
+                                       output_prefix="", max_output_lines=10)
+        assert res == []
+
+    @mock.patch("takeoff.application_version.get_tag", return_value=None)
+    def test_cache_sources_buildkit_does_not_pull(self, _, victim: DockerImageBuilder):
+        victim.config["cache_previous_image"] = True
+        victim.config["buildkit"] = True
+        df = DockerFile("Dockerfile", None, None, None, True)
+        with mock.patch("takeoff.docker_engine.run_shell_command") as m_bash:
+            res = victim._cache_sources(df, "pony/myapp", "")
+
+        m_bash.assert_not_called()
+        assert res == ["pony/myapp:SNAPSHOT"]
+
+    @mock.patch.dict(os.environ, ENV_VARIABLES)
+    @mock.patch("takeoff.build_docker_image.DockerSdkEngine")
+    @mock.patch("takeoff.build_docker_image.DockerRegistry.credentials", return_value=CREDS)
+    def test_sdk_engine(self, _, m_engine):
+        conf = {**takeoff_config(), **BASE_CONF, "engine": "sdk"}
+        res = DockerImageBuilder(ApplicationVersion("dev", "v", "branch"), conf)
+
+        m_engine.assert_called_once_with(CREDS)
+        assert res.engine is m_engine.return_value
+
+    @mock.patch("takeoff.application_version.get_tag", return_value=None)
+    def test_cli_engine(self, _, victim: DockerImageBuilder):
+        assert isinstance(victim.engine, DockerCliEngine)
+
+    @mock.patch.dict(os.environ, ENV_VARIABLES)
+    @mock.patch("takeoff.build_docker_image.DockerRegistry.credentials", return_value=CREDS)
+    def test_sdk_engine_does_not_support_buildkit(self, _):
+        conf = {**takeoff_config(), **BASE_CONF, "engine": "sdk", "buildkit": True}
+        with pytest.raises(vol.MultipleInvalid):
+            DockerImageBuilder(ApplicationVersion("dev", "v", "branch"), conf)
+
+    @mock.patch("takeoff.application_version.get_tag", return_value=None)
+    def test_deploy_image_uses_engine(self, _, victim: DockerImageBuilder):
+        victim.engine = mock.Mock()
+        victim.deploy_image(DockerFile("Dockerfile", None, None, None, True))
+
+        victim.engine.build_image.assert_called_once_with(
+            "Dockerfile", "pony/myapp:SNAPSHOT", "", [], None, False, {}
+        )
+        victim.engine.push_image.assert_called_once_with("pony/myapp:SNAPSHOT", "")
+
+    @mock.patch("takeoff.build_docker_image.context_hash", return_value="abc")
+    @mock.patch("takeoff.application_version.get_tag", return_value="2.1.0")
+    def test_deploy_image_reuses_unchanged_image(self, _, __, victim_release: DockerImageBuilder):
+        victim_release.config["skip_unchanged_images"] = True
+        victim_release.engine = mock.Mock()
+        victim_release.registry = mock.Mock()
+        labels = {"pony/myapp:SNAPSHOT": "abc"}
+        victim_release.registry.image_label.side_effect = lambda tag, _: labels.get(tag)
+
+        victim_release.deploy_image(DockerFile("Dockerfile", None, None, None, True))
+
+        victim_release.registry.image_label.assert_has_calls([
+            mock.call("pony/myapp:2.1.0", "takeoff.context-hash"),
+            mock.call("pony/myapp:latest", "takeoff.context-hash"),
+            mock.call("pony/myapp:SNAPSHOT", "takeoff.context-hash"),
+        ])
+        victim_release.registry.tag_image.assert_has_calls([
+            mock.call("pony/myapp:SNAPSHOT", "pony/myapp:2.1.0"),
+            mock.call("pony/myapp:SNAPSHOT", "pony/myapp:latest"),
+        ])
+        victim_release.engine.pull_image.assert_not_called()
+        victim_release.engine.build_image.assert_not_called()
+        victim_release.engine.push_image.assert_not_called()
+
+    @mock.patch("takeoff.build_docker_image.context_hash", return_value="abc")
+    @mock.patch("takeoff.application_version.get_tag", return_value=None)
+    def test_deploy_image_reuses_image_with_same_tag(self, _, __, victim: DockerImageBuilder):
+        victim.config["skip_unchanged_images"] = True
+        victim.engine = mock.Mock()
+        victim.registry = mock.Mock()
+        victim.registry.image_label.return_value = "abc"
+
+        victim.deploy_image(DockerFile("Dockerfile", None, None, None, True))
+
+        victim.registry.image_label.assert_called_once_with("pony/myapp:SNAPSHOT", "takeoff.context-hash")
+        victim.registry.tag_image.assert_not_called()
+        victim.engine.push_image.assert_not_called()
+
+    @mock.patch("takeoff.build_docker_image.context_hash", return_value="abc")
+    @mock.patch("takeoff.application_version.get_tag", return_value=None)
+    def test_deploy_image_builds_changed_image(self, _, __, victim: DockerImageBuilder):
+        victim.config["skip_unchanged_images"] = True
+        victim.engine = mock.Mock()
+        victim.registry = mock.Mock()
+        victim.registry.image_label.side_effect = ["def", requests.HTTPError("unauthorized")]
+
+        victim.deploy_image(DockerFile("Dockerfile", None, None, None, True))
+
+        assert victim.registry.image_label.call_count == 2
+        victim.registry.tag_image.assert_not_called()
+        victim.engine.pull_image.assert_not_called()
+        victim.engine.build_image.assert_called_once_with(
+            "Dockerfile", "pony/myapp:SNAPSHOT", "", [], None, False, {"takeoff.context-hash": "abc"})
+        victim.engine.push_image.assert_called_once_with("pony/myapp:SNAPSHOT", "")
+
+
+def test_context_hash(tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM python")
+    (tmp_path / "app.py").write_text("print()")
+    (tmp_path / "ignored.log").write_text("1")
+    (tmp_path / ".dockerignore").write_text("# logs\n*.log\n")
+    original = context_hash("Dockerfile", str(tmp_path))
+
+    (tmp_path / "ignored.log").write_text("2")
+    assert context_hash("Dockerfile", str(tmp_path)) == original
+
+    (tmp_path / "app.py").write_text("print(1)")
+    assert context_hash("Dockerfile", str(tmp_path)) != original
+
+
+def test_context_hash_ignores_git(tmp_path):
+    (tmp_path / "Dockerfile").write_text("FROM python")
+    (tmp_path / "app.py").write_text("print()")
+    original = context_hash("Dockerfile", str(tmp_path))
+
+    repo = git.Repo.init(str(tmp_path))
+    repo.index.add(["Dockerfile", "app.py"])
+    repo.index.commit("Initial commit", author=git.Actor("Alice", "alice@example.com"))
+    assert context_hash("Dockerfile", str(tmp_path)) == original
+
+    repo.create_tag("1.0.0")
+    assert context_hash("Dockerfile", str(tmp_path)) == original
+
+    # a .dockerignore exception does not add the git directory to the hash
+    (tmp_path / ".dockerignore").write_text("!.git\n")
+    with_dockerignore = context_hash("Dockerfile", str(tmp_path))
+    repo.create_tag("1.0.1")
+    assert context_hash("Dockerfile", str(tmp_path)) == with_dockerignore
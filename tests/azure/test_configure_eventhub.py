@@ -1,4 +1,5 @@
 import os
+import time
 from dataclasses import dataclass
 from unittest import mock
 
@@ -91,36 +92,32 @@ class TestConfigureEventHub(object):
         )
 
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
-    def test_eventhub_exists(self, victim):
-        hub = EventHubConsumerGroup(EventHub('some_resource_group', 'some_namespace', 'hub1'), 'some_group', False, False)
-        assert victim._eventhub_exists(hub)
+    def test_validate_eventhubs(self, victim):
+        victim._validate_eventhubs({EventHub('some_resource_group', 'some_namespace', 'hub1'),
+                                    EventHub('some_resource_group', 'some_namespace', 'hub2')})
 
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
-    def test_eventhub_not_exists(self, victim):
-        group = EventHubConsumerGroup(EventHub('some_resource_group', 'some_namespace', 'idontexist'), 'some_group', False, False)
+    def test_validate_eventhubs_not_exists(self, victim):
         with pytest.raises(ValueError):
-            victim._eventhub_exists(group)
+            victim._validate_eventhubs({EventHub('some_resource_group', 'some_namespace', 'hub1'),
+                                        EventHub('some_resource_group', 'some_namespace', 'idontexist')})
 
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
-    def test_group_exists(self, victim):
-        group = EventHubConsumerGroup(EventHub('some_resource_group', 'some_namespace', 'some_hub'), 'group1', False, False)
-        assert victim._group_exists(group)
+    def test_index_eventhubs(self, victim):
+        hub = EventHub('some_resource_group', 'some_namespace', 'some_hub')
+        index = victim._index_eventhubs({hub})
+        assert index.consumer_groups == {hub: {'group1', 'group2'}}
+        assert index.authorization_rules == {hub: {'rule1', 'rule2'}}
 
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
-    def test_group_not_exists(self, victim):
-        group = EventHubConsumerGroup(EventHub('some_resource_group', 'some_namespace', 'some_hub'), 'idontexist', False, False)
-        assert not victim._group_exists(group)
-
-    @mock.patch.dict(os.environ, TEST_ENV_VARS)
-    def test_create_producer_policy_with_databricks(self, victim):
+    def test_create_producer_policy(self, victim):
         policy = EventHubProducerPolicy('my-entity', True)
 
-        with mock.patch('takeoff.azure.configure_eventhub.ConfigureEventHub.create_databricks_secrets') as databricks_call:
-            victim._create_producer_policy(policy=policy,
-                                           resource_group='my-group',
-                                           eventhub_namespace='my-namespace',
-                                           application_name='my-name'
-                                           )
+        result = victim._create_producer_policy(policy=policy,
+                                                resource_group='my-group',
+                                                eventhub_namespace='my-namespace',
+                                                application_name='my-name'
+                                                )
 
         victim.eventhub_client.event_hubs.create_or_update_authorization_rule.assert_called_with(
             authorization_rule_name='my-name-send-policy',
@@ -135,8 +132,34 @@ class TestConfigureEventHub(object):
             namespace_name='my-namespace',
             resource_group_name='my-group',
         )
+        assert result == Secret('my-entity-connection-string', 'potato-connection')
+
+    @mock.patch.dict(os.environ, TEST_ENV_VARS)
+    def test_create_eventhub_producer_policies_databricks_batch(self, victim):
+        policies = [EventHubProducerPolicy('entity1', True), EventHubProducerPolicy('entity2', False),
+                    EventHubProducerPolicy('entity3', True)]
 
-        databricks_call.assert_called_once()
+        create_secrets = 'takeoff.azure.configure_eventhub.ConfigureEventHub.create_databricks_secrets'
+        with mock.patch(create_secrets) as databricks_call:
+            result = victim.create_eventhub_producer_policies(policies)
+
+        databricks_call.assert_not_called()
+        assert result == [Secret('entity1-connection-string', 'potato-connection'),
+                          Secret('entity3-connection-string', 'potato-connection')]
+
+    @mock.patch.dict(os.environ, TEST_ENV_VARS)
+    def test_run_writes_databricks_secrets_once(self, victim):
+        group_secret = Secret('group', 'value')
+        policy_secret = Secret('policy', 'value')
+
+        step = "takeoff.azure.configure_eventhub.ConfigureEventHub"
+        with mock.patch.dict(victim.config, {'create_producer_policies': []}), \
+             mock.patch(f"{step}._setup_consumer_groups", return_value=[group_secret]), \
+             mock.patch(f"{step}._setup_producer_policies", return_value=[policy_secret]), \
+             mock.patch(f"{step}.create_databricks_secrets") as databricks_call:
+            victim.run()
+
+        databricks_call.assert_called_once_with([group_secret, policy_secret])
 
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
     def test_create_eventhub_producer_policies_secrets(self, victim):
@@ -148,46 +171,46 @@ class TestConfigureEventHub(object):
                                                                               Secret('entity2-connection-string', 'potato-connection')]
 
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
-    def test_create_producer_policy_without_databricks(self, victim):
-        policy = EventHubProducerPolicy('my-entity', False)
+    def test_create_eventhub_producer_policies_ordered(self, victim):
+        policies = [EventHubProducerPolicy(f'entity{i}', False) for i in range(10)]
 
-        with mock.patch('takeoff.azure.configure_eventhub.ConfigureEventHub.create_databricks_secrets') as databricks_call:
-            victim._create_producer_policy(policy=policy,
-                                           resource_group='my-group',
-                                           eventhub_namespace='my-namespace',
-                                           application_name='my-name'
-                                           )
+        def create(policy, *_):
+            time.sleep(0.01 * (10 - int(policy.eventhub_entity_name[6:])))
+            return Secret(policy.eventhub_entity_name, 'value')
 
-        victim.eventhub_client.event_hubs.create_or_update_authorization_rule.assert_called_with(
-            authorization_rule_name='my-name-send-policy',
-            event_hub_name='my-entity',
-            namespace_name='my-namespace',
-            resource_group_name='my-group',
-            rights=[AccessRights.send]
-        )
-        victim.eventhub_client.event_hubs.list_keys.assert_called_with(
-            authorization_rule_name='my-name-send-policy',
-            event_hub_name='my-entity',
-            namespace_name='my-namespace',
-            resource_group_name='my-group',
-        )
-        databricks_call.assert_not_called()
+        create_policy = "takeoff.azure.configure_eventhub.ConfigureEventHub._create_producer_policy"
+        with mock.patch(create_policy, side_effect=create):
+            victim.create_eventhub_producer_policies(policies)
 
-    def test_authorization_rules_exists(self, victim):
-        group = EventHub('my-group', 'my-namespace', 'my-entity')
-        assert victim._authorization_rules_exists(group, 'rule1')
+        secrets = Context().get(ContextKey.EVENTHUB_PRODUCER_POLICY_SECRETS)
+        assert [_.key for _ in secrets] == [f'entity{i}' for i in range(10)]
 
-    def test_authorization_rules_not_exists(self, victim):
-        group = EventHub('my-group', 'my-namespace', 'my-entity')
-        assert not victim._authorization_rules_exists(group, 'idontexist')
+    @mock.patch.dict(os.environ, TEST_ENV_VARS)
+    def test_create_eventhub_producer_policies_failures(self, victim):
+        policies = [EventHubProducerPolicy(f'entity{i}', False) for i in range(4)]
+
+        def create(policy, *_):
+            if policy.eventhub_entity_name in ('entity1', 'entity3'):
+                raise ValueError(f"{policy.eventhub_entity_name} does not exist")
+            return Secret(policy.eventhub_entity_name, 'value')
+
+        create_policy = "takeoff.azure.configure_eventhub.ConfigureEventHub._create_producer_policy"
+        with mock.patch(create_policy, side_effect=create) as m:
+            with pytest.raises(RuntimeError, match="2 of 4 producer policies") as e:
+                victim.create_eventhub_producer_policies(policies)
+
+        assert m.call_count == 4
+        assert "entity1 does not exist" in str(e.value)
+        assert "entity3 does not exist" in str(e.value)
 
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
     def test_create_connection_string(self, victim):
         result = victim._create_connection_string(EventHub('my-group', 'my-namespace', 'my-entity'))
         assert result == ConnectingString('my-entity', 'potato-connection')
 
+    @mock.patch("takeoff.azure.configure_eventhub.ConfigureEventHub.create_databricks_secrets")
     @mock.patch("takeoff.azure.configure_eventhub.ConfigureEventHub._create_producer_policy")
-    def test_create_eventhub_producer_policies(self, producer_policy_fun, victim):
+    def test_create_eventhub_producer_policies(self, producer_policy_fun, _, victim):
         policies = [
             EventHubProducerPolicy('entity1', False),
             EventHubProducerPolicy('entity2', True)
@@ -198,47 +221,89 @@ class TestConfigureEventHub(object):
         calls = [mock.call(policies[0], 'rgdev', 'eventhubdev', 'my_little_pony'),
                  mock.call(policies[1], 'rgdev', 'eventhubdev', 'my_little_pony')]
 
-        producer_policy_fun.assert_has_calls(calls)
+        producer_policy_fun.assert_has_calls(calls, any_order=True)
 
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
+    @mock.patch("takeoff.azure.configure_eventhub.ConfigureEventHub.create_databricks_secrets")
     @mock.patch("takeoff.azure.configure_eventhub.ConfigureEventHub._create_consumer_group")
-    def test_create_eventhub_consumer_groups(self, consumer_group_fun, victim):
+    def test_create_eventhub_consumer_groups(self, consumer_group_fun, databricks_call, victim):
         groups = [
             EventHubConsumerGroup(EventHub('my-group', 'my-namespace', 'entity1'), 'group1', False, False),
             EventHubConsumerGroup(EventHub('my-group', 'my-namespace', 'entity2'), 'group2', True, True),
         ]
 
-        with mock.patch("takeoff.azure.configure_eventhub.ConfigureEventHub._eventhub_exists", return_value=True):
-            with mock.patch("takeoff.azure.configure_eventhub.ConfigureEventHub._group_exists", return_value=False):
-                victim.create_eventhub_consumer_groups(groups)
+        with mock.patch("takeoff.azure.configure_eventhub.ConfigureEventHub._validate_eventhubs"):
+            result = victim.create_eventhub_consumer_groups(groups)
 
-        calls = [mock.call(group=EventHubConsumerGroup(EventHub('my-group', 'my-namespace', 'entity1'), 'group1', False, False)),
-                 mock.call(group=EventHubConsumerGroup(EventHub('my-group', 'my-namespace', 'entity2'), 'group2', True, True))]
+        calls = [mock.call(group=groups[0], index=mock.ANY), mock.call(group=groups[1], index=mock.ANY)]
 
-        consumer_group_fun.assert_has_calls(calls)
+        consumer_group_fun.assert_has_calls(calls, any_order=True)
+        databricks_call.assert_not_called()
+        assert result == [consumer_group_fun.return_value]
 
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
     def test_create_eventhub_consumer_group(self, victim):
-        group = EventHubConsumerGroup(EventHub('my-rg', 'my-namespace', 'my-entity'), 'my-group', False)
-        with mock.patch('takeoff.azure.configure_eventhub.ConfigureEventHub.create_databricks_secrets') as databricks_call:
-            victim._create_consumer_group(group)
+        group = EventHubConsumerGroup(EventHub('my-rg', 'my-namespace', 'my-entity'), 'my-group', True, True)
+        result = victim._create_consumer_group(group)
 
         victim.eventhub_client.consumer_groups.create_or_update.assert_called_with('my-rg',
                                                                                    'my-namespace',
                                                                                    'my-entity',
                                                                                    'my-group')
+        assert result.val == 'potato-connection'
 
-        databricks_call.assert_not_called()
 
-    @mock.patch.dict(os.environ, TEST_ENV_VARS)
-    def test_create_eventhub_consumer_group(self, victim):
-        group = EventHubConsumerGroup(EventHub('my-rg', 'my-namespace', 'my-entity'), 'my-group', True, True)
-        with mock.patch('takeoff.azure.configure_eventhub.ConfigureEventHub.create_databricks_secrets') as databricks_call:
-            victim._create_consumer_group(group)
+@mock.patch.dict(os.environ, TEST_ENV_VARS)
+def test_create_eventhub_consumer_groups_lists_once():
+    m_client = mock.MagicMock()
+    m_client.event_hubs.list_by_namespace.return_value = [
+        MockEventHubClientResponse("hub1"), MockEventHubClientResponse("hub2")
+    ]
+    m_client.consumer_groups.list_by_event_hub.return_value = [MockEventHubClientResponse("existing")]
 
-        victim.eventhub_client.consumer_groups.create_or_update.assert_called_with('my-rg',
-                                                                                   'my-namespace',
-                                                                                   'my-entity',
-                                                                                   'my-group')
+    def list_authorization_rules(rg, ns, hub):
+        return [MockEventHubClientResponse("my_little_pony-policy")] if hub == "hub1" else []
+
+    m_client.event_hubs.list_authorization_rules.side_effect = list_authorization_rules
+    m_client.event_hubs.list_keys.return_value = MockEventHubClientResponse("key", "potato-connection")
+
+    get_client = "takeoff.azure.configure_eventhub.ConfigureEventHub._get_eventhub_client"
+    vault_and_client = "takeoff.azure.configure_eventhub.KeyVaultClient.vault_and_client"
+    with mock.patch("takeoff.step.ApplicationName.get", return_value="my_little_pony"), \
+         mock.patch(get_client, return_value=m_client), \
+         mock.patch(vault_and_client, return_value=(None, None)):
+        conf = {**takeoff_config(), **BASE_CONF}
+        conf['azure'].update({"eventhub_naming": "eventhub{env}"})
+        victim = ConfigureEventHub(ApplicationVersion('DEV', 'local', 'foo'), conf)
+
+    hub1, hub2 = EventHub('rg', 'ns', 'hub1'), EventHub('rg', 'ns', 'hub2')
+    groups = [EventHubConsumerGroup(hub, group, False, False)
+              for hub in (hub1, hub2)
+              for group in ("existing", "new1", "new2")]
+    victim.create_eventhub_consumer_groups(groups)
 
-        databricks_call.assert_called_once()
+    assert m_client.event_hubs.list_by_namespace.call_count == 1
+    assert m_client.consumer_groups.list_by_event_hub.call_count == 2
+    assert m_client.event_hubs.list_authorization_rules.call_count == 2
+    assert m_client.event_hubs.list_keys.call_count == 2
+    assert m_client.consumer_groups.create_or_update.call_count == 4
+    m_client.event_hubs.create_or_update_authorization_rule.assert_called_once_with(
+        'rg', 'ns', 'hub2', 'my_little_pony-policy', [AccessRights.listen])
+    assert len(Context().get(ContextKey.EVENTHUB_CONSUMER_GROUP_SECRETS)) == 6
+
+
+@mock.patch.dict(os.environ, TEST_ENV_VARS)
+def test_create_databricks_secrets_reuses_client(victim):
+    victim._databricks_secrets = None
+    with mock.patch("takeoff.azure.configure_eventhub.CreateDatabricksSecretFromValue") as m_databricks:
+        victim.create_databricks_secrets([Secret('a', '1')])
+        victim.create_databricks_secrets([])
+        victim.create_databricks_secrets([Secret('b', '2'), Secret('c', '3')])
+    victim._databricks_secrets = None
+
+    m_databricks.assert_called_once()
+    m_databricks.return_value._create_scope.assert_called_once_with('my_little_pony')
+    m_databricks.return_value._add_secrets.assert_has_calls([
+        mock.call('my_little_pony', [Secret('a', '1')], 4),
+        mock.call('my_little_pony', [Secret('b', '2'), Secret('c', '3')], 4),
+    ])
@@ -3,9 +3,15 @@ from dataclasses import dataclass
 from unittest import mock
 
 import pytest
+import voluptuous as vol
 
 from takeoff.application_version import ApplicationVersion
-from takeoff.azure.create_databricks_secrets import CreateDatabricksSecretsFromVault, CreateDatabricksSecretFromValue, CreateDatabricksSecretsMixin
+from takeoff.azure.create_databricks_secrets import (
+    CreateDatabricksSecretsFromVault,
+    CreateDatabricksSecretFromValue,
+    CreateDatabricksSecretsMixin,
+    SecretsState,
+)
 from takeoff.credentials.secret import Secret
 from tests.azure import takeoff_config
 
@@ -73,7 +79,32 @@ class TestCreateDatabricksSecretsFromVault(object):
     @mock.patch("takeoff.azure.create_databricks_secrets.SecretApi", return_value={})
     def test_validate_minimal_schema(self, m1, m2, m3, m4):
         conf = {**takeoff_config(), **BASE_CONF}
-        CreateDatabricksSecretsFromVault(ApplicationVersion('ACP', 'bar', 'foo'), conf)
+        victim = CreateDatabricksSecretsFromVault(ApplicationVersion('ACP', 'bar', 'foo'), conf)
+        assert victim.config["sync"] is None
+        assert victim.config["max_parallel_operations"] == 4
+
+    @mock.patch("takeoff.step.ApplicationName.get", return_value="my_little_pony")
+    @mock.patch("takeoff.azure.create_databricks_secrets.KeyVaultClient.vault_and_client",
+                return_value=(None, None))
+    @mock.patch("takeoff.azure.create_databricks_secrets.Databricks", return_value=MockDatabricksClient())
+    @mock.patch("takeoff.azure.create_databricks_secrets.SecretApi", return_value={})
+    def test_validate_sync_schema(self, m1, m2, m3, m4):
+        conf = {**takeoff_config(), **BASE_CONF, "sync": {"state_file": "/cache/secrets.json"}}
+        victim = CreateDatabricksSecretsFromVault(ApplicationVersion('ACP', 'bar', 'foo'), conf)
+        assert victim.config["sync"] == {"state_file": "/cache/secrets.json", "delete_removed": False}
+
+        with pytest.raises(vol.MultipleInvalid):
+            CreateDatabricksSecretsFromVault(
+                ApplicationVersion('ACP', 'bar', 'foo'), {**takeoff_config(), **BASE_CONF, "sync": {}}
+            )
+
+    @mock.patch('takeoff.azure.create_databricks_secrets.KeyVaultCredentialsMixin.get_keyvault_secrets',
+                return_value=[Secret('FOO', 'foo')])
+    def test_create_databricks_secrets_sync(self, _, victim, tmpdir):
+        victim.config["sync"] = {"state_file": str(tmpdir.join("secrets.json")), "delete_removed": False}
+        with mock.patch.object(victim, "_sync_secrets") as m_sync:
+            victim.create_databricks_secrets()
+        m_sync.assert_called_once_with("my_little_pony", mock.ANY, mock.ANY, "ACP/my_little_pony", False, 4)
 
     def test_scope_exists(self, victim):
         scopes = {"scopes": [{"name": "foo"}, {"name": "bar"}]}
@@ -127,6 +158,92 @@ class TestCreateDatabricksSecretsFromVault(object):
                  mock.call("my-scope", "bar", "rab", None)]
         victim.secret_api.put_secret.assert_has_calls(calls)
 
+    def test_add_secrets_concurrently(self, victim):
+        victim.secret_api.put_secret.reset_mock()
+        secrets = [Secret("foo", "oof"), Secret("bar", "rab"), Secret("foo", "new")]
+
+        victim._add_secrets("my-scope", secrets, max_workers=4)
+        calls = [mock.call("my-scope", "foo", "new", None),
+                 mock.call("my-scope", "bar", "rab", None)]
+        victim.secret_api.put_secret.assert_has_calls(calls, any_order=True)
+        assert victim.secret_api.put_secret.call_count == 2
+
+    def test_sync_secrets(self, victim, tmpdir):
+        state = SecretsState(str(tmpdir.join("state", "secrets.json")))
+        victim.secret_api.list_secrets.return_value = {}
+        secrets = [Secret("foo", "oof"), Secret("bar", "rab")]
+        diff = victim._sync_secrets("my-scope", secrets, state, "dev/my-scope")
+        assert diff.added == ["bar", "foo"]
+        assert diff.summary() == "2 added, 0 changed, 0 unchanged, 0 removed"
+
+        victim.secret_api.put_secret.reset_mock()
+        victim.secret_api.list_secrets.return_value = {"secrets": [{"key": "foo"}, {"key": "bar"}]}
+        state = SecretsState(state.path)
+        secrets = [Secret("foo", "new"), Secret("bar", "rab")]
+        diff = victim._sync_secrets("my-scope", secrets, state, "dev/my-scope")
+
+        assert diff.changed == ["foo"]
+        assert diff.unchanged == ["bar"]
+        victim.secret_api.put_secret.assert_called_once_with("my-scope", "foo", "new", None)
+
+    def test_sync_secrets_removed(self, victim, tmpdir):
+        state = SecretsState(str(tmpdir.join("secrets.json")))
+        state.update("dev/my-scope", {"foo": state.fingerprint(Secret("foo", "oof")), "old": "abc"})
+        victim.secret_api.list_secrets.return_value = {
+            "secrets": [{"key": "foo"}, {"key": "old"}, {"key": "other"}]
+        }
+
+        diff = victim._sync_secrets("my-scope", [Secret("foo", "oof")], state, "dev/my-scope")
+        assert diff.removed == ["old"]
+        victim.secret_api.delete_secret.assert_not_called()
+        assert "old" in SecretsState(state.path).fingerprints("dev/my-scope")
+
+        diff = victim._sync_secrets(
+            "my-scope", [Secret("foo", "oof")], state, "dev/my-scope", delete_removed=True
+        )
+        assert diff.removed == ["old"]
+        victim.secret_api.delete_secret.assert_called_once_with("my-scope", "old")
+        victim.secret_api.put_secret.assert_not_called()
+        fingerprints = SecretsState(state.path).fingerprints("dev/my-scope")
+        assert fingerprints == {"foo": state.fingerprint(Secret("foo", "oof"))}
+
+    def test_sync_secrets_other_scope(self, victim, tmpdir):
+        state = SecretsState(str(tmpdir.join("secrets.json")))
+        state.update("prd/my-scope", {"foo": state.fingerprint(Secret("foo", "oof"))})
+        victim.secret_api.list_secrets.return_value = {"secrets": [{"key": "foo"}]}
+
+        diff = victim._sync_secrets("my-scope", [Secret("foo", "oof")], state, "dev/my-scope")
+        assert diff.changed == ["foo"]
+
+
+class TestSecretsState(object):
+    def test_fingerprint(self, tmpdir):
+        state = SecretsState(str(tmpdir.join("secrets.json")))
+        assert state.fingerprint(Secret("foo", "oof")) == state.fingerprint(Secret("foo", "oof"))
+        assert state.fingerprint(Secret("foo", "oof")) != state.fingerprint(Secret("foo", "rab"))
+        other_state = SecretsState("other")
+        assert state.fingerprint(Secret("foo", "oof")) != other_state.fingerprint(Secret("foo", "oof"))
+        assert "oof" not in state.fingerprint(Secret("foo", "oof"))
+
+    def test_persist(self, tmpdir):
+        state = SecretsState(str(tmpdir.join("secrets.json")))
+        state.update("dev/scope", {"foo": "abc"})
+
+        assert os.stat(state.path).st_mode & 0o777 == 0o600
+        reloaded = SecretsState(state.path)
+        assert reloaded.fingerprints("dev/scope") == {"foo": "abc"}
+        assert reloaded.fingerprints("prd/scope") == {}
+        assert reloaded.fingerprint(Secret("foo", "oof")) == state.fingerprint(Secret("foo", "oof"))
+
+    def test_missing_state_file_is_reported(self, tmpdir, caplog):
+        state = SecretsState(str(tmpdir.join("secrets.json")))
+        assert "does not exist, all secrets are written" in caplog.text
+
+        caplog.clear()
+        state.update("dev/scope", {"foo": "abc"})
+        SecretsState(state.path)
+        assert "does not exist" not in caplog.text
+
 
 class TestCreateDatabricksSecretFromVault(object):
     @mock.patch("takeoff.step.KeyVaultClient.vault_and_client", return_value=(None, None))
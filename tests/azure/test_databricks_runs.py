@@ -0,0 +1,70 @@
+from unittest import mock
+
+import pytest
+import requests
+
+from takeoff.azure.databricks_runs import RunPoller, RunStatus
+
+
+def state(life_cycle_state: str, **kwargs) -> dict:
+    return {"state": {"life_cycle_state": life_cycle_state, **kwargs}}
+
+
+@pytest.fixture
+def runs_api() -> mock.Mock:
+    return mock.Mock()
+
+
+class TestRunPoller(object):
+    @mock.patch("takeoff.azure.databricks_runs.time.sleep")
+    def test_wait(self, m_sleep, runs_api):
+        states = {
+            "run1": iter([state("PENDING"), state("RUNNING")]),
+            "run2": iter([state("PENDING"), state("PENDING"), state("TERMINATED", result_state="FAILED")]),
+        }
+        runs_api.get_run.side_effect = lambda run_id: next(states[run_id])
+        runs = [RunStatus("job1", "run1", 0), RunStatus("job2", "run2", 0)]
+
+        RunPoller(runs_api).wait(runs, timeout=60)
+
+        assert runs[0].running
+        assert runs[0].seconds_to_running > 0
+        assert runs[1].done and not runs[1].running
+        assert runs[1].result_state == "FAILED"
+        assert runs[1].seconds_to_running is None
+        assert runs_api.get_run.call_count == 5
+
+    @mock.patch("takeoff.azure.databricks_runs.time.sleep")
+    def test_wait_backs_off(self, m_sleep, runs_api):
+        runs_api.get_run.side_effect = [state("PENDING")] * 5 + [state("QUEUED"), state("RUNNING")]
+
+        RunPoller(runs_api, initial_interval=1, max_interval=4).wait([RunStatus("job", "run", 0)], timeout=60)
+
+        assert [_[0][0] for _ in m_sleep.call_args_list] == [2, 4, 4, 4, 4, 1]
+
+    @mock.patch("takeoff.azure.databricks_runs.time.sleep")
+    def test_wait_retries_failed_polls(self, m_sleep, runs_api):
+        runs_api.get_run.side_effect = [requests.ConnectionError("reset"), state("PENDING"),
+                                        requests.HTTPError("503"), state("RUNNING")]
+        runs = RunPoller(runs_api).wait([RunStatus("job", "run", 0)], timeout=60)
+
+        assert runs[0].running
+        assert runs_api.get_run.call_count == 4
+
+    def test_wait_timeout_on_failed_polls(self, runs_api):
+        runs_api.get_run.side_effect = requests.ConnectionError("reset")
+        runs = RunPoller(runs_api).wait([RunStatus("job", "run", 0)], timeout=0)
+
+        assert runs[0].life_cycle_state == "PENDING"
+        runs_api.get_run.assert_called_once_with("run")
+
+    def test_wait_timeout(self, runs_api):
+        runs_api.get_run.return_value = state("PENDING")
+        runs = RunPoller(runs_api).wait([RunStatus("job", "run", 0)], timeout=0)
+
+        assert not runs[0].done
+        runs_api.get_run.assert_called_once_with("run")
+
+    def test_wait_skips_done_runs(self, runs_api):
+        RunPoller(runs_api).wait([RunStatus("job", "run", 0, life_cycle_state="RUNNING")], timeout=60)
+        runs_api.get_run.assert_not_called()
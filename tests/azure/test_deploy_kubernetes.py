@@ -178,7 +178,18 @@ spec:
         with mock.patch("takeoff.azure.deploy_to_kubernetes.run_shell_command", return_value=(0, ['output_lines'])) as m:
             victim._await_rollout("target_type/target_name", "target_namespace")
 
-        m.assert_called_once_with(["kubectl", "rollout", "--namespace", "target_namespace", "status", "target_type/target_name", "--watch=True"])
+        m.assert_called_once_with(["kubectl", "rollout", "--namespace", "target_namespace",
+                                   "status", "target_type/target_name", "--watch=True"], timeout=None)
+
+    @mock.patch.dict(os.environ, env_variables)
+    @mock.patch("takeoff.step.KeyVaultClient.vault_and_client", return_value=(None, None))
+    def test_await_rollout_timeout(self, _, victim):
+        with mock.patch("takeoff.azure.deploy_to_kubernetes.run_shell_command", return_value=(-9, [])) as m:
+            with pytest.raises(ChildProcessError):
+                victim._await_rollout("target_type/target_name", "target_namespace", 60)
+
+        m.assert_called_once_with(["kubectl", "rollout", "--namespace", "target_namespace",
+                                   "status", "target_type/target_name", "--watch=True"], timeout=60)
 
     @mock.patch.dict(os.environ, env_variables)
     @mock.patch("takeoff.step.KeyVaultClient.vault_and_client", return_value=(None, None))
@@ -187,7 +198,8 @@ spec:
             with pytest.raises(ChildProcessError):
                 victim._await_rollout("target_type/target_name", "target_namespace")
 
-        m.assert_called_once_with(["kubectl", "rollout", "--namespace", "target_namespace", "status", "target_type/target_name", "--watch=True"])
+        m.assert_called_once_with(["kubectl", "rollout", "--namespace", "target_namespace",
+                                   "status", "target_type/target_name", "--watch=True"], timeout=None)
 
     @mock.patch("takeoff.step.ApplicationName.get", return_value="my_little_pony")
     @mock.patch("takeoff.azure.deploy_to_kubernetes.KeyVaultClient.vault_and_client", return_value=(None, None))
@@ -6,10 +6,11 @@ import pytest
 import voluptuous as vol
 
 from takeoff.application_version import ApplicationVersion
-from takeoff.azure.deploy_to_databricks import JobConfig, SCHEMA, DeployToDatabricks
+from takeoff.azure.databricks_runs import RunStatus
+from takeoff.azure.deploy_to_databricks import JobConfig, JobIndex, SCHEMA, DeployToDatabricks
 from tests.azure import takeoff_config
 
-jobs = [
+jobs = JobIndex([
     JobConfig("foo-SNAPSHOT", 1),
     JobConfig("bar-0.3.1", 2),
     JobConfig("foobar-0.0.2", 3),
@@ -18,7 +19,7 @@ jobs = [
     JobConfig("tim-postfix-SNAPSHOT", 6),
     JobConfig("tim-postfix-SNAPSHOT", 7),
     JobConfig("michel-1.2.3--my-version-postfix", 8)
-]
+])
 
 streaming_job_config = "tests/azure/files/test_job_config.json.j2"
 batch_job_config = "tests/azure/files/test_job_config_scheduled.json.j2"
@@ -46,7 +47,7 @@ def victim():
     m_jobs_api_client = mock.MagicMock()
     m_runs_api_client = mock.MagicMock()
 
-    m_jobs_api_client.list_jobs.return_value = {
+    m_jobs_api_client.client.client.perform_query.return_value = {
         "jobs": [
             {"job_id": "id1", "settings": {"name": "job1"}},
             {"job_id": "id2", "settings": {"name": "job2"}},
@@ -88,6 +89,39 @@ class TestDeployToDatabricks(object):
     def test_find_application_id_multiple_matches(self, victim):
         assert victim._application_job_id("tim-postfix", jobs) == [6, 7]
 
+    def test_find_application_id_prefix_only(self, victim):
+        assert victim._application_job_id("bar", jobs) == [2, 4]
+
+    def test_find_application_id_exact(self, victim):
+        victim.config["job_name_match"] = "exact"
+        assert victim._application_job_id("foo-SNAPSHOT", jobs) == [1]
+        assert victim._application_job_id("tim-postfix", jobs) == []
+
+    def test_job_index_take(self):
+        index = JobIndex(
+            [JobConfig("foo-SNAPSHOT", 1), JobConfig("foo-SNAPSHOT", 2), JobConfig("foo-bar", 3)]
+        )
+        assert index.take([1]) == [1]
+        assert index.exact("foo-SNAPSHOT") == [2]
+        assert index.take([1, 2]) == [2]
+        assert index.prefix("foo") == [3]
+        assert len(index) == 1
+
+    def test_list_jobs_paginated(self, victim):
+        victim.jobs_api.client.client.perform_query.side_effect = [
+            {"jobs": [{"job_id": 1, "settings": {"name": "job1"}}], "has_more": True},
+            {"jobs": [{"job_id": 2, "settings": {"name": "job2"}}], "has_more": False},
+        ]
+        assert victim._list_jobs() == [JobConfig("job1", 1), JobConfig("job2", 2)]
+        victim.jobs_api.client.client.perform_query.assert_has_calls([
+            mock.call("GET", "/jobs/list", data={"offset": 0, "limit": 25}),
+            mock.call("GET", "/jobs/list", data={"offset": 1, "limit": 25}),
+        ])
+
+    def test_list_jobs_empty_workspace(self, victim):
+        victim.jobs_api.client.client.perform_query.return_value = {"has_more": False}
+        assert victim._list_jobs() == []
+
     def test_construct_name_tag(self, victim):
         victim.env = ApplicationVersion('PRD', '1.2.3', 'tag')
         assert victim._construct_name("") == "my_app-1.2.3"
@@ -581,7 +615,7 @@ class TestDeployToDatabricks(object):
                 ) as submit_mock:
                     victim.deploy_to_databricks()
 
-        remove_mock.assert_called_once_with("my_app-SNAPSHOT", is_streaming=True)
+        remove_mock.assert_called_once_with("my_app-SNAPSHOT", is_streaming=True, index=mock.ANY)
         submit_mock.assert_called_once_with(job_config)
 
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
@@ -625,7 +659,7 @@ class TestDeployToDatabricks(object):
                 ) as submit_mock:
                     victim.deploy_to_databricks()
 
-        remove_mock.assert_called_once_with("my_app-baboon-job-SNAPSHOT", is_streaming=True)
+        remove_mock.assert_called_once_with("my_app-baboon-job-SNAPSHOT", is_streaming=True, index=mock.ANY)
         submit_mock.assert_called_once_with(job_config)
 
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
@@ -664,6 +698,169 @@ class TestDeployToDatabricks(object):
         victim.jobs_api.delete_job.assert_has_calls(calls)
         kill_mock.assert_has_calls(calls)
 
+    def test_remove_job_with_index(self, victim):
+        index = JobIndex([JobConfig("my_app-SNAPSHOT", "id1"), JobConfig("other_app-SNAPSHOT", "id2")])
+
+        victim.remove_job("my_app-SNAPSHOT", False, index)
+        victim.remove_job("my_app-SNAPSHOT", False, index)
+
+        victim.jobs_api.delete_job.assert_called_once_with("id1")
+        victim.jobs_api.client.client.perform_query.assert_not_called()
+
+    def test_deploy_to_databricks_lists_jobs_once(self, victim):
+        victim.config["jobs"] = [victim.config["jobs"][0], victim.config["jobs"][0]]
+        with mock.patch.object(victim, "create_config", return_value={}), \
+                mock.patch.object(victim, "deploy_job", return_value=(1, None)):
+            victim.deploy_to_databricks()
+
+        victim.jobs_api.client.client.perform_query.assert_called_once()
+
+    def test_deploy_to_databricks_removes_before_deploying(self, victim):
+        victim.config["jobs"] = [{**victim.config["jobs"][0], "name": str(_)} for _ in range(4)]
+        victim.config["max_parallel_jobs"] = 4
+        calls = []
+
+        def remove(*_, **__):
+            calls.append("remove")
+
+        def deploy(*_):
+            calls.append("deploy")
+            return 1, None
+
+        with mock.patch.object(victim, "create_config", return_value={}), \
+                mock.patch.object(victim, "remove_job", side_effect=remove), \
+                mock.patch.object(victim, "deploy_job", side_effect=deploy):
+            victim.deploy_to_databricks()
+
+        assert calls == ["remove"] * 4 + ["deploy"] * 4
+
+    def test_deploy_to_databricks_failure(self, victim):
+        victim.config["jobs"] = [{**victim.config["jobs"][0], "name": _} for _ in ["good", "bad"]]
+        victim.config["max_parallel_jobs"] = 2
+
+        def remove_job(job_name, **_):
+            if "bad" in job_name:
+                raise ValueError("could not cancel run")
+
+        with mock.patch.object(victim, "create_config", return_value={}), \
+                mock.patch.object(victim, "remove_job", side_effect=remove_job), \
+                mock.patch.object(victim, "deploy_job", return_value=(42, "run42")) as deploy_mock:
+            with pytest.raises(RuntimeError, match="Could not deploy 1 of 2 jobs") as e:
+                victim.deploy_to_databricks()
+
+        assert isinstance(e.value.__cause__, ValueError)
+        deploy_mock.assert_called_once_with({}, True, True)
+
+    def test_deploy_to_databricks_serial_failure(self, victim):
+        victim.config["jobs"] = [{**victim.config["jobs"][0], "name": _} for _ in ["bad", "good"]]
+        victim.config["max_parallel_jobs"] = 1
+
+        with mock.patch.object(victim, "create_config", return_value={}), \
+                mock.patch.object(victim, "remove_job", side_effect=ValueError("boom")) as remove_mock, \
+                mock.patch.object(victim, "deploy_job") as deploy_mock:
+            with pytest.raises(RuntimeError, match="Could not deploy 1 of 2 jobs"):
+                victim.deploy_to_databricks()
+
+        remove_mock.assert_called_once()
+        deploy_mock.assert_not_called()
+
+    def test_deploy_to_databricks_swap(self, victim):
+        victim.config["swap_streaming_jobs"] = {"start_timeout": 60, "health_wait": 0, "poll_interval": 1}
+        victim.jobs_api.client.client.perform_query.return_value = {
+            "jobs": [{"job_id": "old", "settings": {"name": "my_app-SNAPSHOT"}}]
+        }
+        victim.jobs_api.create_job.return_value = {"job_id": "new"}
+        victim.runs_api.get_run.side_effect = [
+            {"state": {"life_cycle_state": "PENDING"}},
+            {"state": {"life_cycle_state": "RUNNING"}},
+        ]
+        calls = []
+        victim.jobs_api.run_now.side_effect = lambda **_: calls.append("run new") or {"run_id": "run-new"}
+        victim.jobs_api.delete_job.side_effect = lambda job_id: calls.append(f"delete {job_id}")
+
+        with mock.patch.object(victim, "create_config", return_value={}), \
+                mock.patch("takeoff.azure.deploy_to_databricks.time.sleep"):
+            victim.deploy_to_databricks()
+
+        assert calls == ["run new", "delete old"]
+        victim.runs_api.list_runs.assert_called_once_with(
+            "old", active_only=True, completed_only=None, offset=0, limit=25
+        )
+
+    def test_deploy_to_databricks_swap_rollback(self, victim):
+        victim.config["swap_streaming_jobs"] = {"start_timeout": 60, "health_wait": 60, "poll_interval": 1}
+        victim.jobs_api.client.client.perform_query.return_value = {
+            "jobs": [{"job_id": "old", "settings": {"name": "my_app-SNAPSHOT"}}]
+        }
+        victim.jobs_api.create_job.return_value = {"job_id": "new"}
+        victim.runs_api.get_run.side_effect = [
+            {"state": {"life_cycle_state": "RUNNING"}},
+            {"state": {"life_cycle_state": "TERMINATED"}},
+        ]
+
+        with mock.patch.object(victim, "create_config", return_value={}), \
+                mock.patch("takeoff.azure.deploy_to_databricks.time.sleep"):
+            with pytest.raises(RuntimeError, match="Could not deploy 1 of 1 jobs"):
+                victim.deploy_to_databricks()
+
+        victim.jobs_api.delete_job.assert_called_once_with("new")
+
+    def test_deploy_to_databricks_swap_rollback_when_run_fails(self, victim):
+        victim.config["swap_streaming_jobs"] = {"start_timeout": 60, "health_wait": 0, "poll_interval": 1}
+        victim.jobs_api.client.client.perform_query.return_value = {
+            "jobs": [{"job_id": "old", "settings": {"name": "my_app-SNAPSHOT"}}]
+        }
+        victim.jobs_api.create_job.return_value = {"job_id": "new"}
+        victim.jobs_api.run_now.side_effect = ValueError("could not start")
+
+        with mock.patch.object(victim, "create_config", return_value={}):
+            with pytest.raises(RuntimeError, match="Could not deploy 1 of 1 jobs"):
+                victim.deploy_to_databricks()
+
+        victim.jobs_api.delete_job.assert_called_once_with("new")
+
+    def test_await_healthy_run_timeout(self, victim):
+        victim.config["swap_streaming_jobs"] = {"start_timeout": 0, "health_wait": 0, "poll_interval": 1}
+        victim.runs_api.get_run.return_value = {"state": {"life_cycle_state": "PENDING"}}
+        assert victim._await_healthy_run(RunStatus("my_app", "run1", 0)) == "PENDING"
+
+    def test_deploy_to_databricks_wait_for_runs(self, victim):
+        victim.config["wait_for_runs"] = {"timeout": 60, "max_poll_interval": 1}
+        victim.config["jobs"] = [{**victim.config["jobs"][0], "name": _} for _ in ["good", "bad"]]
+        victim.jobs_api.create_job.side_effect = [{"job_id": "good"}, {"job_id": "bad"}]
+        victim.jobs_api.run_now.side_effect = [{"run_id": "run-good"}, {"run_id": "run-bad"}]
+        states = {
+            "run-good": {"life_cycle_state": "RUNNING"},
+            "run-bad": {
+                "life_cycle_state": "INTERNAL_ERROR",
+                "result_state": "FAILED",
+                "state_message": "boom",
+            },
+        }
+        victim.runs_api.get_run.side_effect = lambda run_id: {"state": states[run_id]}
+
+        with mock.patch.object(victim, "create_config", return_value={}):
+            with pytest.raises(RuntimeError, match="Could not deploy 1 of 2 jobs") as e:
+                victim.deploy_to_databricks()
+
+        assert "Run run-bad ended with FAILED: boom" in str(e.value)
+
+    def test_deploy_to_databricks_without_wait(self, victim):
+        with mock.patch.object(victim, "create_config", return_value={}):
+            victim.deploy_to_databricks()
+        victim.runs_api.get_run.assert_not_called()
+
+    def test_deploy_to_databricks_swap_only_streaming(self, victim):
+        victim.config["swap_streaming_jobs"] = {"start_timeout": 60, "health_wait": 0, "poll_interval": 1}
+        victim.config["jobs"] = [{**victim.config["jobs"][0], "is_batch": True}]
+        with mock.patch.object(victim, "create_config", return_value={}), \
+                mock.patch.object(victim, "remove_job") as remove_mock, \
+                mock.patch.object(victim, "_swap_job") as swap_mock:
+            victim.deploy_to_databricks()
+
+        remove_mock.assert_called_once()
+        swap_mock.assert_not_called()
+
     def test_remove_non_existing_job(self, victim):
         with mock.patch(
                 "takeoff.azure.deploy_to_databricks.DeployToDatabricks._application_job_id",
@@ -677,7 +874,26 @@ class TestDeployToDatabricks(object):
         victim._kill_it_with_fire("my-id")
 
         calls = [mock.call("run1"), mock.call("run2")]
-        victim.runs_api.cancel_run.assert_has_calls(calls)
+        victim.runs_api.cancel_run.assert_has_calls(calls, any_order=True)
+
+    def test_kill_it_with_fire_paginated(self, victim):
+        victim.runs_api.list_runs.side_effect = [
+            {"runs": [{"run_id": "run1"}], "has_more": True},
+            {"runs": [{"run_id": "run2"}], "has_more": False},
+        ]
+        victim._kill_it_with_fire("my-id")
+
+        victim.runs_api.list_runs.assert_has_calls([
+            mock.call("my-id", active_only=True, completed_only=None, offset=0, limit=25),
+            mock.call("my-id", active_only=True, completed_only=None, offset=1, limit=25),
+        ])
+        calls = [mock.call("run1"), mock.call("run2")]
+        victim.runs_api.cancel_run.assert_has_calls(calls, any_order=True)
+
+    def test_kill_it_with_fire_no_runs(self, victim):
+        victim.runs_api.list_runs.return_value = {"has_more": False}
+        victim._kill_it_with_fire("my-id")
+        victim.runs_api.cancel_run.assert_not_called()
 
     def test_deploy_job_batch(self, victim):
         victim.deploy_job({}, False, True)
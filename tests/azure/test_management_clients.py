@@ -0,0 +1,106 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import pytest
+
+from takeoff.azure.management_clients import ManagementClients
+
+CONFIG = {"credentials_type": "active_directory_user"}
+
+
+class FakeClient(object):
+    def __init__(self, credentials, subscription_id):
+        self.credentials = credentials
+        self.subscription_id = subscription_id
+        self.entered = False
+        self.exited = False
+
+    def __enter__(self):
+        self.entered = True
+        return self
+
+    def __exit__(self, *args):
+        self.exited = True
+
+
+class OtherFakeClient(FakeClient):
+    pass
+
+
+@pytest.fixture
+def victim():
+    clients = ManagementClients().clear()
+    with mock.patch("takeoff.azure.management_clients.get_azure_credentials_object",
+                    return_value="credentials") as m_creds, \
+            mock.patch("takeoff.azure.management_clients.SubscriptionId") as m_subscription:
+        m_subscription.return_value.subscription_id.return_value = "subscription"
+        clients.m_creds = m_creds
+        clients.m_subscription = m_subscription
+        yield clients
+    clients.clear()
+
+
+def test_client_created_once(victim):
+    client = victim.client(FakeClient, CONFIG, "vault", "vault_client")
+
+    assert victim.client(FakeClient, CONFIG, "vault", "vault_client") is client
+    assert (client.credentials, client.subscription_id) == ("credentials", "subscription")
+    assert client.entered
+    victim.m_creds.assert_called_once_with(CONFIG, "vault", "vault_client")
+    victim.m_subscription.return_value.subscription_id.assert_called_once_with(CONFIG)
+
+
+def test_credentials_shared_between_client_types(victim):
+    client = victim.client(FakeClient, CONFIG, "vault", "vault_client")
+    other = victim.client(OtherFakeClient, CONFIG, "vault", "vault_client")
+
+    assert client is not other
+    assert victim.m_creds.call_count == 1
+    assert victim.m_subscription.return_value.subscription_id.call_count == 1
+
+
+def test_clients_per_credentials_type(victim):
+    client = victim.client(FakeClient, CONFIG, "vault", "vault_client")
+    other = victim.client(FakeClient, {"credentials_type": "service_principal"}, "vault", "vault_client")
+
+    assert client is not other
+    assert victim.m_creds.call_count == 2
+
+
+def test_clear(victim):
+    client = victim.client(FakeClient, CONFIG, "vault", "vault_client")
+    victim.clear()
+
+    assert client.exited
+    assert victim.client(FakeClient, CONFIG, "vault", "vault_client") is not client
+
+
+def test_client_created_once_by_concurrent_callers(victim):
+    victim.m_creds.side_effect = lambda *_: time.sleep(0.05) or "credentials"
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        clients = list(executor.map(lambda _: victim.client(FakeClient, CONFIG, "vault", "client"), range(8)))
+
+    assert all(_ is clients[0] for _ in clients)
+    assert victim.m_creds.call_count == 1
+
+
+def test_slow_vault_does_not_block_other_vaults(victim):
+    release = threading.Event()
+
+    def credentials(config, vault_name, vault_client):
+        if vault_name == "slow-vault":
+            release.wait(5)
+        return "credentials"
+
+    victim.m_creds.side_effect = credentials
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        slow = executor.submit(victim.client, FakeClient, CONFIG, "slow-vault", "vault_client")
+        fast = victim.client(FakeClient, CONFIG, "fast-vault", "vault_client")
+
+        # the client of the other vault was created while the slow vault was still resolving credentials
+        assert not slow.done()
+        release.set()
+        assert slow.result() is not fast
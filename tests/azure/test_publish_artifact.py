@@ -1,15 +1,17 @@
 import glob
 import os
+import tempfile
 import unittest
 from unittest import mock
 
 import azure
 import pytest
+from azure.common import AzureMissingResourceHttpError
 import voluptuous as vol
 
 from takeoff.application_version import ApplicationVersion
 from takeoff.azure.publish_artifact import PublishArtifact as victim
-from takeoff.azure.publish_artifact import language_must_match_target
+from takeoff.azure.publish_artifact import language_must_match_target, file_md5
 from tests.azure import takeoff_config
 
 BASE_CONF = {
@@ -103,10 +105,11 @@ class TestPublishArtifact(unittest.TestCase):
 
         m.assert_called_once()
 
+    @mock.patch.object(victim, "_resolve_credentials")
     @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
     @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
     @mock.patch.object(victim, "_get_wheel", return_value="some.whl")
-    def test_publish_python_package_blob(self, m1, m2, m3):
+    def test_publish_python_package_blob(self, m1, m2, m3, m4):
         conf = {**takeoff_config(), **BASE_CONF, "target": ["cloud_storage"]}
 
         with mock.patch.object(victim, 'upload_to_cloud_storage') as m:
@@ -114,10 +117,11 @@ class TestPublishArtifact(unittest.TestCase):
 
         m.assert_called_once_with(file="some.whl", file_extension=".whl")
 
+    @mock.patch.object(victim, "_resolve_credentials")
     @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
     @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
     @mock.patch.object(victim, "_get_wheel", return_value="some.whl")
-    def test_publish_python_package_blob_with_file(self, m1, m2, m3):
+    def test_publish_python_package_blob_with_file(self, m1, m2, m3, m4):
         conf = {
             **takeoff_config(),
             **BASE_CONF,
@@ -130,12 +134,62 @@ class TestPublishArtifact(unittest.TestCase):
 
         calls = [mock.call(file="some.whl", file_extension=".whl"),
                  mock.call(file="main.py", file_extension=".py")]
-        m.assert_has_calls(calls)
+        m.assert_has_calls(calls, any_order=True)
 
+    @mock.patch.object(victim, "_resolve_credentials")
+    @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
+    @mock.patch.object(victim, "_get_wheel", return_value="some.whl")
+    def test_publish_python_package_failure(self, m1, m2, m3, m4):
+        conf = {**takeoff_config(), **BASE_CONF, "target": ["cloud_storage", "pypi"]}
+
+        with mock.patch.object(victim, 'upload_to_cloud_storage', side_effect=IOError("no network")), \
+                mock.patch.object(victim, 'publish_to_pypi') as m_pypi:
+            with pytest.raises(RuntimeError, match="Could not publish to 1 of 2 targets") as e:
+                victim(FAKE_ENV, conf).publish_python_package()
+
+        assert "cloud_storage (some.whl): no network" in str(e.value)
+        assert isinstance(e.value.__cause__, IOError)
+        m_pypi.assert_called_once()
+
+    @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
+    @mock.patch("takeoff.azure.publish_artifact.get_tag", return_value="1.0.0")
+    def test_publish_resolves_credentials_once(self, m1, m2, m3):
+        conf = {**takeoff_config(), **BASE_CONF, "language": "python", "target": ["pypi", "cloud_storage"]}
+        step = victim(FAKE_ENV, conf)
+        with mock.patch("takeoff.azure.publish_artifact.BlobStore") as m_blob, \
+                mock.patch("takeoff.azure.publish_artifact.ArtifactStore") as m_store, \
+                mock.patch("takeoff.azure.publish_artifact.upload") as m_upload, \
+                mock.patch.object(victim, "_get_wheel", return_value="some.whl"), \
+                mock.patch.object(victim, "_upload_file_to_azure_storage_account"):
+            step.publish_python_package()
+            step.publish_python_package()
+
+        m_blob.return_value.service_client.assert_called_once()
+        m_store.return_value.store_settings.assert_called_once()
+        assert m_upload.call_count == 2
+
+    @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
+    def test_upload_to_cloud_storage_shares_client(self, m1, m2):
+        conf = {**takeoff_config(), **BASE_CONF, "upload_block_size": 16}
+        step = victim(FAKE_ENV, conf)
+        with mock.patch("takeoff.azure.publish_artifact.BlobStore") as m_store, \
+                mock.patch.object(victim, "_upload_file_to_azure_storage_account") as m_upload:
+            step.upload_to_cloud_storage("some.whl", ".whl")
+            step.upload_to_cloud_storage("some.whl", ".whl")
+
+        m_store.return_value.service_client.assert_called_once()
+        client = m_store.return_value.service_client.return_value
+        assert client.MAX_BLOCK_SIZE == 16 * 1024 * 1024
+        m_upload.assert_called_with(client, "some.whl", "my_app/my_app-v-py3-none-any.whl")
+
+    @mock.patch.object(victim, "_resolve_credentials")
     @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
     @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
     @mock.patch.object(victim, "_get_jar", return_value="some.jar")
-    def test_publish_jar_to_blob(self, m1, m2, m3):
+    def test_publish_jar_to_blob(self, m1, m2, m3, m4):
         conf = {
             **takeoff_config(),
             **BASE_CONF,
@@ -164,10 +218,102 @@ class TestPublishArtifact(unittest.TestCase):
     )
     @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
     def test_upload_file_to_blob(self, m1, m2):
+        source = self.write_file("Megadeth")
+        conf = {**takeoff_config(), **BASE_CONF, "language": "scala", "target": ["ivy"]}
+        with mock.patch.object(azure.storage.blob, "BlockBlobService") as m:
+            m.get_blob_properties.side_effect = AzureMissingResourceHttpError("not found", 404)
+            victim(FAKE_ENV, conf)._upload_file_to_azure_storage_account(
+                m, source, "Mustaine", "mylittlepony"
+            )
+        m.create_blob_from_path.assert_called_once_with(
+            container_name="mylittlepony",
+            blob_name="Mustaine",
+            file_path=source,
+            content_settings=mock.ANY,
+            max_connections=4,
+        )
+        assert m.create_blob_from_path.call_args[1]["content_settings"].content_md5 == file_md5(source)
+
+    @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
+    def test_upload_file_to_blob_unchanged(self, m1, m2):
+        source = self.write_file("Megadeth")
         conf = {**takeoff_config(), **BASE_CONF, "language": "scala", "target": ["ivy"]}
         with mock.patch.object(azure.storage.blob, "BlockBlobService") as m:
-            victim(FAKE_ENV, conf)._upload_file_to_azure_storage_account(m, "Dave", "Mustaine", "mylittlepony")
-        m.create_blob_from_path.assert_called_once_with(container_name="mylittlepony", blob_name="Mustaine", file_path="Dave")
+            m.get_blob_properties.return_value.properties.content_settings.content_md5 = file_md5(source)
+            report = victim(FAKE_ENV, conf)._upload_file_to_azure_storage_account(
+                m, source, "Mustaine", "mylittlepony"
+            )
+        m.get_blob_properties.assert_called_once_with("mylittlepony", "Mustaine")
+        m.create_blob_from_path.assert_not_called()
+        assert report.skipped
+        assert report.bytes_uploaded == 0
+
+    @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
+    def test_upload_file_to_blob_changed(self, m1, m2):
+        source = self.write_file("Megadeth")
+        conf = {**takeoff_config(), **BASE_CONF, "language": "scala", "target": ["ivy"]}
+        with mock.patch.object(azure.storage.blob, "BlockBlobService") as m:
+            content_settings = m.get_blob_properties.return_value.properties.content_settings
+            content_settings.content_md5 = "c29tZXRoaW5nIGVsc2U="
+            report = victim(FAKE_ENV, conf)._upload_file_to_azure_storage_account(
+                m, source, "Mustaine", "mylittlepony"
+            )
+        m.create_blob_from_path.assert_called_once()
+        assert not report.skipped
+        assert report.bytes_uploaded == 8
+        assert report.megabytes_per_second >= 0
+
+    @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
+    def test_upload_file_to_blob_skip_disabled(self, m1, m2):
+        source = self.write_file("Megadeth")
+        conf = {
+            **takeoff_config(),
+            **BASE_CONF,
+            "language": "scala",
+            "target": ["ivy"],
+            "skip_unchanged_blobs": False,
+        }
+        with mock.patch.object(azure.storage.blob, "BlockBlobService") as m:
+            victim(FAKE_ENV, conf)._upload_file_to_azure_storage_account(
+                m, source, "Mustaine", "mylittlepony"
+            )
+        m.get_blob_properties.assert_not_called()
+        m.create_blob_from_path.assert_called_once()
+
+    @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
+    def test_upload_file_to_blob_resumable(self, m1, m2):
+        source = self.write_file("M" * (1024 * 1024 + 1))
+        conf = {**takeoff_config(), **BASE_CONF, "upload_block_size": 1, "upload_journal_dir": "journal"}
+        with mock.patch.object(azure.storage.blob, "BlockBlobService") as m, \
+                mock.patch("takeoff.azure.publish_artifact.ResumableBlockUpload") as m_upload:
+            m.get_blob_properties.side_effect = AzureMissingResourceHttpError("not found", 404)
+            m_upload.return_value.upload.return_value = 42
+            report = victim(FAKE_ENV, conf)._upload_file_to_azure_storage_account(
+                m, source, "Mustaine", "mylittlepony"
+            )
+
+        m_upload.assert_called_once_with(
+            m, "mylittlepony", "Mustaine", source, file_md5(source), 1024 * 1024, "journal",
+            max_connections=4, retries=3,
+        )
+        m.create_blob_from_path.assert_not_called()
+        assert report.bytes_uploaded == 42
+
+    def test_file_md5(self):
+        source = self.write_file("Megadeth")
+        assert file_md5(source) == "egBpAONtUyGpRxKzsAYf+Q=="
+
+    def write_file(self, content: str) -> str:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "Dave")
+        with open(path, "w") as f:
+            f.write(content)
+        return path
 
     @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
     @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
@@ -201,7 +347,7 @@ class TestPublishArtifact(unittest.TestCase):
         conf = {**takeoff_config(), **BASE_CONF, "language": "scala", "target": ["ivy"]}
         with mock.patch("takeoff.azure.publish_artifact.run_shell_command", return_value=(0, ['output_lines'])) as m:
             victim(FAKE_ENV, conf).publish_to_ivy()
-        m.assert_called_once_with(["sbt", 'set version := "v-SNAPSHOT"', "publish"])
+        m.assert_called_once_with(["sbt", 'set version := "v-SNAPSHOT"', "publish"], max_output_lines=10)
 
     @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
     @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
@@ -211,4 +357,4 @@ class TestPublishArtifact(unittest.TestCase):
         env = ApplicationVersion('prd', '1.0.0', 'branch')
         with mock.patch("takeoff.azure.publish_artifact.run_shell_command", return_value=(0, ['output_lines'])) as m:
             victim(env, conf).publish_to_ivy()
-        m.assert_called_once_with(["sbt", 'set version := "1.0.0"', "publish"])
+        m.assert_called_once_with(["sbt", 'set version := "1.0.0"', "publish"], max_output_lines=10)
@@ -0,0 +1,129 @@
+import json
+import os
+from unittest import mock
+
+import pytest
+from azure.common import AzureMissingResourceHttpError
+from azure.storage.blob import BlobBlock
+
+from takeoff.azure.publish_artifact import file_md5
+from takeoff.azure.resumable_upload import ResumableBlockUpload, UploadJournal
+
+CONTENT = b"0123456789"
+BLOCK_SIZE = 4
+
+
+@pytest.fixture
+def source(tmpdir) -> str:
+    path = tmpdir.join("app-assembly.jar")
+    path.write_binary(CONTENT)
+    return str(path)
+
+
+@pytest.fixture
+def client() -> mock.Mock:
+    client = mock.Mock()
+    client.get_block_list.side_effect = AzureMissingResourceHttpError("not found", 404)
+    return client
+
+
+def victim(client, source, tmpdir, **kwargs) -> ResumableBlockUpload:
+    journal_dir = str(tmpdir.join("journal"))
+    return ResumableBlockUpload(
+        client, "container", "app.jar", source, file_md5(source), BLOCK_SIZE, journal_dir, **kwargs
+    )
+
+
+def put_blocks(client) -> dict:
+    return {_[0][3]: _[0][2] for _ in client.put_block.call_args_list}
+
+
+class TestResumableBlockUpload(object):
+    def test_upload(self, client, source, tmpdir):
+        upload = victim(client, source, tmpdir, max_connections=2)
+        assert upload.upload() == len(CONTENT)
+
+        block_ids = upload._block_ids()
+        assert len(block_ids) == 3
+        assert put_blocks(client) == dict(zip(block_ids, [b"0123", b"4567", b"89"]))
+        client.put_block_list.assert_called_once_with(
+            "container", "app.jar", mock.ANY, content_settings=mock.ANY
+        )
+        assert [_.id for _ in client.put_block_list.call_args[0][2]] == block_ids
+        assert client.put_block_list.call_args[1]["content_settings"].content_md5 == file_md5(source)
+        assert not os.path.exists(upload.journal.path)
+
+    @mock.patch("takeoff.azure.resumable_upload.time.sleep")
+    def test_upload_retries_missing_blocks(self, _, client, source, tmpdir):
+        upload = victim(client, source, tmpdir, retries=1)
+        failing = upload._block_ids()[1]
+        attempts = []
+
+        def put_block(container, blob, data, block_id, validate_content):
+            attempts.append(block_id)
+            if block_id == failing and attempts.count(block_id) == 1:
+                raise ConnectionError("connection reset")
+
+        client.put_block.side_effect = put_block
+        assert upload.upload() == len(CONTENT)
+        assert sorted(attempts) == sorted(upload._block_ids() + [failing])
+        client.put_block_list.assert_called_once()
+
+    @mock.patch("takeoff.azure.resumable_upload.time.sleep")
+    def test_upload_keeps_journal_on_failure(self, _, client, source, tmpdir):
+        upload = victim(client, source, tmpdir, retries=0)
+        failing = upload._block_ids()[2]
+
+        def put_block(container, blob, data, block_id, validate_content):
+            if block_id == failing:
+                raise ConnectionError("connection reset")
+
+        client.put_block.side_effect = put_block
+
+        with pytest.raises(ConnectionError):
+            upload.upload()
+
+        client.put_block_list.assert_not_called()
+        with open(upload.journal.path) as f:
+            assert json.load(f)["blocks"] == sorted(upload._block_ids()[:2])
+
+    def test_upload_resumes(self, client, source, tmpdir):
+        previous = victim(client, source, tmpdir)
+        staged = previous._block_ids()[:2]
+        for block_id in staged:
+            previous.journal.add(block_id)
+        # the second block was discarded by the service
+        client.get_block_list.side_effect = None
+        client.get_block_list.return_value.uncommitted_blocks = [BlobBlock(id=staged[0])]
+
+        upload = victim(client, source, tmpdir)
+        assert upload.upload() == 6
+
+        assert sorted(put_blocks(client)) == sorted(upload._block_ids()[1:])
+        client.put_block_list.assert_called_once()
+
+    def test_block_ids_depend_on_content(self, client, source, tmpdir):
+        block_ids = victim(client, source, tmpdir)._block_ids()
+        with open(source, "wb") as f:
+            f.write(b"9876543210")
+        assert not set(block_ids) & set(victim(client, source, tmpdir)._block_ids())
+        assert all(len(_) == len(block_ids[0]) for _ in block_ids)
+
+
+class TestUploadJournal(object):
+    def test_persist(self, tmpdir):
+        path = str(tmpdir.join("journal", "upload.json"))
+        UploadJournal(path, "md5", 4).add("block-1")
+
+        assert UploadJournal(path, "md5", 4).blocks() == {"block-1"}
+        assert UploadJournal(path, "other-md5", 4).blocks() == set()
+        assert UploadJournal(path, "md5", 8).blocks() == set()
+
+    def test_remove(self, tmpdir):
+        path = str(tmpdir.join("upload.json"))
+        journal = UploadJournal(path, "md5", 4)
+        journal.add("block-1")
+        journal.remove()
+
+        assert not os.path.exists(path)
+        assert journal.blocks() == set()
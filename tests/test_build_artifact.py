@@ -43,7 +43,7 @@ class TestBuildArtifact(unittest.TestCase):
         conf = {**takeoff_config(), **BASE_CONF}
         with mock.patch("takeoff.build_artifact.run_shell_command", return_value=(0, ['output_lines'])) as m:
             victim(FAKE_ENV, conf).build_python_wheel()
-        m.assert_called_once_with(["python", "setup.py", "bdist_wheel"])
+        m.assert_called_once_with(["python", "setup.py", "bdist_wheel"], max_output_lines=10)
 
     @mock.patch.dict(os.environ, {"CI_PROJECT_NAME": "Elon"})
     @mock.patch.object(victim, "_write_version")
@@ -53,7 +53,7 @@ class TestBuildArtifact(unittest.TestCase):
         with pytest.raises(ChildProcessError):
             with mock.patch("takeoff.build_artifact.run_shell_command", return_value=(1, ['output_lines'])) as m:
                 victim(FAKE_ENV, conf).build_python_wheel()
-            m.assert_called_once_with(["python", "setup.py", "bdist_wheel"])
+            m.assert_called_once_with(["python", "setup.py", "bdist_wheel"], max_output_lines=10)
 
     @mock.patch.dict(os.environ, {"CI_PROJECT_NAME": "Elon"})
     @mock.patch.object(victim, "_write_version")
@@ -62,7 +62,7 @@ class TestBuildArtifact(unittest.TestCase):
         conf = {**takeoff_config(), **BASE_CONF}
         with mock.patch("takeoff.build_artifact.run_shell_command", return_value=(0, ['output_lines'])) as m:
             victim(FAKE_ENV, conf).build_sbt_assembly_jar()
-        m.assert_called_once_with(["sbt", "clean", "assembly"])
+        m.assert_called_once_with(["sbt", "clean", "assembly"], max_output_lines=10)
 
     @mock.patch.dict(os.environ, {"CI_PROJECT_NAME": "Elon"})
     @mock.patch.object(victim, "_write_version")
@@ -72,7 +72,7 @@ class TestBuildArtifact(unittest.TestCase):
         with pytest.raises(ChildProcessError):
             with mock.patch("takeoff.build_artifact.run_shell_command", return_value=(1, ['output_lines'])) as m:
                 victim(FAKE_ENV, conf).build_sbt_assembly_jar()
-            m.assert_called_once_with(["sbt", "clean", "assembly"])
+            m.assert_called_once_with(["sbt", "clean", "assembly"], max_output_lines=10)
 
     def test_remove_old_artifacts(self):
         with mock.patch("takeoff.build_artifact.shutil") as m:
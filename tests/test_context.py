@@ -1,6 +1,10 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import pytest
 
-from takeoff.context import Context
+from takeoff.context import Context, Singleton
 
 
 @pytest.fixture(scope='module', autouse=True)
@@ -46,3 +50,18 @@ def test_get_or_else():
     Context().create_or_update("Alice", "Cooper")
     assert Context().get_or_else("Not exists", {}) == {}
     assert Context().get_or_else("Alice", {}) == "Cooper"
+
+
+def test_singleton_is_created_once_by_concurrent_callers():
+    created = []
+
+    class Slow(metaclass=Singleton):
+        def __init__(self):
+            created.append(threading.get_ident())
+            time.sleep(0.05)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        instances = list(executor.map(lambda _: Slow(), range(8)))
+
+    assert len(created) == 1
+    assert all(_ is instances[0] for _ in instances)
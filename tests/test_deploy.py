@@ -121,6 +121,52 @@ def test_deploy_to_databricks(_, mock_load_yaml, mock_get_version, __):
         )
 
 
+@mock.patch.dict(os.environ, environment_variables)
+@mock.patch("takeoff.deploy.get_full_yaml_filename", side_effect=filename)
+@mock.patch("takeoff.deploy.get_environment", return_value=env)
+@mock.patch("takeoff.deploy.load_yaml")
+@mock.patch("takeoff.deploy.run_steps")
+def test_max_parallel_steps_defaults_to_4(mock_run_steps, mock_load_yaml, _, __):
+    mock_load_yaml.side_effect = lambda s: {'steps': []} if s == '.takeoff/deployment.yml' else {}
+
+    main()
+
+    assert mock_run_steps.call_args[0][2] == 4
+
+
+@pytest.mark.parametrize("max_parallel_steps", [0, -1, "4"])
+@mock.patch.dict(os.environ, environment_variables)
+@mock.patch("takeoff.deploy.get_full_yaml_filename", side_effect=filename)
+@mock.patch("takeoff.deploy.get_environment", return_value=env)
+@mock.patch("takeoff.deploy.load_yaml")
+@mock.patch("takeoff.deploy.run_steps")
+def test_max_parallel_steps_is_validated(mock_run_steps, mock_load_yaml, _, __, max_parallel_steps):
+    deployment = {'steps': [], 'max_parallel_steps': max_parallel_steps}
+    mock_load_yaml.side_effect = lambda s: deployment if s == '.takeoff/deployment.yml' else {}
+
+    with pytest.raises(vol.MultipleInvalid):
+        main()
+    mock_run_steps.assert_not_called()
+
+
+@mock.patch.dict(os.environ, environment_variables)
+@mock.patch("takeoff.deploy.get_full_yaml_filename", side_effect=filename)
+@mock.patch("takeoff.deploy.get_environment", return_value=env)
+@mock.patch("takeoff.deploy.load_yaml")
+@mock.patch("takeoff.deploy.run_steps")
+def test_run_scoped_caches_are_reset(_, mock_load_yaml, __, ___):
+    mock_load_yaml.side_effect = lambda s: {'steps': []} if s == '.takeoff/deployment.yml' else {}
+
+    with mock.patch("takeoff.deploy.KeyVaultSecretCache") as m_secrets, \
+            mock.patch("takeoff.deploy.KeyVaultClient") as m_keyvault, \
+            mock.patch("takeoff.deploy.ManagementClients") as m_management:
+        main()
+
+    m_secrets.return_value.invalidate.assert_called_once_with()
+    m_keyvault.clear.assert_called_once_with()
+    m_management.return_value.clear.assert_called_once_with()
+
+
 def test_version_no_feature():
     env = ApplicationVersion("DEV", "SNAPSHOT", 'some-branch')
     assert not env.on_feature_branch
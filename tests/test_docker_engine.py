@@ -0,0 +1,103 @@
+import os
+from unittest import mock
+
+import pytest
+from docker.errors import APIError
+
+from takeoff.credentials.container_registry import DockerCredentials
+from takeoff.docker_engine import DockerSdkEngine
+
+CREDS = DockerCredentials("My", "Little", "pony")
+AUTH = {"username": "My", "password": "Little", "serveraddress": "pony"}
+
+
+@pytest.fixture
+def client() -> mock.Mock:
+    return mock.Mock()
+
+
+@pytest.fixture
+def victim(client) -> DockerSdkEngine:
+    return DockerSdkEngine(CREDS, client)
+
+
+class TestDockerSdkEngine(object):
+    @mock.patch.dict(os.environ, {"PIP_EXTRA_INDEX_URL": "url/to/artifact/store"})
+    def test_build_image(self, victim, client, capsys):
+        client.build.return_value = iter(
+            [{"stream": "Step 1/2 : FROM python\n"}, {"stream": "\n"}, {"aux": {"ID": "sha256:abc"}}]
+        )
+        victim.build_image(
+            "Thefile", "myreg.io/app:1.0", output_prefix="[Thefile] ", cache_from=["app:latest"]
+        )
+
+        client.build.assert_called_once_with(
+            path=".",
+            dockerfile="Thefile",
+            tag="myreg.io/app:1.0",
+            buildargs={"PIP_EXTRA_INDEX_URL": "url/to/artifact/store"},
+            cache_from=["app:latest"],
+            labels=None,
+            rm=True,
+            decode=True,
+        )
+        assert capsys.readouterr().out == "[Thefile] Step 1/2 : FROM python\n"
+
+    def test_build_image_failure(self, victim, client):
+        client.build.return_value = iter([{"stream": "Step 1/2\n"}, {"error": "no such file\n"}])
+        with pytest.raises(ChildProcessError, match="no such file"):
+            victim.build_image("Thefile", "app:1.0")
+
+    def test_build_image_buildkit_not_supported(self, victim, client):
+        with pytest.raises(ValueError):
+            victim.build_image("Thefile", "app:1.0", buildkit=True)
+        client.build.assert_not_called()
+
+    def test_tag_image(self, victim, client):
+        client.tag.return_value = True
+        victim.tag_image("myreg.io:5000/app:1.0", "myreg.io:5000/app:latest")
+        client.tag.assert_called_once_with("myreg.io:5000/app:1.0", "myreg.io:5000/app", "latest")
+
+    def test_tag_image_failure(self, victim, client):
+        client.tag.side_effect = APIError("no such image")
+        with pytest.raises(ChildProcessError):
+            victim.tag_image("app:1.0", "app:latest")
+
+    def test_push_image(self, victim, client):
+        client.push.return_value = iter(
+            [
+                {"status": "The push refers to repository [myreg.io/app]"},
+                {"status": "Preparing", "id": "aaa"},
+                {"status": "Preparing", "id": "bbb"},
+                {"status": "Pushing", "id": "aaa", "progressDetail": {"current": 512, "total": 1024}},
+                {"status": "Layer already exists", "id": "bbb"},
+                {"status": "Pushing", "id": "aaa", "progressDetail": {"current": 1024, "total": 1024}},
+                {"status": "Pushed", "id": "aaa"},
+                {"status": "1.0: digest: sha256:def size: 1234"},
+                {"aux": {"Tag": "1.0", "Digest": "sha256:def", "Size": 1234}},
+            ]
+        )
+        res = victim.push_image("myreg.io/app:1.0")
+
+        client.push.assert_called_once_with(
+            "myreg.io/app", tag="1.0", stream=True, decode=True, auth_config=AUTH
+        )
+        assert res.digest == "sha256:def"
+        assert res.bytes_pushed == 1024
+        assert res.layers["aaa"].status == "Pushed"
+        assert res.layers["aaa"].seconds >= 0
+        assert res.layers["bbb"].status == "Layer already exists"
+        assert res.layers["bbb"].bytes_pushed == 0
+
+    def test_push_image_failure(self, victim, client):
+        client.push.return_value = iter([{"status": "Preparing", "id": "aaa"}, {"error": "denied"}])
+        with pytest.raises(ChildProcessError, match="denied"):
+            victim.push_image("myreg.io/app:1.0")
+
+    def test_pull_image(self, victim, client):
+        assert victim.pull_image("myreg.io/app:latest")
+        client.pull.assert_called_once_with("myreg.io/app", tag="latest", auth_config=AUTH)
+
+    def test_pull_image_missing(self, victim, client):
+        client.pull.side_effect = APIError("not found")
+        assert not victim.pull_image("myreg.io/app:latest")
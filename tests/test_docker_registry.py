@@ -0,0 +1,141 @@
+import json
+from unittest import mock
+
+import pytest
+import requests
+
+from takeoff.credentials.container_registry import DockerCredentials
+from takeoff.docker_registry import RegistryClient
+
+CREDS = DockerCredentials("My", "Little", "myreg.io")
+
+MANIFEST_V2 = "application/vnd.docker.distribution.manifest.v2+json"
+OCI_INDEX = "application/vnd.oci.image.index.v1+json"
+
+
+def response(status: int, body=None, headers=None) -> requests.Response:
+    res = requests.Response()
+    res.status_code = status
+    res._content = body if isinstance(body, bytes) else json.dumps(body or {}).encode()
+    res.headers.update(headers or {})
+    return res
+
+
+def manifest(config_digest: str) -> requests.Response:
+    body = json.dumps({"mediaType": MANIFEST_V2, "config": {"digest": config_digest}}).encode()
+    return response(200, body, {"Content-Type": MANIFEST_V2})
+
+
+def image_config(labels) -> requests.Response:
+    return response(200, {"architecture": "amd64", "config": {"Labels": labels}})
+
+
+@pytest.fixture
+def session() -> mock.Mock:
+    return mock.Mock()
+
+
+@pytest.fixture
+def victim(session) -> RegistryClient:
+    return RegistryClient(CREDS, session)
+
+
+class TestRegistryClient(object):
+    def test_image_label(self, victim, session):
+        session.request.side_effect = [manifest("sha256:cfg"), image_config({"takeoff.context-hash": "abc"})]
+
+        assert victim.image_label("myreg.io/app:1.0", "takeoff.context-hash") == "abc"
+
+        auth = ("My", "Little")
+        session.request.assert_has_calls([
+            mock.call("GET", "https://myreg.io/v2/app/manifests/1.0", headers=mock.ANY, auth=auth),
+            mock.call("GET", "https://myreg.io/v2/app/blobs/sha256:cfg", headers={}, auth=auth),
+        ])
+        assert MANIFEST_V2 in session.request.call_args_list[0][1]["headers"]["Accept"]
+
+    def test_image_label_missing_label(self, victim, session):
+        session.request.side_effect = [manifest("sha256:cfg"), image_config(None)]
+
+        assert victim.image_label("myreg.io/app:1.0", "takeoff.context-hash") is None
+
+    def test_image_label_missing_image(self, victim, session):
+        session.request.return_value = response(404)
+
+        assert victim.image_label("myreg.io/app:1.0", "takeoff.context-hash") is None
+        session.request.assert_called_once()
+
+    def test_image_label_registry_error(self, victim, session):
+        session.request.return_value = response(500)
+
+        with pytest.raises(requests.HTTPError):
+            victim.image_label("myreg.io/app:1.0", "takeoff.context-hash")
+
+    def test_image_label_multi_platform(self, victim, session):
+        index = {
+            "manifests": [
+                {"digest": "sha256:attestation", "platform": {"os": "unknown", "architecture": "unknown"}},
+                {"digest": "sha256:amd64", "platform": {"os": "linux", "architecture": "amd64"}},
+            ]
+        }
+        session.request.side_effect = [
+            response(200, index, {"Content-Type": OCI_INDEX}),
+            manifest("sha256:cfg"),
+            image_config({"takeoff.context-hash": "abc"}),
+        ]
+
+        assert victim.image_label("myreg.io/app:1.0", "takeoff.context-hash") == "abc"
+        assert session.request.call_args_list[1][0][1] == "https://myreg.io/v2/app/manifests/sha256:amd64"
+
+    def test_token_authentication(self, victim, session):
+        challenge = 'Bearer realm="https://myreg.io/oauth2/token",service="myreg.io"'
+        session.request.side_effect = [
+            response(401, headers={"WWW-Authenticate": challenge}),
+            manifest("sha256:cfg"),
+            image_config({"takeoff.context-hash": "abc"}),
+        ]
+        session.get.return_value = response(200, {"access_token": "t0k3n"})
+
+        assert victim.image_label("myreg.io/app:1.0", "takeoff.context-hash") == "abc"
+
+        session.get.assert_called_once_with(
+            "https://myreg.io/oauth2/token",
+            params={"service": "myreg.io", "scope": "repository:app:pull,push"},
+            auth=("My", "Little"),
+        )
+        # the token is reused for the next request to the same repository
+        assert session.request.call_args_list[2][1]["headers"] == {"Authorization": "Bearer t0k3n"}
+
+    def test_other_registries_are_anonymous(self, victim, session):
+        session.request.return_value = response(404)
+
+        victim.image_label("python:3.7", "takeoff.context-hash")
+
+        session.request.assert_called_once_with(
+            "GET", "https://registry-1.docker.io/v2/library/python/manifests/3.7", headers=mock.ANY, auth=None
+        )
+
+    def test_tag_image(self, victim, session):
+        session.request.side_effect = [manifest("sha256:cfg"), response(201)]
+
+        victim.tag_image("myreg.io/app:SNAPSHOT", "myreg.io/app:1.0")
+
+        put = session.request.call_args_list[1]
+        assert put[0] == ("PUT", "https://myreg.io/v2/app/manifests/1.0")
+        assert put[1]["headers"] == {"Content-Type": MANIFEST_V2}
+        assert json.loads(put[1]["data"])["config"]["digest"] == "sha256:cfg"
+
+    def test_tag_image_missing(self, victim, session):
+        session.request.return_value = response(404)
+
+        with pytest.raises(ChildProcessError, match="does not exist"):
+            victim.tag_image("myreg.io/app:SNAPSHOT", "myreg.io/app:1.0")
+
+    def test_tag_image_failure(self, victim, session):
+        session.request.side_effect = [manifest("sha256:cfg"), response(403)]
+
+        with pytest.raises(ChildProcessError, match="Could not tag image"):
+            victim.tag_image("myreg.io/app:SNAPSHOT", "myreg.io/app:1.0")
+
+    def test_tag_image_other_repository(self, victim):
+        with pytest.raises(ValueError):
+            victim.tag_image("myreg.io/app:SNAPSHOT", "myreg.io/other:1.0")
@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+from takeoff.scheduler import plan_steps, run_steps
+
+
+def test_plan_steps_sequential_by_default():
+    steps = plan_steps(
+        [{"task": "build_artifact"}, {"task": "publish_artifact"}, {"task": "deploy_to_databricks"}]
+    )
+
+    assert [_.depends_on for _ in steps] == [frozenset(), {0}, {0, 1}]
+
+
+def test_plan_steps_depends_on():
+    steps = plan_steps(
+        [
+            {"task": "build_artifact"},
+            {"task": "create_application_insights", "depends_on": []},
+            {"task": "publish_artifact", "depends_on": ["build_artifact"]},
+            {"task": "build_docker_image", "name": "docker", "depends_on": []},
+            {"task": "deploy_to_databricks", "depends_on": ["publish_artifact", "docker"]},
+        ]
+    )
+
+    assert [_.depends_on for _ in steps] == [frozenset(), frozenset(), {0}, frozenset(), {2, 3}]
+    assert steps[3].name == "docker"
+
+
+def test_plan_steps_context_keys():
+    steps = plan_steps(
+        [
+            {"task": "configure_eventhub"},
+            {"task": "build_docker_image", "depends_on": []},
+            {"task": "deploy_to_kubernetes", "depends_on": ["build_docker_image"]},
+        ]
+    )
+
+    assert steps[2].depends_on == {0, 1}
+
+
+def test_plan_steps_unknown_dependency():
+    with pytest.raises(ValueError):
+        plan_steps([{"task": "build_artifact", "depends_on": ["foo"]}])
+
+
+def test_plan_steps_cycle():
+    with pytest.raises(ValueError):
+        plan_steps(
+            [
+                {"task": "build_artifact", "depends_on": ["publish_artifact"]},
+                {"task": "publish_artifact", "depends_on": ["build_artifact"]},
+            ]
+        )
+
+
+def test_run_steps_in_order():
+    ran = []
+    steps = plan_steps(
+        [{"task": "build_artifact"}, {"task": "publish_artifact"}, {"task": "deploy_to_databricks"}]
+    )
+
+    run_steps(steps, lambda step: ran.append(step.name), max_workers=4)
+
+    assert ran == ["build_artifact", "publish_artifact", "deploy_to_databricks"]
+
+
+def test_run_steps_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    ran = []
+
+    def run(step):
+        if step.name != "deploy_to_databricks":
+            barrier.wait()
+        ran.append(step.name)
+
+    steps = plan_steps(
+        [
+            {"task": "create_application_insights"},
+            {"task": "build_docker_image", "depends_on": []},
+            {"task": "deploy_to_databricks"},
+        ]
+    )
+    run_steps(steps, run, max_workers=2)
+
+    assert ran[-1] == "deploy_to_databricks"
+
+
+def test_run_steps_stops_after_failure():
+    ran = []
+
+    def run(step):
+        if step.name == "build_artifact":
+            time.sleep(0.1)
+            raise ChildProcessError("boom")
+        ran.append(step.name)
+
+    steps = plan_steps(
+        [
+            {"task": "build_artifact"},
+            {"task": "create_application_insights", "depends_on": []},
+            {"task": "publish_artifact", "depends_on": ["build_artifact"]},
+        ]
+    )
+    with pytest.raises(ChildProcessError):
+        run_steps(steps, run, max_workers=2)
+
+    assert ran == ["create_application_insights"]
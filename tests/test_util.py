@@ -1,5 +1,10 @@
+import json
 import os
 import re
+import sys
+import threading
+import time
+from unittest import mock
 
 import pytest
 
@@ -84,3 +89,211 @@ def test_get_main_py_name():
 def test_get_main_py_name_with_original_filename():
     result = victim.get_main_py_name("project-name", "my-branch", "my_app/src/some.py", True)
     assert result == "project-name/project_name-main-my_branch-some.py"
+
+
+@mock.patch("takeoff.util.DEFAULT_TAKEOFF_PLUGIN_PREFIX", "_takeoff_")
+def test_load_takeoff_plugins_discovers_once():
+    victim.refresh_takeoff_plugins()
+    with mock.patch("takeoff.util.pkgutil.iter_modules", return_value=[]) as m_iter:
+        victim.load_takeoff_plugins()
+        victim.load_takeoff_plugins()
+        assert victim.find_takeoff_plugin_function("deploy_env_logic") is None
+    m_iter.assert_called_once()
+    victim.refresh_takeoff_plugins()
+
+
+@mock.patch("takeoff.util.DEFAULT_TAKEOFF_PLUGIN_PREFIX", "_takeoff_")
+def test_refresh_takeoff_plugins():
+    paths = [os.path.dirname(os.path.realpath(__file__))]
+    victim.refresh_takeoff_plugins()
+    assert victim.find_takeoff_plugin_function("deploy_env_logic") is None
+
+    sys.path.extend(paths)
+    victim.refresh_takeoff_plugins()
+    assert victim.find_takeoff_plugin_function("deploy_env_logic")({}).branch == "master"
+
+    sys.path.remove(paths[0])
+    victim.refresh_takeoff_plugins()
+
+
+def test_run_shell_command_env(capsys):
+    return_code, output = victim.run_shell_command(
+        ["sh", "-c", "echo $TAKEOFF_TEST"], "[x] ", {"TAKEOFF_TEST": "1"}
+    )
+    assert return_code == 0
+    assert output == ["1\n"]
+    assert capsys.readouterr().out == "[x] 1\n"
+
+
+def test_run_shell_command_max_output_lines(capsys):
+    return_code, output = victim.run_shell_command(["sh", "-c", "echo 1; echo 2; echo 3"], max_output_lines=2)
+    assert return_code == 0
+    assert output == ["2\n", "3\n"]
+    assert capsys.readouterr().out == "1\n2\n3\n"
+
+
+def test_run_command_captures_stderr(capsys):
+    res = victim.run_command(["sh", "-c", "echo out; echo err >&2; exit 3"], "[x] ")
+    assert res.exit_code == 3
+    assert res.stdout == ["out\n"]
+    assert res.stderr == ["err\n"]
+    assert not res.timed_out
+    assert res.duration > 0
+    captured = capsys.readouterr()
+    assert captured.out == "[x] out\n"
+    assert captured.err == "[x] err\n"
+
+
+def test_run_command_max_output_lines():
+    res = victim.run_command(["sh", "-c", "for i in 1 2 3 4 5; do echo $i; done"], max_output_lines=2)
+    assert res.exit_code == 0
+    assert res.stdout == ["4\n", "5\n"]
+
+
+def test_run_command_timeout():
+    res = victim.run_command(["sleep", "10"], timeout=0.2)
+    assert res.timed_out
+    assert res.exit_code != 0
+    assert res.duration < 5
+
+
+def test_run_concurrently_keeps_order():
+    def square(i):
+        time.sleep(0.01 * (5 - i))
+        return i * i
+
+    assert victim.run_concurrently(square, range(5), 3, "square", "numbers") == [0, 1, 4, 9, 16]
+
+
+def test_run_concurrently_limits_workers():
+    running, peak, lock = [0], [0], threading.Lock()
+
+    def work(_):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    victim.run_concurrently(work, range(8), 2, "work on", "items")
+    assert peak[0] == 2
+
+
+def test_run_concurrently_reports_all_failures():
+    done = []
+
+    def check(i):
+        if i % 2:
+            raise ValueError(f"odd {i}")
+        done.append(i)
+
+    with pytest.raises(RuntimeError, match="Could not check 2 of 4 numbers") as e:
+        victim.run_concurrently(check, [0, 1, 2, 3], 2, "check", "numbers", lambda _: f"number {_}")
+
+    assert "- number 1: odd 1\n- number 3: odd 3" in str(e.value)
+    assert isinstance(e.value.__cause__, ValueError)
+    assert str(e.value.__cause__) == "odd 1"
+    assert sorted(done) == [0, 2]
+
+
+def test_run_concurrently_serial_stops_at_first_failure():
+    done = []
+
+    def check(i):
+        if i == 0:
+            raise ValueError("zero")
+        done.append(i)
+
+    with pytest.raises(ValueError, match="zero"):
+        victim.run_concurrently(check, [0, 1, 2], 1, "check", "numbers")
+
+    assert done == []
+
+
+def test_run_concurrently_fail_fast():
+    done = []
+
+    def check(i):
+        if i == 0:
+            raise ValueError("zero")
+        time.sleep(0.1)
+        done.append(i)
+
+    with pytest.raises(ValueError, match="zero"):
+        victim.run_concurrently(check, range(6), 2, "check", "numbers", fail_fast=True)
+
+    # the item that was already running is finished, the others are never started
+    assert done == [1]
+
+
+def test_write_json_atomically(tmpdir):
+    path = str(tmpdir.join("state", "file.json"))
+    victim.write_json_atomically(path, {"b": 1, "a": [2]}, mode=0o600)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+    victim.write_json_atomically(path, {"b": 2}, mode=0o600)
+    with open(path) as f:
+        assert json.load(f) == {"b": 2}
+    assert not os.path.exists(f"{path}.tmp")
+
+
+def test_keyed_cache_creates_once():
+    cache, created = victim.KeyedCache(), []
+
+    def create():
+        time.sleep(0.05)
+        created.append("a")
+        return len(created)
+
+    values = victim.run_concurrently(lambda _: cache.get_or_create("a", create), range(4), 4, "get", "values")
+    assert values == [1] * 4
+    assert created == ["a"]
+
+
+def test_keyed_cache_clear():
+    cache = victim.KeyedCache()
+    for key in ["a1", "a2", "b1"]:
+        cache.get_or_create(key, lambda: key.upper())
+
+    assert cache.clear(lambda _: _.startswith("a")) == ["A1", "A2"]
+    assert cache.get_or_create("b1", lambda: "new") == "B1"
+    assert cache.clear() == ["B1"]
+    assert cache.get_or_create("b1", lambda: "new") == "new"
+
+
+def test_run_concurrently_no_items():
+    assert victim.run_concurrently(lambda _: 1 / 0, [], 4, "divide", "numbers") == []
+
+
+@pytest.fixture
+def git_repo(tmp_path, monkeypatch):
+    from git import Repo
+
+    repo = Repo.init(tmp_path)
+    with repo.config_writer() as config:
+        config.set_value("user", "name", "takeoff")
+        config.set_value("user", "email", "takeoff@example.com")
+    (tmp_path / "file").write_text("1")
+    repo.index.add(["file"])
+    repo.index.commit("first")
+    monkeypatch.chdir(tmp_path)
+    victim.refresh_git_metadata()
+    yield repo
+    victim.refresh_git_metadata()
+
+
+def test_git_metadata(git_repo):
+    git_repo.create_tag("1.0.0")
+    assert victim.get_tag() == "1.0.0"
+    assert victim.get_short_hash() == git_repo.head.object.hexsha[:7]
+    assert victim.get_short_hash(10) == git_repo.head.object.hexsha[:10]
+
+
+def test_git_metadata_resolved_once(git_repo):
+    assert victim.get_tag() is None
+    git_repo.create_tag("1.0.0")
+    assert victim.get_tag() is None
+
+    victim.refresh_git_metadata()
+    assert victim.get_tag() == "1.0.0"